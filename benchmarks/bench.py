@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+'''Benchmark bosun tasks against a fake cluster on this machine.
+
+Tasks run unchanged, but remote calls go to a local shell (the 'local'
+backend in bosun.remote, with an optional latency added to every call)
+and qsub/qstat/qdel/hg/rsync are the fakes in benchmarks/fakebin. For
+each task the wall time, number of remote calls and bytes moved are
+reported.
+
+  python benchmarks/bench.py [--latency 0.05] [--json results.json]
+                             [--trace trace.json] [task ...]
+
+Tasks: deploy, deploy_again, run_model, check_status, archive (all by
+default, in this order; later ones depend on the earlier ones).
+'''
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import cluster
+
+
+TASKS = ('deploy', 'deploy_again', 'run_model', 'check_status', 'archive')
+
+
+def _setup_environment(root, latency):
+    ''' Isolate HOME, the local cache and PATH before bosun is imported '''
+    os.environ['HOME'] = join(root, 'home')
+    os.environ['BOSUN_CACHE_DIR'] = join(root, 'cache')
+    os.environ['BOSUN_FAKE_CLUSTER'] = join(root, 'cluster')
+    os.environ['PATH'] = cluster.FAKEBIN + os.pathsep + os.environ['PATH']
+    os.environ.setdefault('USER', 'bench')
+
+    from fabric.api import env
+    env.host_string = 'bench'
+    env.user = os.environ['USER']
+    env.bosun_backend = 'local'
+    env.bosun_latency = latency
+    # no login scripts: they would reset PATH
+    env.shell = '/bin/bash -c'
+
+
+def _submit_fake_run(root):
+    ''' Write model outputs for the whole run and queue its job, as the
+        runscript would. '''
+    exp = join(root, 'home', 'exp', cluster.NAME)
+    script = ('export workdir=%s TRUNC=0062 LEV=028 && '
+              '. %s/runscripts/run_atmos_model.cray run 2000010100 '
+              '2000010300 2000010300 4 %s'
+              % (join(root, 'scratch', cluster.NAME, 'work'), exp,
+                 cluster.NAME))
+    subprocess.check_call(['bash', '-c', script], stdout=open(os.devnull, 'w'))
+
+
+def run_task(name, root, exp_repo):
+    import bosun
+    from bosun import tasks
+
+    kw = {'name': cluster.NAME, 'exp_repo': exp_repo}
+    if name in ('deploy', 'deploy_again'):
+        bosun.deploy(**kw)
+    elif name == 'run_model':
+        tasks.run_model(**kw)
+    elif name == 'check_status':
+        _submit_fake_run(root)
+        tasks.check_status(oneshot=True, **kw)
+    elif name == 'archive':
+        bosun.archive(**kw)
+
+
+def benchmark(names, root, exp_repo, log):
+    from fabric.api import settings, hide
+    from bosun import remote
+
+    results = []
+    for name in names:
+        remote.reset_stats()
+        stdout = sys.stdout
+        sys.stdout = log
+        start = time.time()
+        try:
+            with settings(hide('running', 'stdout', 'stderr')):
+                run_task(name, root, exp_repo)
+        finally:
+            sys.stdout = stdout
+        elapsed = time.time() - start
+        results.append({'task': name,
+                        'seconds': elapsed,
+                        'calls': dict(remote.STATS['calls']),
+                        'bytes_sent': remote.STATS['bytes_sent'],
+                        'bytes_received': remote.STATS['bytes_received']})
+    return results
+
+
+def report(results):
+    from bosun.storage import human_size
+
+    print('%-14s %9s %6s  %-38s %10s %10s'
+          % ('task', 'wall (s)', 'calls', 'by operation', 'sent',
+             'received'))
+    for r in results:
+        calls = r['calls']
+        ops = ' '.join('%s=%d' % (op, calls[op]) for op in sorted(calls))
+        print('%-14s %9.2f %6d  %-38s %10s %10s'
+              % (r['task'], r['seconds'], sum(calls.values()), ops,
+                 human_size(r['bytes_sent']),
+                 human_size(r['bytes_received'])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('tasks', nargs='*', metavar='task',
+                        help='one of: %s' % ', '.join(TASKS))
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to each remote call')
+    parser.add_argument('--job-seconds', type=int, default=3,
+                        help='how long each fake job runs')
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--trace', help='write a trace of every task and '
+                        'remote call to this file (see bosun.trace)')
+    parser.add_argument('--keep', action='store_true',
+                        help="don't remove the fake cluster tree")
+    args = parser.parse_args(argv)
+    unknown = set(args.tasks) - set(TASKS)
+    if unknown:
+        parser.error('unknown tasks: %s' % ', '.join(sorted(unknown)))
+
+    root = tempfile.mkdtemp(prefix='bosun-bench-')
+    try:
+        os.environ['BOSUN_FAKE_JOB_SECONDS'] = str(args.job_seconds)
+        exp_repo = cluster.create(root)
+        _setup_environment(root, args.latency)
+        if args.trace:
+            from fabric.api import env
+            env.bosun_trace = abspath(args.trace)
+        with open(join(root, 'bench.log'), 'w') as log:
+            results = benchmark(args.tasks or TASKS, root, exp_repo, log)
+        report(results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'latency': args.latency, 'results': results}, f,
+                          indent=1, sort_keys=True)
+    finally:
+        if args.keep:
+            print('Fake cluster kept in %s' % root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
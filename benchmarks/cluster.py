@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+'''Fake cluster tree for the benchmarks.
+
+Builds, under a root directory, everything an atmos experiment needs: an
+experiments repository, a code repository with Makefiles, AGCM inputs, a
+workdir template, an archive (hsm) directory and runscripts submitting
+jobs to the fake PBS in fakebin/.
+'''
+
+import os
+from os.path import join, dirname, abspath
+
+
+NAME = 'bench'
+FAKEBIN = join(dirname(abspath(__file__)), 'fakebin')
+
+CONFIG = '''
+name: {name}
+type: atmos
+mode: cold
+start: 2000010100
+restart: 2000010100
+finish: 2000010300
+restart_interval: 1 day
+TRC: 62
+LV: 28
+dt_atmos: 600
+npes: 4
+walltime: "01:00:00"
+platform: fake
+account: bench
+status_sleep_time: 1
+instrument: false
+clean_checkout: false
+code_repo: ROOT/repos/code
+code_dir: ROOT/home/code
+code_branch: default
+root: ROOT/home/code
+rootexp: ROOT/scratch/{name}/rootexp
+expdir: ROOT/home/exp/{name}
+execdir: ROOT/scratch/{name}/exec
+workdir: ROOT/scratch/{name}/work
+workdir_template: ROOT/data/workdir_template
+executable: ROOT/scratch/{name}/exec/ParModel_MPP
+envconf: ROOT/data/envconf
+envconf_pos: ROOT/data/envconf
+atmos_makeconf: ROOT/data/Makefile.model
+pre_atmos: ROOT/home/code/pre
+posgrib_src: ROOT/home/code/pos/source
+PATH2: ROOT/scratch/{name}/rootexp/PATH2
+agcm_namelist:
+  file: ROOT/home/exp/{name}/MODELIN
+agcm_model_inputs: ROOT/data/agcm_model
+agcm_pos_inputs: ROOT/data/agcm_pos
+hsm: ROOT/hsm
+'''
+
+MODELIN = ''' &MODEL_RES
+ trunc = 62
+ vert = 28
+ dt = 600
+ /
+ &MODEL_IN
+ slagr = .FALSE.
+ /
+ &PHYSPROC
+ iswrad = 'CRD'
+ /
+ &PHYSCS
+ mxrdcc = .TRUE.
+ /
+ &COMCON
+ initlz = 2
+ /
+'''
+
+# Sourced by agcm.run_model: writes what the model would write and submits
+# a job to the fake queue.
+RUNSCRIPT = '''# fake AGCM runscript: run start restart finish npes name
+start=$2; finish=$4; name=$6
+out=$workdir/model/dataout/TQ${TRUNC}L${LEV}
+mkdir -p $out
+for p in 001 002; do
+    head -c 262144 /dev/urandom > \\
+        $out/GFCTNMC${start}${finish}F.unf.TQ${TRUNC}L${LEV}.outattP$p
+done
+touch $out/GFCTNMC${start}${finish}F.fct.TQ${TRUNC}L${LEV}
+head -c 65536 /dev/urandom | base64 > $workdir/Out.MPI.1
+job=$(qsub -N M_$name ${JobID_depend:+-W depend=afterok:$JobID_depend} \\
+      $workdir/run_model.cray)
+echo "JobIDmodel: $job"
+'''
+
+MAKEFILE = '''cray:
+\ttouch aux.exe
+'''
+
+MODEL_MAKEFILE = '''all:
+\tmkdir -p $(dir $(executable)) && touch $(executable)
+'''
+
+
+def _write(path, content=''):
+    if not os.path.isdir(dirname(path)):
+        os.makedirs(dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _data(path, nbytes):
+    _write(path, os.urandom(nbytes))
+
+
+def create(root, inputs=20, input_size=1 << 20):
+    '''Create the fake cluster tree under root. Returns the path of the
+    experiments repository (the exp_repo task argument).'''
+    config = CONFIG.replace('ROOT', root).replace('{name}', NAME)
+    exp = join(root, 'repos', 'exps', 'exp', NAME)
+    _write(join(exp, 'namelist.yaml'), config)
+    _write(join(exp, 'MODELIN'), MODELIN)
+    _write(join(exp, 'runscripts', 'run_atmos_model.cray'), RUNSCRIPT)
+
+    code = join(root, 'repos', 'code')
+    _write(join(code, 'pre', 'sources', 'Makefile'), MAKEFILE)
+    _write(join(code, 'pos', 'source', 'Makefile'), MAKEFILE)
+
+    data = join(root, 'data')
+    _write(join(data, 'envconf'), 'export BOSUN_FAKE_ENV=1\n')
+    _write(join(data, 'Makefile.model'), MODEL_MAKEFILE)
+    for i in range(inputs):
+        _data(join(data, 'agcm_model', 'input%03d.unf' % i), input_size)
+        _data(join(data, 'agcm_pos', 'table%03d' % i), input_size // 16)
+    for i in range(inputs):
+        _data(join(data, 'workdir_template', 'INPUT', 'field%03d.nc' % i),
+              input_size)
+
+    for path in ('home', 'scratch', 'hsm', 'cluster'):
+        os.makedirs(join(root, path))
+    return join(root, 'repos', 'exps')
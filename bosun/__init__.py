@@ -2,11 +2,12 @@
 
 import fabric.colors as fc
 from fabric.decorators import task
-from fabric.api import run as frun
 
-from bosun import coupled, agcm, mom4
-from bosun import tasks
-from bosun.environ import env_options, fmt
+from bosun import tasks, ensemble
+from bosun.dag import Graph
+from bosun.cache import ConfigCache
+from bosun.environ import env_options, fmt, invalidate_remote_env
+from bosun.remote import batch, run as frun
 
 
 @task
@@ -14,13 +15,20 @@ from bosun.environ import env_options, fmt
 def deploy(environ, **kwargs):
     '''Deploy cycle: prepare, compile.
 
+    Independent steps run concurrently (see deploy_graph). Pass
+    dry_run=True to only print the plan.
+
     Depends on:
       prepare
       compilation
     '''
+    graph = deploy_graph(environ)
+    if kwargs.get('dry_run', False):
+        graph.plan()
+        return
     print(fc.green("Started"))
-    prepare(environ)
-    compilation(environ)
+    graph.run(environ)
+    graph.report()
 
 
 @task
@@ -33,10 +41,95 @@ def deploy_and_run(environ, **kwargs):
       compilation
       run
     '''
+    graph = deploy_graph(environ)
+    graph.add('run', tasks.run_model, requires=list(graph.steps))
+    if kwargs.get('dry_run', False):
+        graph.plan()
+        return
+    print(fc.green("Started"))
+    graph.run(environ)
+    graph.report()
+
+
+def deploy_graph(environ):
+    '''Steps of prepare and compilation, and what each one needs.
+
+    The code checkout, the workdir and the experiment directories are
+    independent, and so are the model, pre and post-processing builds.
+    '''
+    graph = Graph('deploy')
+    _prepare_steps(graph, environ)
+    _compilation_steps(graph, environ)
+    return graph
+
+
+def _prepare_steps(graph, environ):
+    model = environ['model']
+    graph.add('make_dirs', _make_dirs)
+    graph.add('prepare_expdir', model.prepare_expdir, requires=['make_dirs'])
+    graph.add('prepare_workdir', model.prepare_workdir)
+    graph.add('copy_expfiles', _copy_expfiles, requires=['make_dirs'])
+
+
+def _compilation_steps(graph, environ):
+    model = environ['model']
+    # only wait for the directories when preparing in the same graph
+    dirs = [s for s in ('make_dirs',) if s in graph.steps]
+    expdir = [s for s in ('prepare_expdir',) if s in graph.steps]
+    expfiles = [s for s in ('copy_expfiles',) if s in graph.steps]
+    graph.add('check_code', tasks.check_code)
+    if environ['instrument']:
+        # pat_build reads instrument_coupler.apa from the copied expfiles
+        graph.add('instrument_code', tasks.instrument_code,
+                  requires=['check_code'] + dirs + expdir + expfiles)
+    else:
+        # builds can run on any host of the pool
+        graph.add('compile_model', model.compile_model,
+                  requires=['check_code'] + dirs, balanced=True)
+        for step in ('compile_pre', 'compile_post'):
+            if hasattr(model, 'component_graph'):
+                # one step per component model
+                model.component_graph(step, graph,
+                                      requires=['check_code'] + expdir,
+                                      balanced=True)
+            else:
+                graph.add(step, getattr(model, step),
+                          requires=['check_code'] + expdir, balanced=True)
+
+
+def _make_dirs(environ):
+    print(fc.yellow('Preparing expdir'))
+    with batch() as b:
+        b.run(fmt('mkdir -p {expdir}', environ))
+        b.run(fmt('mkdir -p {execdir}', environ))
+
+
+def _copy_expfiles(environ):
+    frun(fmt('rsync -rtL --progress {expfiles}/exp/{name}/* {expdir}',
+             environ))
+
+
+@task
+@env_options
+def run_ensemble(environ, **kwargs):
+    '''Ensemble cycle: compile once, then prepare and run every member.
+
+    Members run concurrently, at most 'ensemble_workers' at a time, each
+    one logging to its own file (see ensemble.run_members).
+
+    Depends on:
+      compilation
+      prepare
+      run_model
+    '''
     print(fc.green("Started"))
-    prepare(environ)
     compilation(environ)
-    run(environ)
+    ensemble.run_members(environ, _run_member)
+
+
+def _run_member(environ):
+    prepare(environ)
+    tasks.run_model(environ)
 
 
 @task
@@ -44,16 +137,22 @@ def deploy_and_run(environ, **kwargs):
 def compilation(environ, **kwargs):
     '''Compile code for model run and post-processing.
 
+    Each build is skipped when its fingerprint (see build.Fingerprint)
+    matches the one stored next to its product. The model, pre and
+    post-processing builds run concurrently.
+
     Depends on:
       instrument_code
       compile_model
       check_code
     '''
-    if environ['instrument']:
-        tasks.check_code(environ)
-        tasks.instrument_code(environ)
-    elif tasks.check_code(environ):
-        tasks.compile_model(environ)
+    graph = Graph('compilation')
+    _compilation_steps(graph, environ)
+    if kwargs.get('dry_run', False):
+        graph.plan()
+        return
+    graph.run(environ)
+    graph.report()
 
 
 @task
@@ -66,12 +165,12 @@ def prepare(environ, **kwargs):
       link_agcm_inputs
       prepare_workdir
     '''
-    print(fc.yellow('Preparing expdir'))
-    frun(fmt('mkdir -p {expdir}', environ))
-    frun(fmt('mkdir -p {execdir}', environ))
-
-    environ['model'].prepare(environ)
-    frun(fmt('rsync -rtL --progress {expfiles}/exp/{name}/* {expdir}', environ))
+    graph = Graph('prepare')
+    _prepare_steps(graph, environ)
+    if kwargs.get('dry_run', False):
+        graph.plan()
+        return
+    graph.run(environ)
 
 
 @task
@@ -112,6 +211,8 @@ def restart(environ, **kwargs):
 @task
 @env_options
 def generate_grid(environ, **kwargs):
+    from bosun import mom4
+
     tasks.prepare_expdir(environ)
     tasks.check_code(environ)
     mom4.compile_pre(environ)
@@ -121,6 +222,8 @@ def generate_grid(environ, **kwargs):
 @task
 @env_options
 def make_xgrids(environ, **kwargs):
+    from bosun import mom4
+
     tasks.prepare_expdir(environ)
     tasks.check_code(environ)
     mom4.compile_pre(environ)
@@ -130,6 +233,8 @@ def make_xgrids(environ, **kwargs):
 @task
 @env_options
 def regrid_3d(environ, **kwargs):
+    from bosun import mom4
+
     tasks.prepare_expdir(environ)
     tasks.check_code(environ)
     mom4.compile_pre(environ)
@@ -139,7 +244,20 @@ def regrid_3d(environ, **kwargs):
 @task
 @env_options
 def regrid_2d(environ, **kwargs):
+    from bosun import mom4
+
     tasks.prepare_expdir(environ)
     tasks.check_code(environ)
     mom4.compile_pre(environ)
     mom4.regrid_2d(environ)
+
+
+@task
+def clear_cache():
+    '''Forget the cached remote shell environment, configurations and
+    namelist templates.'''
+    from bosun import namelist
+
+    invalidate_remote_env()
+    ConfigCache().clear()
+    namelist.clear()
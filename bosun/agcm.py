@@ -2,19 +2,24 @@
 
 from __future__ import with_statement
 from __future__ import print_function
-from StringIO import StringIO
 import re
 from datetime import datetime
 
-from fabric.api import run, cd, get, put, prefix, hide, settings
+from fabric.api import cd, prefix, settings
 from fabric.decorators import task
 import fabric.colors as fc
-from fabric.contrib.files import exists
-from mom_utils import nml_decode, yaml2nml
 
+from bosun import namelist
+from bosun.build import Fingerprint, parallel_make
 from bosun.environ import env_options, fmt, shell_env
+from bosun.progress import tracker, ForecastProgress
+from bosun.remote import batch, run
+from bosun.staging import (stage_workdir, link_tree_script, LINK_MARKER,
+                           copy_files_script)
+from bosun.storage import (Archive, compression, extract_command,
+                           probe_extract_command, tarball_name)
 from bosun.utils import total_seconds, JOB_STATES, print_ETA
-from bosun.utils import hsm_full_path, clear_output
+from bosun.utils import hsm_full_path, restart_index
 
 
 def format_atmos_date(date):
@@ -43,66 +48,51 @@ def prepare_namelist(environ, **kwargs):
     Depends on:
       None
     '''
-    input_file = StringIO()
-    get(fmt('{agcm_namelist[file]}', environ), input_file)
-    data = nml_decode(input_file.getvalue())
-    input_file.close()
-    output = StringIO()
-
-    try:
-        tkeys = set(
-            environ['atmos_namelist']['vars'].keys()) & set(data.keys())
-    except KeyError:
-        pass
-    else:
-        for k in tkeys:
-            keys = set(environ['atmos_namelist']['vars'][k]
-                       .keys()) & set(data[k].keys())
-            data[k].update([(
-                ke, environ['atmos_namelist']['vars'][k][ke]) for ke in keys])
-
     trunc = "%04d" % environ['TRC']
     lev = "%03d" % environ['LV']
 
-    data['MODEL_RES']['trunc'] = "%04d" % environ['TRC']
-    data['MODEL_RES']['vert'] = environ['LV']
-    data['MODEL_RES']['dt'] = environ['dt_atmos']
-    data['MODEL_RES']['IDATEI'] = format_atmos_date(environ['start'])
-    data['MODEL_RES']['IDATEW'] = format_atmos_date(environ['restart'])
-    data['MODEL_RES']['IDATEF'] = format_atmos_date(environ['finish'])
-    data['MODEL_RES']['DHEXT'] = environ.get('DHEXT', 0)
-    if environ.get('DHEXT', 0) != 0:
-        begin = datetime.strptime(environ['restart'], "%Y%m%d%H")
-        end = datetime.strptime(environ['finish'], "%Y%m%d%H")
-        nhext = total_seconds(end - begin) / 3600
-    else:
-        nhext = 0
-    data['MODEL_RES']['NHEXT'] = nhext
-
-    # TODO: is this environ['agcm_model_inputs'] ?
-    data['MODEL_RES']['path_in'] = fmt(
-        '{rootexp}/AGCM-1.0/model/datain', environ)
+    def update(data):
+        data['MODEL_RES']['trunc'] = "%04d" % environ['TRC']
+        data['MODEL_RES']['vert'] = environ['LV']
+        data['MODEL_RES']['dt'] = environ['dt_atmos']
+        data['MODEL_RES']['IDATEI'] = format_atmos_date(environ['start'])
+        data['MODEL_RES']['IDATEW'] = format_atmos_date(environ['restart'])
+        data['MODEL_RES']['IDATEF'] = format_atmos_date(environ['finish'])
+        data['MODEL_RES']['DHEXT'] = environ.get('DHEXT', 0)
+        if environ.get('DHEXT', 0) != 0:
+            begin = datetime.strptime(environ['restart'], "%Y%m%d%H")
+            end = datetime.strptime(environ['finish'], "%Y%m%d%H")
+            nhext = total_seconds(end - begin) / 3600
+        else:
+            nhext = 0
+        data['MODEL_RES']['NHEXT'] = nhext
 
-    data['MODEL_RES']['dirfNameOutput'] = (
-        fmt('{workdir}/model/dataout/TQ%sL%s' % (trunc, lev), environ))
+        # TODO: is this environ['agcm_model_inputs'] ?
+        data['MODEL_RES']['path_in'] = fmt(
+            '{rootexp}/AGCM-1.0/model/datain', environ)
 
-    output.write(yaml2nml(data,
-                          key_order=['MODEL_RES', 'MODEL_IN', 'PHYSPROC',
-                                     'PHYSCS', 'COMCON']))
+        data['MODEL_RES']['dirfNameOutput'] = (
+            fmt('{workdir}/model/dataout/TQ%sL%s' % (trunc, lev), environ))
 
     # HACK: sigh, this is needed to run atmos post processing, even if we
     # don't use these forecasts.
-    output.write("""
+    forecasts = """
  17
    6.0 12.0  18.0  24.0
   30.0 36.0  42.0  48.0
   54.0 60.0  66.0  72.0
   84.0 96.0 120.0 144.0
  168.0
-""")
+"""
 
-    put(output, fmt('{workdir}/MODELIN', environ))
-    output.close()
+    namelist.render(fmt('{agcm_namelist[file]}', environ),
+                    fmt('{workdir}/MODELIN', environ) +
+                    environ.get('namelist_suffix', ''),
+                    update=update,
+                    variables=environ.get('atmos_namelist', {}).get('vars'),
+                    key_order=['MODEL_RES', 'MODEL_IN', 'PHYSPROC',
+                               'PHYSCS', 'COMCON'],
+                    trailer=forecasts)
 
 
 @task
@@ -163,7 +153,7 @@ def run_model(environ, **kwargs):
     env_vars.update({'TRUNC': trunc, 'LEV': lev})
 
     keys = ['rootexp', 'workdir', 'TRUNC', 'LEV', 'executable', 'walltime',
-            'execdir', 'platform', 'LV']
+            'execdir', 'platform', 'LV', 'JobID_depend', 'namelist_suffix']
     with shell_env(env_vars, keys=keys):
         with prefix(fmt('source {envconf}', environ)):
             with cd(fmt('{expdir}/runscripts', environ)):
@@ -176,30 +166,47 @@ def run_model(environ, **kwargs):
 @task
 @env_options
 def compile_pre(environ, **kwargs):
-    with shell_env(environ, keys=['PATH2']):
-        with prefix(fmt('source {envconf_pos}', environ)):
-            with cd(fmt('{pre_atmos}/sources', environ)):
-                fix_atmos_makefile()
-                run(fmt('make cray', environ))
+    _compile_aux(environ, fmt('{pre_atmos}/sources', environ))
 
 
 @task
 @env_options
 def compile_post(environ, **kwargs):
+    _compile_aux(environ, environ['posgrib_src'])
+
+
+def _compile_aux(environ, src):
+    ''' Build pre or post-processing sources in src '''
+    with cd(src):
+        fix_atmos_makefile()
+    fp = Fingerprint(environ, '%s/.bosun_fingerprint' % src,
+                     inputs=[fmt('{envconf_pos}', environ),
+                             '%s/Makefile' % src],
+                     keys=['PATH2'])
+    if fp.matches():
+        return
     with shell_env(environ, keys=['PATH2']):
         with prefix(fmt('source {envconf_pos}', environ)):
-            with cd(environ['posgrib_src']):
-                fix_atmos_makefile()
+            with cd(src), parallel_make(environ):
                 run(fmt('make cray', environ))
+    fp.save()
 
 
 @task
 @env_options
 def compile_model(environ, **kwargs):
+    fp = Fingerprint(environ, fmt('{executable}.fingerprint', environ),
+                     inputs=[fmt('{atmos_makeconf}', environ),
+                             fmt('{envconf}', environ)],
+                     keys=['root', 'executable'],
+                     target=environ['executable'])
+    if fp.matches():
+        return
     with shell_env(environ, keys=['root', 'executable']):
         with prefix(fmt('source {envconf}', environ)):
-            with cd(fmt('{execdir}', environ)):
+            with cd(fmt('{execdir}', environ)), parallel_make(environ):
                 run(fmt('make -f {atmos_makeconf}', environ))
+    fp.save()
 
 
 @task
@@ -214,14 +221,21 @@ def prepare(environ, **kwargs):
 def prepare_workdir(environ, **kwargs):
     '''Prepare output dir
 
+    The workdir is populated from a snapshot of the template, with hard
+    links by default (see staging.stage_workdir).
+
     Used vars:
       workdir
       workdir_template
+      workdir_staging
+      template_store
+      workdir_writable
     '''
     print(fc.yellow('Preparing workdir'))
-    run(fmt('mkdir -p {workdir}', environ))
-    run(fmt('rsync -rtL --progress {workdir_template}/* {workdir}', environ))
-    run(fmt('touch {workdir}/time_stamp.restart', environ))
+    with batch() as b:
+        b.run(stage_workdir(environ))
+        b.run(fmt('touch {workdir}/time_stamp.restart', environ))
+    restart_index(environ).forget_workdir(environ['workdir'])
     # TODO: lots of things.
     #  1) generate atmos inputs (gdas_to_atmos from oper scripts)
     #  2) copy restart files from somewhere (emanuel's spinup, for example)
@@ -239,7 +253,10 @@ def prepare_expdir(environ, **kwargs):
 def check_restart(environ, **kwargs):
     if 'warm' in environ['mode']:
         prepare_restart(environ)
-        run(fmt('ls {workdir}/model/dataout/TQ{TRC:04d}L{LV:03d}/*{start}{restart}F.unf*outatt*', environ))
+        index = restart_index(environ)
+        if not index.extracted('atmos', environ['restart'], environ['workdir']):
+            run(fmt('ls {workdir}/model/dataout/TQ{TRC:04d}L{LV:03d}/*{start}{restart}F.unf*outatt*', environ))
+            index.mark_extracted('atmos', environ['restart'], environ['workdir'])
 
 
 @task
@@ -260,24 +277,38 @@ def prepare_inputs(environ, **kwargs):
 @task
 @env_options
 def link_agcm_inputs(environ, **kwargs):
-    '''Copy AGCM inputs for model run and post-processing to the right place
+    '''Link AGCM inputs for model run and post-processing to the right place
+
+    Inputs are symlinked by default ('agcm_inputs_link' can be symlink,
+    hardlink or copy), and nothing is done if they didn't change since the
+    last time (see staging.link_tree_script).
 
     Used vars:
       rootexp
       agcm_pos_inputs
       agcm_model_inputs
+      agcm_inputs_link
     '''
+    mode = environ.get('agcm_inputs_link', 'symlink')
+    linked = {}
+    with batch() as b:
+        for comp in ['model', 'pos']:
+            print(fc.yellow(fmt("Linking AGCM %s input data" % comp, environ)))
+            linked[comp] = b.run(link_tree_script(
+                fmt('{agcm_%s_inputs}' % comp, environ),
+                fmt('{rootexp}/AGCM-1.0/%s/datain' % comp, environ),
+                mode=mode))
     for comp in ['model', 'pos']:
-        print(fc.yellow(fmt("Linking AGCM %s input data" % comp, environ)))
-        if not exists(fmt('{rootexp}/AGCM-1.0/%s/datain' % comp, environ)):
-            run(fmt('mkdir -p {rootexp}/AGCM-1.0/%s/datain' % comp, environ))
-        run(fmt('cp -R {agcm_%s_inputs}/* '
-                '{rootexp}/AGCM-1.0/%s/datain' % (comp, comp), environ))
+        if LINK_MARKER + 'unchanged' in linked[comp].output:
+            print(fc.green('AGCM %s input data up to date' % comp))
 
 
 def fix_atmos_makefile():
-    '''Stupid pre and pos makefiles...'''
-    run("sed -i.bak -r -e 's/^PATH2/#PATH2/g' Makefile")
+    '''Stupid pre and pos makefiles...
+
+    Only rewrite them when needed, or make would rebuild everything.'''
+    run("! grep -q '^PATH2' Makefile || "
+        "sed -i.bak -r -e 's/^PATH2/#PATH2/g' Makefile")
 
 
 def fix_atmos_runpre(environ):
@@ -302,11 +333,11 @@ def check_status(environ, status):
         print(fc.yellow('Atmos post-processing: %s' % JOB_STATES[status['S']]))
     elif status['ID'] in environ.get('JobID_model', ""):
         if status['S'] == 'R':
-            with hide('running', 'stdout'):
-                fcts = run(fmt('find {workdir}/model/dataout/ -iname "*.fct.*" | sort', environ))
-            date = re.search('.*(\d{10})F.*', fcts.splitlines()[-1])
-            if date:
-                current = datetime.strptime(date.groups()[0], "%Y%m%d%H")
+            current = tracker(status['ID'], ForecastProgress,
+                              fmt('{workdir}/model/dataout', environ),
+                              '*.fct.*',
+                              fmt('{workdir}/.bosun_progress', environ)).poll()
+            if current:
                 print_ETA(environ, status, current)
             else:
                 print(fc.yellow('Preparing!'))
@@ -314,51 +345,113 @@ def check_status(environ, status):
             print(fc.yellow('Model: %s' % JOB_STATES[status['S']]))
 
 
+# Files in the workdir archived after each segment, and the ones among
+# them kept uncompressed
+OUTPUTS = ['MODELIN', 'Out.MPI.*', 'set_post*out.txt',
+           'set_g4c_posgrib*out.txt', 'POSTIN-GRIB', 'set_g4c_poseta*out.txt']
+KEEP_OUTPUTS = ('MODELIN', 'POSTIN-GRIB')
+
+# Where the model writes restarts, relative to the workdir
+DATAOUT = 'model/dataout/TQ{TRC:04}L{LV:03}'
+
+
+def _restart_pieces(environ, date):
+    ''' Restart files written at date ('finish' or 'restart') '''
+    return fmt('GFCTNMC{start}{%s}F.unf.TQ{TRC:04}L{LV:03}.*P???' % date,
+               environ)
+
+
+def snapshot_script(environ, dest):
+    '''Shell lines copying what archive reads to dest, laid out as in the
+    workdir.
+
+    The restart this segment started from is removed from the workdir when
+    the previous segment was snapshotted too (then it is archived from
+    that snapshot), as archive did before it could run alongside the next
+    segment.
+    '''
+    dataout = fmt('{workdir}/%s' % DATAOUT, environ)
+    lines = ['mkdir -p %s/%s' % (dest, fmt(DATAOUT, environ)),
+             copy_files_script(dataout, [_restart_pieces(environ, 'finish')],
+                               '%s/%s' % (dest, fmt(DATAOUT, environ))),
+             copy_files_script(fmt('{workdir}', environ), OUTPUTS, dest)]
+    if environ.get('JobID_depend') and environ['mode'] != 'cold':
+        lines.append('rm -f %s/%s' % (dataout,
+                                      _restart_pieces(environ, 'restart')))
+    return lines
+
+
 @task
 @env_options
 def archive(environ, **kwargs):
+    '''Archive outputs and restart files of the last segment
+
+    Used vars:
+      workdir
+      hsm
+      start
+      finish
+      TRC
+      LV
+      archive_jobs
+      archive_compression
+      archive_chunk
+    '''
     full_path, cname = hsm_full_path(environ)
+    arch = Archive(full_path, jobs=environ.get('archive_jobs', 4),
+                   compression=compression(environ),
+                   chunk=environ.get('archive_chunk', 256))
 
-    run('mkdir -p %s/atmos/%s' % (full_path, cname))
+    arch.mkdir('%s/atmos/%s' % (full_path, cname))
     # TODO: copy AGCM output ({workdir}/pos/dataout)
 
-    run('mkdir -p %s/output' % full_path)
-    with cd(fmt('{workdir}', environ)):
-        with settings(warn_only=True):
-            out = run(fmt('ls -1 MODELIN Out.MPI.* set_post*out.txt '
-                      'set_g4c_posgrib*out.txt POSTIN-GRIB '
-                      'set_g4c_poseta*out.txt 2>/dev/null', environ))
-        files = clear_output(out).splitlines()
-        for f in files:
-            if exists(f):
-                if f not in ('MODELIN', 'POSTIN-GRIB'):
-                    run(fmt('gzip %s' % f, environ))
-                    f = f + '.gz'
-                run(fmt('mv %s %s/output/' % (f, full_path), environ))
-
-    run('mkdir -p %s/restart' % full_path)
-    with cd(fmt('{workdir}/model/dataout/TQ{TRC:04}L{LV:03}', environ)):
-        run(fmt('tar czvf GFCTNMC{start}{finish}F.unf.TQ{TRC:04}L{LV:03}.tar.gz '
-            'GFCTNMC{start}{finish}F.unf.TQ{TRC:04}L{LV:03}.*P???', environ))
-        run(fmt('mv GFCTNMC{start}{finish}F.unf.TQ{TRC:04}L{LV:03}.tar.gz '
-            '%s/restart/' % full_path, environ))
-        run(fmt('rm GFCTNMC{start}{finish}F.unf.TQ{TRC:04}L{LV:03}.*P???',
-            environ))
+    arch.outputs(fmt('{workdir}', environ), OUTPUTS, keep=KEEP_OUTPUTS)
+
+    name = tarball_name(
+        fmt('GFCTNMC{start}{finish}F.unf.TQ{TRC:04}L{LV:03}', environ), environ)
+    arch.tarball(fmt('{workdir}/%s' % DATAOUT, environ), name,
+                 [_restart_pieces(environ, 'finish')], remove=True)
+    arch.run()
+
+    restart_index(environ).record('atmos', environ['finish'],
+                                  '%s/restart/%s' % (full_path, name),
+                                  **arch.stored.get(name, {}))
 
 
 @task
 @env_options
 def prepare_restart(environ, **kwargs):
-    '''Prepare restart for new run'''
+    '''Prepare restart for new run
+
+    Files are only extracted from the archive when they are not in the
+    workdir, decompressed according to their suffix. The restart index
+    is not trusted alone, since the workdir may have been cleaned since.
+    '''
+    index = restart_index(environ)
     with settings(warn_only=True):
         out = run(fmt('ls {workdir}/model/dataout/TQ{TRC:04d}L{LV:03d}/*{start}{restart}F.unf*outatt*', environ))
-    if out.failed:
-        with cd(fmt('{workdir}/model/dataout/TQ{TRC:04}L{LV:03}', environ)):
+    if out.succeeded and index.extracted('atmos', environ['restart'],
+                                         environ['workdir']):
+        print(fc.green('Atmos restart %s already in workdir'
+                       % environ['restart']))
+    elif out.failed:
+        index.mark_missing('atmos', environ['restart'])
+        entry = index.lookup('atmos', environ['restart'])
+        if entry and entry['archive']:
+            command = extract_command(entry['archive'], environ)
+        else:
+            # archived before the index: the compression isn't known
             full_path, cname = hsm_full_path(environ)
-            run(fmt('tar xf %s/restart/GFCTNMC{start}{restart}F.unf.TQ{TRC:04}L{LV:03}.tar.gz' % full_path, environ))
+            command = probe_extract_command(fmt('%s/restart/GFCTNMC{start}{restart}F.unf.TQ{TRC:04}L{LV:03}' % full_path, environ), environ)
+        with cd(fmt('{workdir}/model/dataout/TQ{TRC:04}L{LV:03}', environ)):
+            run(command)
+    else:
+        index.mark_extracted('atmos', environ['restart'], environ['workdir'])
 
 
 @task
 @env_options
 def verify_run(environ, **kwargs):
-    pass
+    ''' Nothing is checked yet: returns False, so the segment isn't taken
+        as verified (see tasks._finish_segment). '''
+    return False
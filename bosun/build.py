@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import hashlib
+
+from fabric.api import env, settings, hide, prefix
+import fabric.colors as fc
+
+from bosun.remote import run
+
+
+SEPARATOR = '@@bosun:fingerprint'
+
+
+class Fingerprint(object):
+    '''Fingerprint of the inputs of a build, stored next to its product.
+
+    It combines the revision of the code repository (plus a digest of
+    uncommitted changes), the contents of the input files (makeconf,
+    envconf, mkmf template, Makefiles...), the environ keys exported to
+    the build and the active command prefixes (module loads, for example).
+    Checking it costs one remote call:
+
+      fp = Fingerprint(environ, stamp, inputs, keys, target=executable)
+      if not fp.matches():
+          ... build ...
+          fp.save()
+
+    Setting 'force_build' in environ makes matches always return False.
+    '''
+
+    def __init__(self, environ, stamp, inputs=(), keys=(), target=None):
+        self.environ = environ
+        self.stamp = stamp
+        self.inputs = list(inputs)
+        self.keys = list(keys)
+        self.target = target
+        self.value = None
+
+    def _remote_state(self):
+        ''' Returns (stored fingerprint, target exists, input state) '''
+        code_dir = self.environ.get('code_dir', None)
+        lines = ['cat %s 2>/dev/null' % self.stamp,
+                 'echo "%s"' % SEPARATOR]
+        if self.target:
+            lines.append('test -e %s && echo present' % self.target)
+        lines.append('echo "%s"' % SEPARATOR)
+        if code_dir:
+            lines.append('hg -R %s id -i 2>/dev/null' % code_dir)
+            lines.append('hg -R %s diff 2>/dev/null | md5sum' % code_dir)
+        if self.inputs:
+            lines.append('md5sum %s 2>&1' % ' '.join(self.inputs))
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                      warn_only=True):
+            out = run("\n".join(lines))
+        stored, target, state = out.split(SEPARATOR, 2)
+        stored = stored.split()
+        return ((stored[-1] if stored else None), 'present' in target,
+                state.strip())
+
+    def compute(self, state):
+        values = [(k, self.environ.get(k, None)) for k in sorted(self.keys)]
+        digest = hashlib.sha1(state)
+        digest.update(repr(values))
+        digest.update(repr(list(env.command_prefixes)))
+        return digest.hexdigest()
+
+    def matches(self):
+        stored, present, state = self._remote_state()
+        self.value = self.compute(state)
+        if self.environ.get('force_build', False):
+            return False
+        if self.target and not present:
+            return False
+        if stored == self.value:
+            print(fc.green('Up to date: %s' % (self.target or self.stamp)))
+            return True
+        return False
+
+    def save(self):
+        if self.value is None:
+            self.value = self.compute(self._remote_state()[2])
+        with settings(hide('running', 'stdout')):
+            run('echo %s > %s' % (self.value, self.stamp))
+
+
+def parallel_make(environ):
+    '''Context manager running builds with 'make_jobs' parallel jobs.
+
+    It exports MAKEFLAGS, so it also reaches the make calls inside build
+    scripts (mkmf makeconfs, for example). Use it around the build command
+    only, after checking the Fingerprint: the number of jobs doesn't change
+    what is built.
+    '''
+    jobs = environ.get('make_jobs', None)
+    if not jobs:
+        return settings()
+    return prefix('export MAKEFLAGS=-j%d' % int(jobs))
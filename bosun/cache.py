@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+import os
+from os.path import expanduser, join, exists
+import json
+import time
+import hashlib
+import shutil
+import cPickle as pickle
+
+
+CACHE_DIR = os.environ.get('BOSUN_CACHE_DIR', expanduser('~/.bosun/cache'))
+
+# Seconds a cached configuration is trusted without asking the remote side
+# for the experiments repository revision. 0 means always probe.
+CONFIG_TTL = int(os.environ.get('BOSUN_CONFIG_TTL', 0))
+
+
+def cache_dir(*parts):
+    '''Return a directory inside the local cache, creating it if needed'''
+    path = join(CACHE_DIR, *parts)
+    if not exists(path):
+        os.makedirs(path)
+    return path
+
+
+def digest(text):
+    return hashlib.sha1(text).hexdigest()
+
+
+def _write(path, data, mode='w'):
+    ''' Write to a temporary file and rename, so concurrent bosun
+        processes never see a partial file. '''
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, mode) as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+class ConfigCache(object):
+    '''Content-addressed cache of experiment configurations.
+
+    namelist.yaml contents are stored by their SHA1, and an index maps each
+    (host, exp_repo, name) to the experiments repository revision they came
+    from. Expanded configurations are stored by namelist digest plus the
+    task keyword arguments that were merged into them.
+    '''
+
+    def __init__(self, root=None, ttl=CONFIG_TTL):
+        self.root = root or cache_dir('configs')
+        self.ttl = ttl
+        self.index_file = join(self.root, 'index.json')
+
+    def _index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def lookup(self, key):
+        return self._index().get(key, None)
+
+    def fresh(self, entry):
+        return time.time() - entry['checked'] < self.ttl
+
+    def store(self, key, revision, text):
+        text_digest = digest(text)
+        path = join(self.root, text_digest + '.yaml')
+        if not exists(path):
+            _write(path, text)
+        self._update(key, {'revision': revision,
+                           'digest': text_digest,
+                           'checked': time.time()})
+        return text_digest
+
+    def touch(self, key):
+        entry = self.lookup(key)
+        if entry:
+            entry['checked'] = time.time()
+            self._update(key, entry)
+
+    def _update(self, key, entry):
+        index = self._index()
+        index[key] = entry
+        _write(self.index_file, json.dumps(index, indent=1, sort_keys=True))
+
+    def load_text(self, text_digest):
+        try:
+            with open(join(self.root, text_digest + '.yaml')) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _expanded_path(self, text_digest, kw, env_key):
+        key = digest(text_digest + repr(sorted((kw or {}).items())) +
+                     env_key)
+        path = join(self.root, 'expanded')
+        if not exists(path):
+            os.makedirs(path)
+        return join(path, key + '.pickle')
+
+    def load_expanded(self, text_digest, kw, env_key=''):
+        '''Expanded configuration of text_digest with kw. env_key
+        identifies the remote shell environment ${VAR}s were expanded
+        from (host, user and environment), see environ.expansion_key.'''
+        try:
+            with open(self._expanded_path(text_digest, kw, env_key),
+                      'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def store_expanded(self, text_digest, kw, environ, env_key=''):
+        _write(self._expanded_path(text_digest, kw, env_key),
+               pickle.dumps(environ, pickle.HIGHEST_PROTOCOL), mode='wb')
+
+
+class EnvSnapshot(object):
+    '''Persisted snapshot of the shell environment of a remote user.
+
+    One JSON file per user@host, kept until invalidate is called.
+    '''
+
+    def __init__(self, host, root=None):
+        self.host = host
+        self.path = join(root or cache_dir('env'), host.replace('/', '_')
+                         + '.json')
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                env_vars = json.load(f)['vars']
+        except (IOError, ValueError, KeyError):
+            return None
+        return dict((str(k), v.encode('utf-8')) for k, v in env_vars.items())
+
+    def digest(self):
+        ''' SHA1 of the snapshot, None if there is none '''
+        env_vars = self.load()
+        if env_vars is None:
+            return None
+        return digest(json.dumps(env_vars, sort_keys=True))
+
+    def save(self, env_vars):
+        _write(self.path, json.dumps({'host': self.host,
+                                      'time': time.time(),
+                                      'vars': env_vars},
+                                     indent=1, sort_keys=True))
+
+    def invalidate(self):
+        if exists(self.path):
+            os.remove(self.path)
+
+
+class RestartIndex(object):
+    '''Local index of the restart files of an experiment.
+
+    Entries are keyed by component and date, and record where the restart
+    tarball was archived (with its size and MD5) and the workdir it is
+    currently extracted to, if any:
+
+      {'ocean:2008020100': {'archive': '/hsm/.../2008020100.tar.gz',
+                            'size': 1234, 'md5': '...',
+                            'extracted': '/scratch/exp'}}
+    '''
+
+    def __init__(self, host, experiment, root=None):
+        self.path = join(root or cache_dir('restarts'),
+                         digest('%s|%s' % (host, experiment)) + '.json')
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _update(self, component, date, **values):
+        index = self._load()
+        key = '%s:%s' % (component, date)
+        entry = index.setdefault(key, {'archive': None, 'size': None,
+                                       'md5': None, 'extracted': None})
+        entry.update(values)
+        _write(self.path, json.dumps(index, indent=1, sort_keys=True))
+
+    def lookup(self, component, date):
+        return self._load().get('%s:%s' % (component, date), None)
+
+    def record(self, component, date, archive, size=None, md5=None):
+        ''' Restart was archived; the workdir copy is no longer tracked '''
+        self._update(component, date, archive=archive, size=size, md5=md5,
+                     extracted=None)
+
+    def extracted(self, component, date, workdir):
+        entry = self.lookup(component, date)
+        return bool(entry) and entry['extracted'] == workdir
+
+    def mark_extracted(self, component, date, workdir):
+        self._update(component, date, extracted=workdir)
+
+    def mark_missing(self, component, date):
+        if self.lookup(component, date):
+            self._update(component, date, extracted=None)
+
+    def forget_workdir(self, workdir):
+        ''' Workdir was removed or staged again: none of the restarts are
+            extracted to it anymore '''
+        index = self._load()
+        changed = [entry for entry in index.values()
+                   if entry['extracted'] == workdir]
+        for entry in changed:
+            entry['extracted'] = None
+        if changed:
+            _write(self.path, json.dumps(index, indent=1, sort_keys=True))
@@ -4,16 +4,23 @@ from __future__ import with_statement
 from __future__ import print_function
 import re
 
-from fabric.api import run, cd, prefix
+from fabric.api import cd, prefix
 from fabric.decorators import task
 import fabric.colors as fc
 
 from bosun import mom4, agcm
+from bosun.build import Fingerprint, parallel_make
+from bosun.dag import Graph
 from bosun.environ import env_options, fmt, shell_env
+from bosun.remote import run
 from bosun.utils import JOB_STATES
 
 
-__all__ = ['compile_model', 'run_model', 'prepare', 'compile_pre', 'compile_post', 'archive']
+__all__ = ['compile_model', 'run_model', 'prepare', 'prepare_expdir',
+           'prepare_workdir', 'compile_pre', 'compile_post', 'archive']
+
+# Component models, with the name of their steps in a task graph
+COMPONENTS = (('ocean', mom4), ('atmos', agcm))
 
 
 @task
@@ -57,7 +64,8 @@ def run_model(environ, **kwargs):
 
     keys = ['workdir', 'platform', 'walltime', 'datatable', 'diagtable',
             'fieldtable', 'executable', 'execdir', 'TRUNC', 'LEV', 'LV',
-            'rootexp', 'mppnccombine', 'comb_exe', 'account', 'DHEXT']
+            'rootexp', 'mppnccombine', 'comb_exe', 'account', 'DHEXT',
+            'JobID_depend', 'namelist_suffix']
     with shell_env(env_vars, keys=keys):
         with prefix(fmt('source {envconf}', environ)):
             with cd(fmt('{expdir}/runscripts', environ)):
@@ -70,32 +78,66 @@ def run_model(environ, **kwargs):
 @env_options
 def compile_model(environ, **kwargs):
     keys = ['comp', 'code_dir', 'root', 'type', 'mkmf_template', 'executable']
+    fp = Fingerprint(environ, fmt('{executable}.fingerprint', environ),
+                     inputs=[fmt('{cpld_makeconf}', environ),
+                             fmt('{envconf}', environ),
+                             fmt('{mkmf_template}', environ)],
+                     keys=keys, target=environ['executable'])
+    if fp.matches():
+        return
     with shell_env(environ, keys=keys):
         with prefix(fmt('source {envconf}', environ)):
-            with cd(fmt('{execdir}', environ)):
+            with cd(fmt('{execdir}', environ)), parallel_make(environ):
                 run(fmt('/usr/bin/tcsh -e {cpld_makeconf}', environ))
+    fp.save()
 
 
 @task
 @env_options
 def prepare(environ, **kwargs):
+    prepare_expdir(environ)
+    prepare_workdir(environ)
+
+
+@task
+@env_options
+def prepare_expdir(environ, **kwargs):
     mom4.prepare_expdir(environ)
-    mom4.prepare_workdir(environ)
     agcm.link_agcm_inputs(environ)
 
 
+@task
+@env_options
+def prepare_workdir(environ, **kwargs):
+    mom4.prepare_workdir(environ)
+
+
 @task
 @env_options
 def compile_pre(environ, **kwargs):
-    mom4.compile_pre(environ)
-    agcm.compile_pre(environ)
+    '''Build the pre-processing tools of every component, concurrently '''
+    graph = component_graph('compile_pre')
+    graph.run(environ)
+    graph.report()
 
 
 @task
 @env_options
 def compile_post(environ, **kwargs):
-    mom4.compile_post(environ)
-    agcm.compile_post(environ)
+    '''Build the post-processing tools of every component, concurrently '''
+    graph = component_graph('compile_post')
+    graph.run(environ)
+    graph.report()
+
+
+def component_graph(step, graph=None, requires=(), balanced=True):
+    ''' Add a step for each component (named <step>_<component>) '''
+    if graph is None:
+        graph = Graph(step)
+    for name, component in COMPONENTS:
+        graph.add('%s_%s' % (step, name), getattr(component, step),
+                  requires=requires, balanced=balanced)
+    return graph
 
 
 @task
@@ -149,5 +191,12 @@ def prepare_restart(environ, **kwargs):
 @task
 @env_options
 def verify_run(environ, **kwargs):
-    mom4.verify_run(environ)
+    # the coupler output checked by mom4 covers the whole coupled run
+    checked = mom4.verify_run(environ)
     agcm.verify_run(environ)
+    return checked
+
+
+def snapshot_script(environ, dest):
+    return (mom4.snapshot_script(environ, dest) +
+            agcm.snapshot_script(environ, dest))
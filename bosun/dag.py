@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import cPickle as pickle
+import time
+import traceback
+from collections import OrderedDict
+from copy import deepcopy
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+from fabric.api import env, settings
+from fabric.state import connections
+from fabric.utils import abort
+import fabric.colors as fc
+
+from bosun import hosts, remote, trace
+
+
+# Steps running at the same time, unless 'task_workers' says otherwise
+WORKERS = 4
+
+
+def _snapshot(environ):
+    ''' Copy of environ, deep where possible, so changes made in place to
+        nested values (lists, dicts) are seen as updates too '''
+    before = {}
+    for key, value in environ.items():
+        try:
+            before[key] = deepcopy(value)
+        except Exception:
+            # modules and the like: only replacing them counts
+            before[key] = value
+    return before
+
+
+def _run_step(name, func, environ, host, home, queue):
+    ''' Body of a step process: run it and report back what changed '''
+    env.host_string = host
+    env.bosun_home_host = home
+    # connections inherited from the parent can't be shared
+    connections.clear()
+    remote.reset_stats()
+    trace.detach()
+
+    before = _snapshot(environ)
+    seen = len(trace.events())
+    start = time.time()
+    error = None
+    try:
+        func(environ)
+    except BaseException as e:
+        # abort() raises SystemExit
+        traceback.print_exc()
+        error = str(e) or e.__class__.__name__
+    updates = {}
+    for key, value in environ.items():
+        if key in before and before[key] == value:
+            continue
+        try:
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            continue
+        updates[key] = value
+    queue.put({'name': name,
+               'result': {'elapsed': time.time() - start, 'error': error,
+                          'updates': updates,
+                          'events': trace.events()[seen:],
+                          'stats': remote.STATS}})
+
+
+class Graph(object):
+    '''Steps of a task and the steps each one requires.
+
+    Steps are functions taking the environ, like the tasks themselves:
+
+      graph = Graph('deploy')
+      graph.add('check_code', tasks.check_code)
+      graph.add('compile_model', model.compile_model,
+                requires=['check_code'])
+      graph.run(environ)
+
+    run starts every step as soon as the steps it requires finished, at
+    most 'task_workers' (default WORKERS) at a time. Concurrent steps run
+    in separate processes, each with its own connection; changes they make
+    to the environ are copied back. A step that can't run alongside
+    anything else runs in this process.
+
+    Steps added with balanced=True run on the least loaded host of the
+    host pool, if there is one (see hosts.pool); the others stay on the
+    current host.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = OrderedDict()
+        self.balanced = set()
+        self.results = {}
+        self.elapsed = None
+
+    def add(self, name, func, requires=(), balanced=False):
+        self.steps[name] = (func, tuple(requires))
+        if balanced:
+            self.balanced.add(name)
+
+    def levels(self):
+        '''Steps grouped by depth: every step only requires steps from
+        earlier levels. Raises ValueError for unknown steps or cycles.'''
+        for name, (func, requires) in self.steps.items():
+            unknown = [r for r in requires if r not in self.steps]
+            if unknown:
+                raise ValueError('Step %s requires unknown steps: %s'
+                                 % (name, ', '.join(unknown)))
+        levels = []
+        done = set()
+        remaining = list(self.steps)
+        while remaining:
+            level = [name for name in remaining
+                     if done.issuperset(self.steps[name][1])]
+            if not level:
+                raise ValueError('Dependency cycle between steps: %s'
+                                 % ', '.join(remaining))
+            levels.append(level)
+            done.update(level)
+            remaining = [name for name in remaining if name not in done]
+        return levels
+
+    def plan(self):
+        ''' Print what would run, and in which order '''
+        print(fc.yellow('Plan for %s:' % self.name))
+        for i, level in enumerate(self.levels(), 1):
+            for name in level:
+                requires = self.steps[name][1]
+                print(('  %d. %-20s %s' % (
+                    i, name,
+                    'after ' + ', '.join(requires) if requires else ''))
+                    .rstrip())
+
+    def run(self, environ, workers=None):
+        '''Run every step. Returns a dict mapping step names to
+        {'elapsed': seconds, 'error': message or None}, and aborts if a
+        step failed (after the ones already running finish).'''
+        self.levels()
+        workers = max(1, int(workers or environ.get('task_workers', WORKERS)))
+        queue = Queue()
+        pending = list(self.steps)
+        running = {}
+        results = self.results = {}
+        start_all = time.time()
+
+        while True:
+            started = False
+            if not any(result['error'] for result in results.values()):
+                ready = [name for name in pending
+                         if all(r in results for r in self.steps[name][1])]
+                for name in ready:
+                    if len(running) >= workers:
+                        break
+                    pending.remove(name)
+                    func = self.steps[name][0]
+                    started = True
+                    host = env.host_string
+                    if name in self.balanced:
+                        host = hosts.pick(environ)
+                    if workers == 1 or (len(ready) == 1 and not running):
+                        start = time.time()
+                        with settings(host_string=host,
+                                      bosun_home_host=hosts.home()):
+                            func(environ)
+                        results[name] = {'elapsed': time.time() - start,
+                                         'error': None}
+                        break
+                    running[name] = Process(
+                        target=_run_step, name=name,
+                        args=(name, func, environ, host, hosts.home(), queue))
+                    running[name].start()
+            if running:
+                self._collect(environ, queue, running, results)
+            elif not started:
+                break
+
+        self.elapsed = time.time() - start_all
+        failed = sorted(n for n in results if results[n]['error'])
+        if failed:
+            abort('%s: steps failed: %s (skipped: %s)'
+                  % (self.name,
+                     ', '.join('%s (%s)' % (n, results[n]['error'])
+                               for n in failed),
+                     ', '.join(pending) or 'none'))
+        return results
+
+    def report(self):
+        ''' Print how long each step of the last run took, slowest first '''
+        timed = sorted(((r['elapsed'], name)
+                        for name, r in self.results.items()
+                        if r['elapsed'] is not None), reverse=True)
+        print(fc.yellow('%s: %.1fs (%.1fs of steps)'
+                        % (self.name, self.elapsed or 0,
+                           sum(t for t, _ in timed))))
+        for elapsed, name in timed:
+            print('  %-24s %8.1fs' % (name, elapsed))
+
+    def _collect(self, environ, queue, running, results):
+        ''' Wait for a step process to finish '''
+        while True:
+            try:
+                message = queue.get(timeout=1)
+            except Empty:
+                dead = [n for n in running if not running[n].is_alive()]
+                if not dead:
+                    continue
+                try:
+                    message = queue.get(timeout=1)
+                except Empty:
+                    # died without reporting back
+                    process = running.pop(dead[0])
+                    process.join()
+                    results[dead[0]] = {
+                        'elapsed': None,
+                        'error': 'exit code %s' % process.exitcode}
+                    return
+            break
+
+        name = message['name']
+        result = message['result']
+        running.pop(name).join()
+        environ.update(result.pop('updates'))
+        trace.merge(result.pop('events'))
+        remote.merge_stats(result.pop('stats'))
+        results[name] = result
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import os
+import sys
+import time
+import traceback
+from os.path import expanduser, join, exists
+from multiprocessing import Process, Queue
+
+from fabric.api import env
+from fabric.job_queue import JobQueue
+from fabric.state import connections
+import fabric.colors as fc
+
+from bosun import hosts, trace
+
+
+def member_logdir(environ):
+    ''' Local directory for the per-member logs '''
+    logdir = environ.get('ensemble_logdir',
+                         expanduser(join('~/.bosun/logs', environ['name'])))
+    if not exists(logdir):
+        os.makedirs(logdir)
+    return logdir
+
+
+def _run_member(func, environ, host, home, logfile, queue):
+    ''' Body of a member process: log to its own file and report back '''
+    # JobQueue names the process after the host it should connect to, but
+    # our processes are named after ensemble members.
+    env.host_string = host
+    env.bosun_home_host = home
+    # connections inherited from the parent can't be shared
+    connections.clear()
+
+    sys.stdout = sys.stderr = open(logfile, 'a', 0)
+    trace.detach()
+    seen = len(trace.events())
+    start = time.time()
+    error = None
+    try:
+        func(environ)
+    except BaseException as e:
+        # abort() raises SystemExit, and we want to keep the other members
+        # going anyway.
+        traceback.print_exc()
+        error = str(e) or e.__class__.__name__
+    queue.put({'name': environ['name'],
+               'result': {'elapsed': time.time() - start, 'error': error,
+                          'events': trace.events()[seen:]}})
+    if error is not None:
+        sys.exit(1)
+
+
+def run_members(environ, func, workers=None):
+    '''Run func(member_environ) for every ensemble member.
+
+    Members run in separate processes (through Fabric's JobQueue), at most
+    'ensemble_workers' (default 4) at a time, all on the home host since
+    they submit and monitor jobs; their build and archive steps are spread
+    over the host pool as in a single run (see hosts.balanced). Each one
+    logs to <ensemble_logdir>/<member>.log, and its trace spans are merged
+    into this process's trace. Returns a dict mapping member names to
+    {'elapsed': seconds, 'error': message or None}.
+    '''
+    members = environ.get('ensemble_members', {})
+    if not members:
+        print(fc.yellow('No ensemble members defined.'))
+        return {}
+
+    workers = int(workers or environ.get('ensemble_workers', 4))
+    logdir = member_logdir(environ)
+    queue = Queue()
+    jobs = JobQueue(min(workers, len(members)), queue)
+    # JobQueue starts from the end of its list
+    for name in sorted(members, reverse=True):
+        logfile = join(logdir, '%s.log' % name)
+        print(fc.yellow('Member %s: logging to %s' % (name, logfile)))
+        jobs.append(Process(target=_run_member, name=name,
+                            args=(func, members[name], hosts.home(),
+                                  hosts.home(), logfile, queue)))
+    jobs.close()
+    results = jobs.run()
+
+    summary = {}
+    for name in sorted(members):
+        result = results[name]['results'] or {}
+        trace.merge(result.pop('events', []))
+        if result.get('error', None) is None and results[name]['exit_code']:
+            result['error'] = 'exit code %s' % results[name]['exit_code']
+        summary[name] = result
+    print_summary(summary)
+    return summary
+
+
+def print_summary(summary):
+    failed = [name for name in summary if summary[name].get('error')]
+    print(fc.yellow('Ensemble summary: %d members, %d failed'
+                    % (len(summary), len(failed))))
+    for name in sorted(summary):
+        result = summary[name]
+        elapsed = result.get('elapsed', 0)
+        if result.get('error'):
+            print(fc.red('  %-20s FAILED after %6.1f min: %s'
+                         % (name, elapsed / 60., result['error'])))
+        else:
+            print(fc.green('  %-20s ok     in    %6.1f min'
+                           % (name, elapsed / 60.)))
@@ -2,12 +2,18 @@
 
 import functools
 from copy import deepcopy
+from importlib import import_module
+import re
 import string
 from StringIO import StringIO
 
-from fabric.api import run, get, prefix, hide, cd
-from fabric.contrib.files import exists
+from fabric.api import prefix, hide, cd, settings, env
 import rec_env
+import yaml
+
+from bosun import hosts, trace
+from bosun.cache import ConfigCache, EnvSnapshot
+from bosun.remote import run, get, exists
 
 
 API_VERSION = 'v1'
@@ -38,9 +44,18 @@ def env_options(func):
     wrapper search for keyword argument 'config_file' and read the
     config file. Next step is to replace all the cross-referenced vars and then
     call the original function.
+
+    Each call is also a span in the trace, when tracing is enabled (see
+    bosun.trace).
     '''
 
     def _wrapped_env(*args, **kw):
+        with trace.span(func.__name__, 'task',
+                        module=func.__module__,
+                        experiment=kw.get('name')):
+            return _call(*args, **kw)
+
+    def _call(*args, **kw):
         if args:
             environ = args[0]
         else:
@@ -60,25 +75,14 @@ def env_options(func):
             # uses {} instead of ${} for variables
             environ = _fix_environ(environ)
 
-            with hide('running', 'stdout', 'stderr', 'warnings'):
-                if exists(fmt('{expfiles}', environ)):
-                    with cd(fmt('{expfiles}', environ)):
-                        run('hg pull')
-                        run('hg update -C')
-                    #run(fmt('rm -rf {expfiles}', environ))
-                else:
-                    run(fmt('hg clone {exp_repo} {expfiles}', environ))
-
-                temp_exp = StringIO()
-                get(fmt('{expfiles}/exp/{name}/namelist.yaml', environ),
-                    temp_exp)
+            text, text_digest = _fetch_configuration(environ)
 
             kw['expfiles'] = environ['expfiles']
-            environ = load_configuration(temp_exp.getvalue(), kw, missing_fmt)
+            environ = load_configuration(text, kw, missing_fmt,
+                                         digest=text_digest)
             kw.pop('expfiles', None)
             kw.pop('name', None)
             kw.pop('exp_repo', None)
-            temp_exp.close()
             environ = _fix_environ(environ)
 
         return func(environ, **kw)
@@ -86,8 +90,62 @@ def env_options(func):
     return functools.update_wrapper(_wrapped_env, func)
 
 
+def _fetch_configuration(environ):
+    '''Return the experiment namelist.yaml contents and its digest.
+
+    A local ConfigCache is consulted first. If the cached entry is older
+    than its TTL a single remote call compares the experiments repository
+    revision (and the revision of the checkout in {expfiles}) with the
+    cached one, and only on a mismatch the checkout is updated and the file
+    downloaded again.
+    '''
+    cache = ConfigCache()
+    key = '|'.join((str(hosts.home()), environ['exp_repo'],
+                    environ['name']))
+    entry = cache.lookup(key)
+    if entry and cache.fresh(entry):
+        text = cache.load_text(entry['digest'])
+        if text is not None:
+            return text, entry['digest']
+
+    with hide('running', 'stdout', 'stderr', 'warnings'):
+        with settings(warn_only=True):
+            probe = run(fmt('hg id -i {exp_repo} && '
+                            'hg -R {expfiles} id -i', environ))
+        revision = None
+        if probe.succeeded:
+            # last two words: anything before comes from login scripts
+            revs = probe.split()[-2:]
+            if len(revs) == 2 and revs[0] == revs[1]:
+                revision = revs[0]
+
+        if entry and revision and entry['revision'] == revision:
+            text = cache.load_text(entry['digest'])
+            if text is not None:
+                cache.touch(key)
+                return text, entry['digest']
+
+        if exists(fmt('{expfiles}', environ)):
+            with cd(fmt('{expfiles}', environ)):
+                run('hg pull')
+                run('hg update -C')
+            #run(fmt('rm -rf {expfiles}', environ))
+        else:
+            run(fmt('hg clone {exp_repo} {expfiles}', environ))
+        if revision is None:
+            revision = run(fmt('hg -R {expfiles} id -i', environ)).split()[-1]
+
+        temp_exp = StringIO()
+        get(fmt('{expfiles}/exp/{name}/namelist.yaml', environ), temp_exp)
+        text = temp_exp.getvalue()
+        temp_exp.close()
+
+    return text, cache.store(key, revision, text)
+
+
 class EnvVarFormatter(string.Formatter):
-    env_vars = {}
+    '''Formatter falling back to the remote shell environment for missing
+    keys (see remote_env).'''
 
     def get_value(self, key, args, kwargs):
         try:
@@ -95,19 +153,79 @@ class EnvVarFormatter(string.Formatter):
                 return args[key]
             else:
                 return kwargs[key]
-        except:
-            if not self.env_vars:
-                with hide('running', 'stdout', 'stderr', 'warnings'):
-                    env_output = run('env')
-                    for line in env_output.split('\n'):
-                        try:
-                            k, v = line.split('=')
-                        except:
-                            pass
-                        else:
-                            self.env_vars[k] = v.rstrip()
+        except (KeyError, IndexError):
+            env_vars = remote_env()
+            if key not in env_vars and not _remote_envs_refreshed.get(
+                    _env_host(), False):
+                # The snapshot might predate a change in the remote login
+                # scripts, so give it one chance to catch up.
+                env_vars = remote_env(refresh=True)
+            return env_vars[key]
+
 
-            return self.env_vars[key]
+ENV_LINE = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*|BASH_FUNC_[^=]*)=(.*)$')
+
+_remote_envs = {}
+_remote_envs_refreshed = {}
+
+
+def parse_env_output(output):
+    '''Parse the output of env into a dict.
+
+    Values are split at the first '=' only, and lines not starting a new
+    variable are continuation lines of a multi-line value.
+    '''
+    env_vars = {}
+    key = None
+    for line in output.splitlines():
+        line = line.rstrip('\r')
+        match = ENV_LINE.match(line)
+        if match:
+            key, value = match.groups()
+            env_vars[key] = value
+        elif key is not None:
+            env_vars[key] += '\n' + line
+    return env_vars
+
+
+def _env_host():
+    return '%s@%s' % (env.user, env.host or env.host_string)
+
+
+def remote_env(refresh=False):
+    '''Shell environment of the remote user on the current host.
+
+    Read from the EnvSnapshot persisted in the local cache, so only the
+    first call ever (or the first after invalidate_remote_env) costs a
+    remote env call.
+    '''
+    host = _env_host()
+    if refresh:
+        invalidate_remote_env()
+    if host not in _remote_envs:
+        snapshot = EnvSnapshot(host)
+        env_vars = snapshot.load()
+        if env_vars is None:
+            with hide('running', 'stdout', 'stderr', 'warnings'):
+                env_vars = parse_env_output(run('env'))
+            snapshot.save(env_vars)
+            _remote_envs_refreshed[host] = True
+        _remote_envs[host] = env_vars
+    return _remote_envs[host]
+
+
+def invalidate_remote_env():
+    '''Drop the remote shell environment snapshot for the current host'''
+    host = _env_host()
+    _remote_envs.pop(host, None)
+    EnvSnapshot(host).invalidate()
+
+
+def expansion_key():
+    '''Identifies what ${VAR}s in a configuration expand to: the remote
+    user and host, and the snapshot of its shell environment.'''
+    host = _env_host()
+    return '%s|%s' % (host, EnvSnapshot(host).digest())
 
 
 def _fix_environ(environ):
@@ -122,9 +240,29 @@ def _fix_environ(environ):
     return environ
 
 
-def load_configuration(yaml_string, kw=None, missing_fmt=None):
-    environ = rec_env.load_configuration(yaml_string, kw, missing_fmt)
+def load_configuration(yaml_string, kw=None, missing_fmt=None, digest=None):
+    '''Load and expand a YAML configuration.
+
+    If digest (the SHA1 of yaml_string) is given the expanded configuration
+    is read from and stored in the local ConfigCache, keyed also by the
+    remote environment it was expanded in (see expansion_key).
+
+    Each member of an 'ensemble' block is expanded on its own (so paths
+    built from {name} are per member) and stored in
+    environ['ensemble_members'], keyed by member name.
+    '''
+    environ = None
+    if digest:
+        cache = ConfigCache()
+        environ = cache.load_expanded(digest, kw, expansion_key())
+    if environ is None:
+        environ = _expand_configuration(yaml_string, kw, missing_fmt)
+        if digest:
+            # expanding may have taken the first environment snapshot
+            cache.store_expanded(digest, kw, environ, expansion_key())
     environ = update_model_type(environ)
+    for member in environ.get('ensemble_members', {}).values():
+        update_model_type(member)
 
     #if environ.get('API', 0) != API_VERSION:
     #    print fc.red('Error: Configuration outdated')
@@ -133,35 +271,39 @@ def load_configuration(yaml_string, kw=None, missing_fmt=None):
     #    report_differences(environ, ref)
     #    raise APIVersionException
 
-    if 'ensemble' in environ:
-        environs = []
-        ensemble = environ['ensemble']
-        environ.pop('ensemble')
-        for member in ensemble.keys():
-            new_env = update_environ(environ, ensemble, member)
-            new_env = update_model_type(environ)
-            environs.append(new_env)
+    return environ
+
+
+def _expand_configuration(yaml_string, kw=None, missing_fmt=None):
+    raw = yaml.safe_load(yaml_string)
+    ensemble = raw.pop('ensemble', None)
+    environ = rec_env._expand_config_vars(deepcopy(raw), updates=kw,
+                                          missing_fmt=missing_fmt)
 
-        # TODO: ignoring for now, but need to think on how to run
-        # multiple environs (one for each ensemble member).
-        # Maybe use the Fabric JobQueue, which abstracts
-        # multiprocessing?
+    if ensemble:
+        # the member name must win over the name given in the command line
+        member_kw = dict((k, v) for k, v in (kw or {}).items()
+                         if k != 'name')
+        members = {}
+        for member in sorted(ensemble.keys()):
+            new_env = update_environ(raw, ensemble, member)
+            members[member] = rec_env._expand_config_vars(
+                new_env, updates=member_kw, missing_fmt=missing_fmt)
+        environ['ensemble_members'] = members
 
     return environ
 
 
+# Module implementing each model type
+MODEL_TYPES = {'coupled': 'bosun.coupled',
+               'mom4p1_falsecoupled': 'bosun.mom4',
+               'atmos': 'bosun.agcm'}
+
+
 def update_model_type(environ):
-    from bosun import agcm, mom4, coupled
-
-    mtype = environ.get('type', None)
-    if mtype == 'coupled':
-        environ['model'] = coupled
-    elif mtype == 'mom4p1_falsecoupled':
-        environ['model'] = mom4
-    elif mtype == 'atmos':
-        environ['model'] = agcm
-    else:
-        environ['model'] = None
+    ''' Set environ['model'], importing only the module for its type '''
+    module = MODEL_TYPES.get(environ.get('type', None), None)
+    environ['model'] = import_module(module) if module else None
 
     return environ
 
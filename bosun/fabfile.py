@@ -0,0 +1,7 @@
+# Every bosun task: the ones in the package (deploy, run, tasks.*, ...) and
+# the ones of each model (agcm.*, mom4.*, coupled.*). bin/bosun loads the
+# package alone when it has all the tasks asked for, so the models are only
+# imported when needed (see update_model_type).
+
+from bosun import *
+from bosun import tasks, agcm, mom4, coupled
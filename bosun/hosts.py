@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from contextlib import contextmanager
+import os
+import time
+
+from fabric.api import env, settings, hide
+import fabric.colors as fc
+
+from bosun.remote import run
+
+
+# Seconds a measured load is trusted before asking the host again
+LOAD_TTL = 60
+
+# Hosts measured by this process: host -> [time, load per CPU, CPUs]
+_loads = {}
+
+
+def pool(environ=None):
+    '''Hosts that independent work can be spread over.
+
+    Read from 'host_pool' in the experiment configuration or in
+    ~/.bosunrc (bin/bosun passes it on in BOSUN_HOST_POOL), as a list or a
+    comma separated string. Empty without a pool.
+    '''
+    hosts = (environ or {}).get('host_pool', None)
+    if not hosts:
+        hosts = os.environ.get('BOSUN_HOST_POOL', '')
+    if isinstance(hosts, basestring):
+        hosts = hosts.split(',')
+    return [host.strip() for host in hosts if host.strip()]
+
+
+def home():
+    '''The host bosun was started for.
+
+    Work that isn't explicitly balanced stays there (job submission and
+    monitoring, restart checks...), and local caches describing the remote
+    side are keyed by it, wherever the current operation runs.
+    '''
+    return env.get('bosun_home_host', None) or env.host_string
+
+
+def measure(hosts):
+    ''' Ask each host for its load average and number of CPUs '''
+    now = time.time()
+    for host in hosts:
+        with settings(hide('everything'), host_string=host,
+                      bosun_home_host=home(), warn_only=True,
+                      skip_bad_hosts=True):
+            try:
+                out = run('cat /proc/loadavg && nproc')
+            except (SystemExit, Exception):
+                out = None
+        try:
+            # anything before the last two lines comes from login scripts
+            loadavg, cpus = out.splitlines()[-2:]
+            cpus = max(1, int(cpus))
+            _loads[host] = [now, float(loadavg.split()[0]) / cpus, cpus]
+        except (AttributeError, ValueError, IndexError):
+            print(fc.red('Host %s unavailable, leaving it out' % host))
+            _loads[host] = [now, None, None]
+
+
+def least_loaded(hosts):
+    '''Host with the lowest load per CPU, measured at most every LOAD_TTL
+    seconds. Each pick counts as one more running process on the host, so
+    work started in a row is spread even before the loads catch up.'''
+    now = time.time()
+    measure([host for host in hosts
+             if host not in _loads or now - _loads[host][0] > LOAD_TTL])
+    available = [(_loads[host][1], i, host) for i, host in enumerate(hosts)
+                 if _loads[host][1] is not None]
+    if not available:
+        return home()
+    load, _, host = min(available)
+    _loads[host][1] += 1.0 / _loads[host][2]
+    return host
+
+
+def pick(environ=None):
+    ''' Host for a piece of independent work: the least loaded one in the
+        pool, or the current host without a pool. '''
+    hosts = pool(environ)
+    if not hosts:
+        return env.host_string
+    return least_loaded(hosts)
+
+
+@contextmanager
+def balanced(environ=None):
+    '''Run the block on the least loaded host of the pool.
+
+    Only for work that doesn't depend on which host runs it: every host in
+    the pool must see the same filesystems. Without a pool nothing changes.
+    '''
+    host = pick(environ)
+    if host == env.host_string:
+        yield host
+        return
+    print(fc.yellow('Running on %s' % host))
+    with settings(host_string=host, bosun_home_host=home()):
+        yield host
+
+
+def clear():
+    _loads.clear()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from collections import namedtuple
+from contextlib import contextmanager
+import os
+from os.path import expanduser, dirname, exists
+import sqlite3
+import time
+
+
+JOBS_DB = os.environ.get('BOSUN_JOBS_DB', expanduser('~/.bosun/jobs.db'))
+
+# One job submitted by bosun. Times are seconds since the epoch, walltime
+# (requested) and elapsed (last seen in qstat) are seconds, start and
+# finish are the dates of the segment the job runs and days its length in
+# simulated days. config identifies the model configuration, for model
+# jobs (see bosun.throughput), and verified is 1 once the segment a model
+# job ran was checked by verify_run.
+JobRecord = namedtuple('JobRecord', [
+    'host', 'job_id', 'experiment', 'component', 'start', 'finish', 'state',
+    'submitted', 'started', 'finished', 'walltime', 'elapsed', 'npes',
+    'config', 'days', 'verified'])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    host TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    experiment TEXT,
+    component TEXT,
+    start TEXT,
+    finish TEXT,
+    state TEXT,
+    submitted REAL,
+    started REAL,
+    finished REAL,
+    walltime INTEGER,
+    elapsed INTEGER,
+    npes INTEGER,
+    config TEXT,
+    days REAL,
+    verified INTEGER,
+    PRIMARY KEY (host, job_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_experiment ON jobs (experiment, submitted);
+CREATE TABLE IF NOT EXISTS transitions (
+    host TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    state TEXT,
+    time REAL
+);
+CREATE INDEX IF NOT EXISTS transitions_job ON transitions (host, job_id);
+'''
+
+# Columns added after the first version of the store: name, type
+NEW_COLUMNS = (('config', 'TEXT'), ('days', 'REAL'), ('verified', 'INTEGER'))
+
+# States of jobs that are still in the queue, as far as the store knows
+ACTIVE_STATES = ('Q', 'H', 'W', 'S', 'T', 'M', 'R', 'B', 'E')
+
+
+def seconds(value):
+    ''' Seconds in a PBS time ([[HH:]MM:]SS, or a number of seconds, as
+        YAML reads unquoted HH:MM:SS). None if unknown ('--'). '''
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+    try:
+        total = 0
+        for part in str(value).split(':'):
+            total = total * 60 + int(part)
+    except ValueError:
+        return None
+    if str(value).count(':') == 1:
+        # qstat -a shows HH:MM
+        total *= 60
+    return total
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+class JobStore(object):
+    '''Local SQLite history of the jobs bosun submits.
+
+    Jobs are keyed by (host, job ID). Every state change seen by the job
+    monitor is recorded in transitions with its time, and the job row
+    keeps the current state, when it started and finished running and the
+    elapsed time last reported by qstat. Each operation opens its own
+    connection, so concurrent bosun processes (ensemble members, deploy
+    steps) can share the store.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or JOBS_DB
+        if not exists(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            columns = [row[1] for row in db.execute('PRAGMA table_info(jobs)')]
+            for name, kind in NEW_COLUMNS:
+                if name not in columns:
+                    db.execute('ALTER TABLE jobs ADD COLUMN %s %s'
+                               % (name, kind))
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_config '
+                       'ON jobs (config, submitted)')
+
+    @contextmanager
+    def _connect(self):
+        ''' Connection committed at the end of the block (rolled back on
+            errors) and closed '''
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def submitted(self, host, job_id, experiment, component, start=None,
+                  finish=None, walltime=None, npes=None, config=None,
+                  days=None, when=None):
+        ''' Job was submitted. Known jobs are left alone. '''
+        when = when or time.time()
+        with self._connect() as db:
+            cursor = db.execute(
+                'INSERT OR IGNORE INTO jobs (host, job_id, experiment, '
+                'component, start, finish, state, submitted, walltime, npes, '
+                'config, days) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (host, job_id, experiment, component, _str(start),
+                 _str(finish), 'Q', when, seconds(walltime), _int(npes),
+                 config, days))
+            if cursor.rowcount:
+                db.execute('INSERT INTO transitions VALUES (?, ?, ?, ?)',
+                           (host, job_id, 'Q', when))
+
+    def transition(self, host, job_id, state, status=None, when=None,
+                   experiment=None):
+        '''Job changed to state ('F' once it left the queue). status is
+        the qstat status, if there is one. Jobs the store doesn't know
+        (not submitted through bosun) are added, as submitted when first
+        seen.'''
+        when = when or time.time()
+        status = status or {}
+        with self._connect() as db:
+            db.execute('INSERT OR IGNORE INTO jobs (host, job_id, '
+                       'experiment, submitted, walltime, npes) '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       (host, job_id, experiment, when,
+                        seconds(status.get('Req_Time')),
+                        _int(status.get('TSK'))))
+            changed = db.execute(
+                'UPDATE jobs SET state = ? WHERE host = ? AND job_id = ? '
+                'AND state IS NOT ?', (state, host, job_id, state)).rowcount
+            if changed:
+                db.execute('INSERT INTO transitions VALUES (?, ?, ?, ?)',
+                           (host, job_id, state, when))
+            if state == 'R':
+                self._started(db, host, job_id, when, status)
+            elif state == 'F':
+                db.execute('UPDATE jobs SET finished = ? WHERE host = ? AND '
+                           'job_id = ?', (when, host, job_id))
+            self._elapsed(db, host, job_id, status)
+
+    def verified(self, host, job_id):
+        ''' The segment of the job ran to its end '''
+        with self._connect() as db:
+            db.execute('UPDATE jobs SET verified = 1 WHERE host = ? AND '
+                       'job_id = ?', (host, job_id))
+
+    def progress(self, host, job_id, status, when=None):
+        ''' Keep the elapsed time of a running job '''
+        with self._connect() as db:
+            self._started(db, host, job_id, when or time.time(), status)
+            self._elapsed(db, host, job_id, status)
+
+    def _started(self, db, host, job_id, when, status):
+        '''Job is running at when. A job first seen after it started (the
+        monitor only watches the segment it waits for) is backdated by
+        the elapsed time qstat reports.'''
+        elapsed = seconds(status.get('Time')) or 0
+        db.execute('UPDATE jobs SET started = ? WHERE host = ? AND '
+                   'job_id = ? AND started IS NULL',
+                   (when - elapsed, host, job_id))
+
+    def _elapsed(self, db, host, job_id, status):
+        elapsed = seconds(status.get('Time'))
+        if elapsed is not None:
+            db.execute('UPDATE jobs SET elapsed = ? WHERE host = ? AND '
+                       'job_id = ?', (elapsed, host, job_id))
+
+    def job(self, host, job_id):
+        ''' JobRecord of a job, None if unknown '''
+        with self._connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE host = ? AND '
+                             'job_id = ?', (host, job_id)).fetchone()
+        return row and JobRecord(*[row[f] for f in JobRecord._fields])
+
+    def jobs(self, experiment=None, host=None, active=False, limit=None,
+             **columns):
+        '''JobRecords, most recently submitted last. Other keyword
+        arguments select jobs by column value (state='F', ...).'''
+        query = 'SELECT * FROM jobs WHERE 1'
+        args = []
+        if experiment:
+            query += ' AND experiment = ?'
+            args.append(experiment)
+        if host:
+            query += ' AND host = ?'
+            args.append(host)
+        for column, value in sorted(columns.items()):
+            if column not in JobRecord._fields:
+                raise ValueError('Unknown job column: %s' % column)
+            query += ' AND %s = ?' % column
+            args.append(value)
+        if active:
+            query += ' AND state IN (%s)' % ','.join('?' * len(ACTIVE_STATES))
+            args.extend(ACTIVE_STATES)
+        query += ' ORDER BY submitted DESC, rowid DESC'
+        if limit:
+            query += ' LIMIT %d' % int(limit)
+        with self._connect() as db:
+            rows = db.execute(query, args).fetchall()
+        return [JobRecord(*[row[f] for f in JobRecord._fields])
+                for row in reversed(rows)]
+
+    def transitions(self, host, job_id):
+        ''' [(state, time)] of a job, in order '''
+        with self._connect() as db:
+            return [tuple(row) for row in db.execute(
+                'SELECT state, time FROM transitions WHERE host = ? AND '
+                'job_id = ? ORDER BY time, rowid', (host, job_id))]
+
+
+def format_duration(secs):
+    if secs is None:
+        return '--'
+    return '%02d:%02d' % (secs // 3600, secs % 3600 // 60)
+
+
+def format_time(when):
+    if not when:
+        return '--'
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(when))
+
+
+def print_history(records):
+    print('%-16s %-10s %-10s %-10s %1s %-16s %-16s %8s %8s %5s'
+          % ('Job ID', 'Component', 'Start', 'Finish', 'S', 'Submitted',
+             'Started', 'Walltime', 'Elapsed', 'NPES'))
+    for r in records:
+        print('%-16s %-10s %-10s %-10s %1s %-16s %-16s %8s %8s %5s'
+              % (r.job_id, r.component or '--', r.start or '--',
+                 r.finish or '--', r.state or '-', format_time(r.submitted),
+                 format_time(r.started), format_duration(r.walltime),
+                 format_duration(r.elapsed), r.npes or '--'))
@@ -1,18 +1,28 @@
 #!/usr/bin/env python
 
 import sys
-from StringIO import StringIO
 import re
 from datetime import datetime
 
-from fabric.api import run, cd, get, put, prefix, settings, hide
-from fabric.contrib.files import exists
+from fabric.api import cd, prefix, settings
 from fabric.decorators import task
 import fabric.colors as fc
-from mom_utils import layout, nml_decode, yaml2nml
+from mom_utils import layout
 
+from bosun import namelist
+from bosun.build import Fingerprint, parallel_make
 from bosun.environ import env_options, fmt, shell_env
-from bosun.utils import print_ETA, JOB_STATES, hsm_full_path, clear_output
+from bosun.progress import tracker, LogProgress
+from bosun.remote import batch, run, exists
+from bosun.staging import stage_workdir, copy_files_script
+from bosun.storage import (Archive, compression, extract_command,
+                           probe_extract_command, tarball_name)
+from bosun.utils import print_ETA, JOB_STATES, hsm_full_path, restart_index
+
+
+# Model date in the progress lines of fms.out
+FMS_DATE = ('(\d{4})/(\s*\d{1,2})/(\s*\d{1,2})\s(\s*'
+            '\d{1,2}):(\s*\d{1,2}):(\s*\d{1,2})')
 
 
 @task
@@ -27,14 +37,21 @@ def prepare(environ, **kwargs):
 def prepare_workdir(environ, **kwargs):
     '''Prepare output dir
 
+    The workdir is populated from a snapshot of the template, with hard
+    links by default (see staging.stage_workdir).
+
     Used vars:
       workdir
       workdir_template
+      workdir_staging
+      template_store
+      workdir_writable
     '''
     print(fc.yellow('Preparing workdir'))
-    run(fmt('mkdir -p {workdir}', environ))
-    run(fmt('rsync -rtL --progress {workdir_template}/* {workdir}', environ))
-    run(fmt('touch {workdir}/time_stamp.restart', environ))
+    with batch() as b:
+        b.run(stage_workdir(environ))
+        b.run(fmt('touch {workdir}/time_stamp.restart', environ))
+    restart_index(environ).forget_workdir(environ['workdir'])
     # TODO: lots of things.
     #  1) generate atmos inputs (gdas_to_atmos from oper scripts)
     #  2) copy restart files from somewhere (emanuel's spinup, for example)
@@ -43,21 +60,22 @@ def prepare_workdir(environ, **kwargs):
 @task
 @env_options
 def prepare_expdir(environ, **kwargs):
-    run(fmt('mkdir -p {comb_exe}', environ))
-    if environ.get('gengrid_run_this_module', False):
-        run(fmt('mkdir -p {execdir}/gengrid', environ))
-        run(fmt('mkdir -p {gengrid_workdir}', environ))
-    if environ.get('make_xgrids_run_this_module', False):
-        run(fmt('mkdir -p {execdir}/make_xgrids', environ))
-        run(fmt('mkdir -p {make_xgrids_workdir}', environ))
-    if environ.get('regrid_3d_run_this_module', False):
-        run(fmt('mkdir -p {execdir}/regrid_3d', environ))
-        run(fmt('mkdir -p {regrid_3d_workdir}', environ))
-    if environ.get('regrid_2d_run_this_module', False):
-        run(fmt('mkdir -p {execdir}/regrid_2d', environ))
-        run(fmt('mkdir -p {regrid_2d_workdir}', environ))
-    # Need to check if input.nml->ocean_drifters_nml->use_this_module is True
-    run(fmt('mkdir -p {workdir}/DRIFTERS', environ))
+    with batch() as b:
+        b.run(fmt('mkdir -p {comb_exe}', environ))
+        if environ.get('gengrid_run_this_module', False):
+            b.run(fmt('mkdir -p {execdir}/gengrid', environ))
+            b.run(fmt('mkdir -p {gengrid_workdir}', environ))
+        if environ.get('make_xgrids_run_this_module', False):
+            b.run(fmt('mkdir -p {execdir}/make_xgrids', environ))
+            b.run(fmt('mkdir -p {make_xgrids_workdir}', environ))
+        if environ.get('regrid_3d_run_this_module', False):
+            b.run(fmt('mkdir -p {execdir}/regrid_3d', environ))
+            b.run(fmt('mkdir -p {regrid_3d_workdir}', environ))
+        if environ.get('regrid_2d_run_this_module', False):
+            b.run(fmt('mkdir -p {execdir}/regrid_2d', environ))
+            b.run(fmt('mkdir -p {regrid_2d_workdir}', environ))
+        # Need to check if input.nml->ocean_drifters_nml->use_this_module is True
+        b.run(fmt('mkdir -p {workdir}/DRIFTERS', environ))
 
 
 @task
@@ -78,112 +96,127 @@ def prepare_namelist(environ, **kwargs):
     Depends on:
       None
     '''
-    input_file = StringIO()
-    get(fmt('{ocean_namelist[file]}', environ), input_file)
-    data = nml_decode(input_file.getvalue())
-    input_file.close()
-    output = StringIO()
-
-    try:
-        tkeys = set(
-            environ['ocean_namelist']['vars'].keys()) & set(data.keys())
-    except KeyError:
-        pass
-    else:
-        for k in tkeys:
-            keys = (set(environ['ocean_namelist']['vars'][k].keys())
-                    & set(data[k].keys()))
-            data[k].update([(ke, environ['ocean_namelist']['vars'][k][ke])
-                            for ke in keys])
-
-    if data['coupler_nml'].get('concurrent', False):
-        data['ocean_model_nml']['layout'] = ("%d,%d"
-                                             % layout(data['coupler_nml']['ocean_npes']))
-        data['ice_model_nml']['layout'] = ("0,0")
-    else:
-        data['ocean_model_nml']['layout'] = ("%d,%d"
-                                             % layout(int(environ['npes'])))
-        data['ice_model_nml']['layout'] = ("%d,%d"
-                                             % layout(int(environ['npes'])))
-
-    data['ocean_model_nml']['dt_ocean'] = environ['dt_ocean']
-    data['coupler_nml']['dt_atmos'] = environ['dt_atmos']
-    data['coupler_nml']['dt_cpld'] = environ['dt_cpld']
-
-    if 'days' in data['coupler_nml']:
-        data['coupler_nml'].pop('days')
-    if 'months' in data['coupler_nml']:
-        data['coupler_nml'].pop('months')
-
-    if ('days' in environ) & ('months' not in environ):
-        data['coupler_nml']['days'] = environ['days']
-    elif ('days' not in environ) & ('months' in environ):
-        data['coupler_nml']['months'] = environ['months']
-    else:
-        print "Error, one should use days or months, not both or none"
+    def update(data):
+        if data['coupler_nml'].get('concurrent', False):
+            data['ocean_model_nml']['layout'] = ("%d,%d"
+                                                 % layout(data['coupler_nml']['ocean_npes']))
+            data['ice_model_nml']['layout'] = ("0,0")
+        else:
+            data['ocean_model_nml']['layout'] = ("%d,%d"
+                                                 % layout(int(environ['npes'])))
+            data['ice_model_nml']['layout'] = ("%d,%d"
+                                                 % layout(int(environ['npes'])))
+
+        data['ocean_model_nml']['dt_ocean'] = environ['dt_ocean']
+        data['coupler_nml']['dt_atmos'] = environ['dt_atmos']
+        data['coupler_nml']['dt_cpld'] = environ['dt_cpld']
+
+        if 'days' in data['coupler_nml']:
+            data['coupler_nml'].pop('days')
+        if 'months' in data['coupler_nml']:
+            data['coupler_nml'].pop('months')
+
+        if ('days' in environ) & ('months' not in environ):
+            data['coupler_nml']['days'] = environ['days']
+        elif ('days' not in environ) & ('months' in environ):
+            data['coupler_nml']['months'] = environ['months']
+        else:
+            print "Error, one should use days or months, not both or none"
 
-    if environ['mode'] == 'warm':
-        start = datetime.strptime(str(environ['restart']), "%Y%m%d%H")
-    else:
-        start = datetime.strptime(str(environ['start']), "%Y%m%d%H")
-    data['coupler_nml']['current_date'] = start.strftime(
-        "%Y, %m, %d, %H, 0, 0")
+        if environ['mode'] == 'warm':
+            start = datetime.strptime(str(environ['restart']), "%Y%m%d%H")
+        else:
+            start = datetime.strptime(str(environ['start']), "%Y%m%d%H")
+        data['coupler_nml']['current_date'] = start.strftime(
+            "%Y, %m, %d, %H, 0, 0")
+
+    suffix = environ.get('namelist_suffix', '')
+    data = namelist.render(fmt('{ocean_namelist[file]}', environ),
+                           fmt('{workdir}/input.nml', environ) + suffix,
+                           update=update,
+                           variables=environ['ocean_namelist'].get('vars'))
 
     if 'ocean_drifters_nml' in data.keys():
         if data['ocean_drifters_nml']['use_this_module']:
             environ['run_drifters_pos'] = True
 
-    output.write(yaml2nml(data))
-
-    put(output, fmt('{workdir}/input.nml', environ))
-    output.close()
-
 
 @task
 @env_options
 def compile_model(environ, **kwargs):
     keys = ['comp', 'code_dir', 'root', 'type', 'mkmf_template', 'executable']
+    fp = Fingerprint(environ, fmt('{executable}.fingerprint', environ),
+                     inputs=[fmt('{ocean_makeconf}', environ),
+                             fmt('{envconf}', environ),
+                             fmt('{mkmf_template}', environ)],
+                     keys=keys, target=environ['executable'])
+    if fp.matches():
+        return
     with shell_env(environ, keys=keys):
         with prefix(fmt('source {envconf}', environ)):
-            with cd(fmt('{execdir}', environ)):
+            with cd(fmt('{execdir}', environ)), parallel_make(environ):
                 run(fmt('/usr/bin/tcsh {ocean_makeconf}', environ))
+    fp.save()
 
 
 @task
 @env_options
 def compile_post(environ, **kwargs):
+    fp = Fingerprint(environ, fmt('{comb_exe}/.bosun_fingerprint', environ),
+                     inputs=[fmt('{envconf}', environ),
+                             fmt('{comb_src}/Make_combine', environ)],
+                     keys=['root', 'platform'],
+                     target=fmt('{comb_exe}/drifters_combine', environ))
+    if fp.matches():
+        return
     with shell_env(environ, keys=['root', 'platform']):
         with prefix(fmt('source {envconf}', environ)):
-            with cd(environ['comb_exe']):
+            with cd(environ['comb_exe']), parallel_make(environ):
                 run(fmt('make -f {comb_src}/Make_combine', environ))
     run(fmt('cp {root}/MOM4p1/src/shared/drifters/drifters_combine {comb_exe}/', environ))
+    fp.save()
 
 
 @task
 @env_options
 def compile_pre(environ, **kwargs):
     with prefix(fmt('source {envconf}', environ)):
-        if environ.get('gengrid_run_this_module', False):
-            with shell_env(environ, keys=['root', 'platform', 'mkmf_template', 'executable_gengrid']):
-                with cd(fmt('{execdir}/gengrid', environ)):
-                    run(fmt('/usr/bin/tcsh {gengrid_makeconf}', environ))
-        if environ.get('regrid_3d_run_this_module', False):
-            with shell_env(environ, keys=['root', 'mkmf_template', 'executable_regrid_3d']):
-                with cd(fmt('{execdir}/regrid_3d', environ)):
-                    run(fmt('/usr/bin/tcsh {regrid_3d_makeconf}', environ))
-        if environ.get('regrid_2d_run_this_module', False):
-            with shell_env(environ, keys=['root', 'mkmf_template', 'executable_regrid_2d']):
-                with cd(fmt('{execdir}/regrid_2d', environ)):
-                    run(fmt('/usr/bin/tcsh {regrid_2d_makeconf}', environ))
+        for module, keys in (
+                ('gengrid', ['root', 'platform', 'mkmf_template', 'executable_gengrid']),
+                ('regrid_3d', ['root', 'mkmf_template', 'executable_regrid_3d']),
+                ('regrid_2d', ['root', 'mkmf_template', 'executable_regrid_2d'])):
+            if not environ.get('%s_run_this_module' % module, False):
+                continue
+            executable = environ['executable_%s' % module]
+            fp = Fingerprint(environ, '%s.fingerprint' % executable,
+                             inputs=[fmt('{%s_makeconf}' % module, environ),
+                                     fmt('{envconf}', environ),
+                                     fmt('{mkmf_template}', environ)],
+                             keys=keys, target=executable)
+            if fp.matches():
+                continue
+            with shell_env(environ, keys=keys):
+                with cd(fmt('{execdir}/%s' % module, environ)), \
+                        parallel_make(environ):
+                    run(fmt('/usr/bin/tcsh {%s_makeconf}' % module, environ))
+            fp.save()
     if environ.get('make_xgrids_run_this_module', False):
         with prefix(fmt('source {make_xgrids_envconf}', environ)):
             #run(fmt('cc -g -V -O -o {executable_make_xgrids} {make_xgrids_src} -I $NETCDF_DIR/include -L $NETCDF_DIR/lib -lnetcdf -lm -Duse_LARGEFILE -Duse_netCDF -DLARGE_FILE -Duse_libMPI', environ))
             fix_MAXLOCAL_make_xgrids(environ)
-            run(fmt('cc -g -V -O -o {executable_make_xgrids} {make_xgrids_src} -I $NETCDF_DIR/include -L $NETCDF_DIR/lib -lnetcdf -lm -Duse_LARGEFILE -Duse_netCDF -DLARGE_FILE', environ))
+            fp = Fingerprint(environ,
+                             fmt('{executable_make_xgrids}.fingerprint', environ),
+                             inputs=[fmt('{make_xgrids_src}', environ)],
+                             target=environ['executable_make_xgrids'])
+            if not fp.matches():
+                run(fmt('cc -g -V -O -o {executable_make_xgrids} {make_xgrids_src} -I $NETCDF_DIR/include -L $NETCDF_DIR/lib -lnetcdf -lm -Duse_LARGEFILE -Duse_netCDF -DLARGE_FILE', environ))
+                fp.save()
 
 
 def fix_MAXLOCAL_make_xgrids(environ):
-    run(fmt("sed -i.bak -r -e 's/^#define MAXLOCAL.*$/#define MAXLOCAL 1e8/g' {make_xgrids_src}", environ))
+    '''Only touch the source if needed, or make_xgrids is always rebuilt'''
+    run(fmt("grep -q '^#define MAXLOCAL 1e8$' {make_xgrids_src} || "
+            "sed -i.bak -r -e 's/^#define MAXLOCAL.*$/#define MAXLOCAL 1e8/g' {make_xgrids_src}", environ))
 
 
 @task
@@ -228,31 +261,17 @@ def regrid_2d(environ, **kwargs):
 @task
 @env_options
 def regrid_2d_prepare(environ, **kwargs):
-    input_file = StringIO()
-    get(fmt('{regrid_2d_namelist[file]}', environ), input_file)
-    data = nml_decode(input_file.getvalue())
-    input_file.close()
-    output = StringIO()
-
-    try:
-        tkeys = set(
-            environ['regrid_2d_namelist']['vars'].keys()) & set(data.keys())
-    except KeyError:
-        pass
-    else:
-        for k in tkeys:
-            keys = (set(environ['regrid_2d_namelist']['vars'][k].keys())
-                    & set(data[k].keys()))
-            data[k].update([(ke, environ['regrid_2d_namelist']['vars'][k][ke])
-                            for ke in keys])
+    src_files = []
 
-    src_file = data['regrid_2d_nml']['src_file']
-    run(fmt('cp %s {regrid_2d_workdir}/src_file.nc' % src_file, environ))
-    data['regrid_2d_nml']['src_file'] = 'src_file.nc'
-    output.write(yaml2nml(data))
+    def update(data):
+        src_files.append(data['regrid_2d_nml']['src_file'])
+        data['regrid_2d_nml']['src_file'] = 'src_file.nc'
 
-    put(output, fmt('{regrid_2d_workdir}/input.nml', environ))
-    output.close()
+    namelist.render(fmt('{regrid_2d_namelist[file]}', environ),
+                    fmt('{regrid_2d_workdir}/input.nml', environ),
+                    update=update,
+                    variables=environ['regrid_2d_namelist'].get('vars'))
+    run(fmt('cp %s {regrid_2d_workdir}/src_file.nc' % src_files[0], environ))
 
 
 @task
@@ -289,9 +308,26 @@ def get_coupler_dates(environ):
     return res_date, cmp_date
 
 
+def _restart_extracted(index, date, environ):
+    ''' The index says the restart is in the workdir, and it still is '''
+    return (index.extracted('ocean', date, environ['workdir']) and
+            exists(fmt('{workdir}/INPUT/coupler.res', environ)))
+
+
 @task
 @env_options
 def check_restart(environ, **kwargs):
+    index = restart_index(environ)
+    date = _restart_date(environ)
+    if _restart_extracted(index, date, environ):
+        print(fc.green('Ocean restart %s already in workdir' % date))
+        return
+
+    if _coupler_matches(environ):
+        index.mark_extracted('ocean', date, environ['workdir'])
+        return
+
+    index.mark_missing('ocean', date)
     prepare_restart(environ)
     if exists(fmt('{workdir}/INPUT/coupler.res', environ)):
         res_date, cmp_date = get_coupler_dates(environ)
@@ -299,11 +335,26 @@ def check_restart(environ, **kwargs):
         if res_date != cmp_date:
             print(fc.red('ERROR'))
             sys.exit(1)
+        index.mark_extracted('ocean', date, environ['workdir'])
     else:
         # TODO: check if it starts from zero (ocean forced)
         sys.exit(1)
 
 
+def _restart_date(environ):
+    if 'cold' in environ['mode']:
+        return str(environ['start'])
+    return str(environ['restart'])
+
+
+def _coupler_matches(environ):
+    with settings(warn_only=True):
+        if not exists(fmt('{workdir}/INPUT/coupler.res', environ)):
+            return False
+        res_date, cmp_date = get_coupler_dates(environ)
+    return res_date == cmp_date
+
+
 @task
 @env_options
 def run_model(environ, **kwargs):
@@ -363,7 +414,7 @@ def run_model(environ, **kwargs):
 
     keys = ['workdir', 'platform', 'walltime', 'datatable', 'diagtable',
             'fieldtable', 'executable', 'mppnccombine', 'comb_exe',
-            'account']
+            'account', 'JobID_depend', 'namelist_suffix']
     with shell_env(environ, keys=keys):
         with prefix(fmt('source {envconf}', environ)):
             with cd(fmt('{expdir}/runscripts', environ)):
@@ -414,80 +465,122 @@ def check_status(environ, status):
     if status['ID'] in environ.get('JobID_pos_ocean', ""):
         print(fc.yellow('Ocean post-processing: %s' % JOB_STATES[status['S']]))
     elif status['ID'] in environ.get('JobID_model', ""):
-        fmsfile = fmt("{workdir}/fms.out", environ)
         if status['S'] == 'R':
-            if not exists(fmsfile):
-                print(fc.yellow('Preparing!'))
+            current = tracker(status['ID'], LogProgress,
+                              fmt("{workdir}/fms.out", environ), 'yyyy',
+                              FMS_DATE).poll()
+            if current:
+                print_ETA(environ, status, current)
             else:
-                with hide('running', 'stdout'):
-                    line = run('tac %s | grep -m1 yyyy' % fmsfile).splitlines()[-1]
-                current = re.search('(\d{4})/(\s*\d{1,2})/(\s*\d{1,2})\s(\s*'
-                                    '\d{1,2}):(\s*\d{1,2}):(\s*\d{1,2})', line)
-                if current:
-                    current = datetime(*[int(i) for i in current.groups()])
-                    print_ETA(environ, status, current)
-                else:
-                    print(fc.yellow('Preparing!'))
+                print(fc.yellow('Preparing!'))
         else:
             print(fc.yellow('Model: %s' % JOB_STATES[status['S']]))
 
 
+# Files in the workdir archived after each segment, and the ones among
+# them kept uncompressed
+OUTPUTS = ['*fms.out', '*logfile.*.out', 'input.nml', 'set_g4c_model*out.txt',
+           '*_table', '*diag_integral.out', 'set_g4c_pos_m4g4*out.txt',
+           '*time_stamp.out']
+KEEP_OUTPUTS = ('data_table', 'diag_table', 'field_table', 'input.nml')
+
+
+def snapshot_script(environ, dest):
+    '''Shell lines checking that the segment ran and copying what
+    verify_run and archive read to dest, laid out as in the workdir.'''
+    return [_verify_command(environ),
+            fmt('mkdir -p %s/RESTART' % dest, environ),
+            fmt('cp -a {workdir}/RESTART/. %s/RESTART/' % dest, environ),
+            # only restarts in INPUT are rewritten, and they aren't archived
+            fmt('cp -al {workdir}/INPUT %s/' % dest, environ),
+            copy_files_script(fmt('{workdir}', environ), OUTPUTS, dest)]
+
+
 @task
 @env_options
 def archive(environ, **kwargs):
+    '''Archive outputs and restart files of the last segment
+
+    Used vars:
+      workdir
+      hsm
+      finish
+      archive_jobs
+      archive_compression
+      archive_chunk
+    '''
     full_path, cname = hsm_full_path(environ)
+    arch = Archive(full_path, jobs=environ.get('archive_jobs', 4),
+                   compression=compression(environ),
+                   chunk=environ.get('archive_chunk', 256))
 
-    run('mkdir -p %s/ocean/%s' % (full_path, cname))
+    arch.mkdir('%s/ocean/%s' % (full_path, cname))
     # TODO: copy OGCM output ({workdir}/dataout)
 
-    run('mkdir -p %s/output' % full_path)
-    with cd(fmt('{workdir}', environ)):
-        with settings(warn_only=True):
-            out = run(fmt('ls -1 *fms.out *logfile.*.out input.nml '
-                      'set_g4c_model*out.txt *_table *diag_integral.out '
-                      'set_g4c_pos_m4g4*out.txt *time_stamp.out 2> /dev/null', environ))
-        files = clear_output(out).splitlines()
-        for f in files:
-            if exists(f):
-                if f not in ('data_table', 'diag_table', 'field_table', 'input.nml'):
-                    run(fmt('gzip %s' % f, environ))
-                    f = f + '.gz'
-                run(fmt('mv %s %s/output/' % (f, full_path), environ))
-
-    run('mkdir -p %s/restart' % full_path)
-    with cd(fmt('{workdir}/RESTART', environ)):
-        # TODO: check date in coupler.res!
-        run(fmt('tar czvf {finish}.tar.gz coupler* ice* land* ocean*', environ))
-        run(fmt('mv {finish}.tar.gz %s/restart/' % full_path, environ))
-    with cd(fmt('{workdir}', environ)):
-        run(fmt('tar czvf INPUT.tar.gz INPUT/ --exclude="*.res*"', environ))
-        run(fmt('mv INPUT.tar.gz %s/restart/' % full_path, environ))
+    arch.outputs(fmt('{workdir}', environ), OUTPUTS, keep=KEEP_OUTPUTS)
+
+    # TODO: check date in coupler.res!
+    name = tarball_name(str(environ['finish']), environ)
+    arch.tarball(fmt('{workdir}/RESTART', environ), name,
+                 ['coupler*', 'ice*', 'land*', 'ocean*'])
+    arch.tarball(fmt('{workdir}', environ), tarball_name('INPUT', environ),
+                 ['INPUT/'], exclude=['*.res*'])
+    arch.run()
+
+    index = restart_index(environ)
+    index.record('ocean', environ['finish'],
+                 '%s/restart/%s' % (full_path, name),
+                 **arch.stored.get(name, {}))
+    # the model already replaced the restart this segment started from
+    index.mark_missing('ocean', _restart_date(environ))
 
 
 @task
 @env_options
 def prepare_restart(environ, **kwargs):
-    '''Prepare restart for new run'''
+    '''Prepare restart for new run
+
+    Nothing is extracted if the restart index says the restart is already
+    in the workdir and INPUT/coupler.res is there. Archives are
+    decompressed according to their suffix, whatever archive_compression
+    is now.
+    '''
 
     # TODO: check if it starts from zero (ocean forced)
 
-    if 'cold' in environ['mode']:
-        cmp_date = str(environ['start'])
+    cmp_date = _restart_date(environ)
+    index = restart_index(environ)
+    if _restart_extracted(index, cmp_date, environ):
+        return
+
+    entry = index.lookup('ocean', cmp_date)
+    if entry and entry['archive']:
+        command = extract_command(entry['archive'], environ)
     else:
-        cmp_date = str(environ['restart'])
+        # archived before the index: the compression isn't known
+        full_path, cname = hsm_full_path(environ)
+        command = probe_extract_command(
+            '%s/restart/%s' % (full_path, cmp_date), environ)
 
     with settings(warn_only=True):
         with cd(fmt('{workdir}/INPUT', environ)):
-            full_path, cname = hsm_full_path(environ)
-            run(fmt('tar xf %s/restart/%s.tar.gz' % (full_path, cmp_date), environ))
+            run(command)
 
 
 @task
 @env_options
 def verify_run(environ, **kwargs):
+    ''' Check that the segment ran to its end (aborts if not). Returns True,
+        the run was checked. '''
+    run(_verify_command(environ))
+    # TODO: need to check post processing!
+    return True
+
+
+def _verify_command(environ):
     if 'cold' in environ['mode']:
         cmp_date = str(environ['start'])
     else:
         cmp_date = str(environ['restart'])
-    run(fmt('grep "Total runtime" {workdir}/%s.fms.out' % cmp_date[:8], environ))
-    # TODO: need to check post processing!
+    return fmt('grep "Total runtime" {workdir}/%s.fms.out' % cmp_date[:8],
+               environ)
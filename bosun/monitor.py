@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import time
+
+from fabric.api import settings, hide
+
+from bosun.remote import run
+
+
+# (shortest, longest) polling interval in seconds for each PBS job state.
+# Queued and held jobs change slowly, running jobs are watched more closely
+# and exiting jobs are about to finish, so we want to know right away.
+POLL_INTERVALS = {
+    'Q': (30, 300),
+    'H': (60, 600),
+    'W': (60, 600),
+    'S': (60, 600),
+    'T': (10, 60),
+    'M': (10, 60),
+    'R': (15, 120),
+    'B': (15, 120),
+    'E': (2, 10),
+}
+DEFAULT_INTERVAL = (15, 120)
+
+# States meaning the job is not going to run anymore
+FINISHED_STATES = ('F', 'X')
+
+
+def parse_qstat(data):
+    ''' Parse qstat -a output into a dict of statuses keyed by job ID.
+
+    Each status is a dict keyed by the header columns, as in:
+      {'ID': '1234.sdb', 'Jobname': 'M_exp', 'S': 'R', 'Time': '01:02', ...}
+
+    Time is the elapsed time; the requested one (the other Time column)
+    is Req_Time.
+    '''
+    statuses = {}
+    header = None
+    for line in data.splitlines():
+        if header:
+            info = line.split()
+            if not info or info[0].startswith('---'):
+                continue
+            statuses[info[0]] = dict(zip(header, info))
+        elif line.startswith('Job ID'):
+            header = line.split()[1:]
+            for i, column in enumerate(header):
+                if column in header[i + 1:]:
+                    header[i] = 'Req_' + column
+    return statuses
+
+
+def query_jobs(job_ids):
+    ''' Retrieve PBS status for job_ids with a single qstat call.
+
+    With job_ids None every job known to the server is returned. qstat
+    exits with an error if any of the jobs is unknown (has already left
+    the queue), but still reports the others, so the output is parsed
+    regardless of the return code.
+    '''
+    if job_ids is not None and not job_ids:
+        return {}
+    with settings(warn_only=True):
+        with hide('running', 'stdout', 'stderr', 'warnings'):
+            data = run("qstat -a %s" % " ".join(job_ids or []))
+    return parse_qstat(data)
+
+
+def _same_job(job_id, status_id):
+    '''The job numbers must be the same. qstat truncates the server part
+    of IDs (sometimes marking it with '*'), and we sometimes keep them
+    without server, so servers only have to agree on what both show.'''
+    number, _, server = job_id.partition('.')
+    status_number, _, status_server = status_id.rstrip('*').partition('.')
+    if number != status_number:
+        return False
+    return (server.startswith(status_server) or
+            status_server.startswith(server))
+
+
+class JobMonitor(object):
+    '''Watch a set of PBS jobs until all of them leave the queue.
+
+    Each poll issues one qstat for every tracked job. The time until the
+    next poll depends on the state of the jobs (see POLL_INTERVALS): it
+    starts at the shortest interval of the most urgent state and doubles
+    while nothing changes, up to the longest one (or max_sleep).
+
+    Progress is reported through callbacks:
+      on_change(job_id, old_state, new_state, status)  state transitions,
+                                                       old_state None on
+                                                       the first sighting
+      on_progress(job_id, status)  every poll, for running jobs
+      on_finish(job_id, status)    job left the queue; status is the last
+                                   one seen (None if never seen)
+    '''
+
+    def __init__(self, job_ids, on_change=None, on_progress=None,
+                 on_finish=None, max_sleep=None, query=query_jobs):
+        self.job_ids = [j for j in job_ids if j]
+        self.on_change = on_change
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.max_sleep = max_sleep
+        self.query = query
+        self.last = {}
+        self.unchanged = 0
+
+    @property
+    def active(self):
+        return bool(self.job_ids)
+
+    def _match(self, statuses):
+        matched = {}
+        for job_id in self.job_ids:
+            for status_id, status in statuses.items():
+                if _same_job(job_id, status_id):
+                    matched[job_id] = status
+                    break
+        return matched
+
+    def poll(self):
+        ''' Query all tracked jobs once. Returns statuses of active jobs. '''
+        statuses = self._match(self.query(self.job_ids))
+        changed = False
+
+        for job_id in list(self.job_ids):
+            status = statuses.get(job_id, None)
+            old = self.last.get(job_id, None)
+            if status is None or status['S'] in FINISHED_STATES:
+                self.job_ids.remove(job_id)
+                statuses.pop(job_id, None)
+                changed = True
+                if self.on_finish:
+                    self.on_finish(job_id, status or old)
+                continue
+
+            old_state = old['S'] if old else None
+            if old_state != status['S']:
+                changed = True
+                if self.on_change:
+                    self.on_change(job_id, old_state, status['S'], status)
+            if status['S'] == 'R' and self.on_progress:
+                self.on_progress(job_id, status)
+            self.last[job_id] = status
+
+        self.unchanged = 0 if changed else self.unchanged + 1
+        return statuses
+
+    def next_interval(self):
+        ''' Seconds to wait before the next poll '''
+        states = [self.last[j]['S'] for j in self.job_ids if j in self.last]
+        intervals = [POLL_INTERVALS.get(s, DEFAULT_INTERVAL) for s in states]
+        shortest, longest = min(intervals or [DEFAULT_INTERVAL])
+        if self.max_sleep:
+            longest = min(longest, self.max_sleep)
+        return min(shortest * 2 ** self.unchanged, longest)
+
+    def wait(self, sleep=time.sleep):
+        ''' Poll until every tracked job is gone '''
+        self.poll()
+        while self.active:
+            sleep(self.next_interval())
+            self.poll()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from StringIO import StringIO
+from copy import deepcopy
+from os.path import join
+import hashlib
+import re
+import shutil
+import cPickle as pickle
+
+from fabric.api import settings, hide
+import fabric.colors as fc
+from mom_utils import nml_decode, yaml2nml
+
+from bosun.cache import cache_dir, _write
+from bosun.remote import run, get, put
+
+
+# Output line of md5sum reading stdin
+_MD5SUM = re.compile(r'^[0-9a-f]{32}\s+-$')
+
+# Parsed templates already loaded by this process, keyed by MD5
+_templates = {}
+
+
+def md5(text):
+    return hashlib.md5(text).hexdigest()
+
+
+def _remote_digests(*paths):
+    ''' MD5 of each remote file (of an empty file if it doesn't exist),
+        with a single remote call. '''
+    with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                  warn_only=True):
+        out = run("\n".join('cat %s 2>/dev/null | md5sum' % p
+                            for p in paths))
+    # login scripts may print to stdout: md5sum lines are the last ones
+    digests = [line.split()[0] for line in out.splitlines()
+               if _MD5SUM.match(line.strip())]
+    return digests[-len(paths):]
+
+
+def load_template(path, digest):
+    '''Parsed namelist template, cached locally by content.
+
+    The template is only downloaded when this content (digest) was never
+    seen before. Callers must not modify the returned data.
+    '''
+    if digest in _templates:
+        return _templates[digest]
+
+    try:
+        with open(join(cache_dir('namelists'), '%s.pickle' % digest),
+                  'rb') as f:
+            data = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        input_file = StringIO()
+        get(path, input_file)
+        text = input_file.getvalue()
+        input_file.close()
+        data = nml_decode(text)
+        # the template may have changed since we computed digest
+        digest = md5(text)
+        _write(join(cache_dir('namelists'), '%s.pickle' % digest),
+               pickle.dumps(data, pickle.HIGHEST_PROTOCOL), 'wb')
+    _templates[digest] = data
+    return data
+
+
+def merge_vars(data, variables):
+    ''' Update namelist groups with the values from the experiment config.
+        Only variables already present in the template are used. '''
+    for k in set(variables.keys()) & set(data.keys()):
+        keys = set(variables[k].keys()) & set(data[k].keys())
+        data[k].update([(ke, variables[k][ke]) for ke in keys])
+
+
+def render(template, dest, update=None, variables=None, key_order=None,
+           trailer=''):
+    '''Write a namelist to dest based on a remote template.
+
+    The template is parsed once and cached (see load_template); each call
+    works on a copy of it, merged with variables (the 'vars' entry of a
+    namelist config) and then passed to update(data) for the changes that
+    depend on the segment being run. The result is uploaded only when it
+    differs from what is already in dest, so checking costs one remote
+    call. Returns the data written.
+    '''
+    template_digest, dest_digest = _remote_digests(template, dest)
+    data = deepcopy(load_template(template, template_digest))
+    merge_vars(data, variables or {})
+    if update is not None:
+        update(data)
+
+    text = yaml2nml(data, key_order=key_order) + trailer
+    if md5(text) == dest_digest:
+        print(fc.green('Namelist up to date: %s' % dest))
+    else:
+        put(StringIO(text), dest)
+    return data
+
+
+def clear():
+    ''' Forget every parsed template '''
+    _templates.clear()
+    shutil.rmtree(cache_dir('namelists'), ignore_errors=True)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import re
+from datetime import datetime
+
+from fabric.api import env, settings, hide
+
+from bosun.remote import run
+
+
+SEPARATOR = '@@bosun:progress:'
+
+# Trackers for the jobs being watched, keyed by (host, job ID, path)
+_trackers = {}
+
+
+class LogProgress(object):
+    '''Model date from the last matching line of a growing log file.
+
+    The first poll scans the file backwards from its end (tac), later polls
+    only read what was appended since the previous one, starting from the
+    stored offset. If the file shrinks (a new segment started writing it)
+    it is scanned from the end again.
+    '''
+
+    def __init__(self, path, pattern, regex):
+        self.path = path
+        self.pattern = pattern
+        self.regex = re.compile(regex)
+        self.offset = 0
+        self.current = None
+
+    def script(self):
+        return "\n".join([
+            'f=%s; off=%d' % (self.path, self.offset),
+            '[ -e $f ] || exit 0',
+            'size=$(stat -c %s $f)',
+            'echo "%s$size"' % SEPARATOR,
+            'if [ $off -gt 0 ] && [ $off -le $size ]; then',
+            "  tail -c +$((off + 1)) $f | head -c $((size - off)) |"
+            " grep '%s' | tail -n 1" % self.pattern,
+            'else',
+            "  tac $f | grep -m1 '%s'" % self.pattern,
+            'fi'])
+
+    def update(self, out):
+        if SEPARATOR not in out:
+            # file doesn't exist (yet)
+            self.offset = 0
+            return self.current
+        size, _, lines = out.split(SEPARATOR, 1)[1].partition('\n')
+        size = int(size.strip())
+        if size < self.offset:
+            self.current = None
+        self.offset = size
+        date = self.regex.search(lines)
+        if date:
+            self.current = datetime(*[int(i) for i in date.groups()])
+        return self.current
+
+    def poll(self):
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                      warn_only=True):
+            return self.update(run(self.script()))
+
+
+class ForecastProgress(object):
+    '''Latest model date from the names of files written to a directory.
+
+    The latest date found is kept in a stamp file on the remote side, and
+    only files newer than the stamp are listed on each poll, so neither
+    the listing nor its transfer grows with the number of files. The first
+    poll removes the stamp left by a previous job.
+    '''
+
+    def __init__(self, directory, pattern, stamp):
+        self.directory = directory
+        self.pattern = pattern
+        self.stamp = stamp
+        self.current = None
+        self.polled = False
+
+    def script(self):
+        find = 'find %s -iname "%s"' % (self.directory, self.pattern)
+        return "\n".join([
+            's=%s' % self.stamp,
+            'rm -f $s' if not self.polled else ':',
+            'touch $s.t',
+            'latest=$({ cat $s 2>/dev/null',
+            '  if [ -e $s ]; then %s -newer $s; else %s; fi |' % (find, find),
+            "  sed -n 's/.*\\([0-9]\\{10\\}\\)F.*/\\1/p'; } | sort |"
+            " tail -n 1)",
+            'echo $latest > $s && touch -r $s.t $s',
+            'rm -f $s.t',
+            'echo "%s$latest"' % SEPARATOR])
+
+    def update(self, out):
+        self.polled = True
+        if SEPARATOR in out:
+            date = out.split(SEPARATOR, 1)[1].strip()
+            if date:
+                self.current = datetime.strptime(date, "%Y%m%d%H")
+        return self.current
+
+    def poll(self):
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                      warn_only=True):
+            return self.update(run(self.script()))
+
+
+def tracker(job_id, cls, *args):
+    ''' Tracker for a job, kept between polls '''
+    key = (env.host_string, job_id) + args
+    if key not in _trackers:
+        _trackers[key] = cls(*args)
+    return _trackers[key]
+
+
+def release(job_id):
+    ''' Forget the trackers of a job that left the queue '''
+    for key in [k for k in _trackers if k[:2] == (env.host_string, job_id)]:
+        del _trackers[key]
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+from __future__ import with_statement
+from __future__ import print_function
+from contextlib import contextmanager
+from os.path import expanduser
+import shutil
+import subprocess
+import time
+from uuid import uuid4
+
+import fabric.api as fapi
+from fabric.api import env, settings, hide
+from fabric.contrib import files
+from fabric.operations import (_prefix_commands, _prefix_env_vars,
+                               _shell_wrap, _AttributeString)
+from fabric.state import output, connections
+from fabric.utils import error
+
+from bosun import trace
+
+
+MARKER = '@@bosun'
+
+# Seconds between SSH keepalive packets, so the shared connection survives
+# long waits on the queue (--keepalive on the command line overrides it).
+KEEPALIVE = 30
+
+
+def connection():
+    '''Shared SSH connection to the current host.
+
+    Fabric keeps one client per host string, but never notices if its
+    transport died (after a long wait for a job, for example). This makes
+    sure the cached connection is alive, with keepalive enabled, and
+    reconnects otherwise. run, get, put and exists from this module go
+    through it, so every task and nested task call share one connection.
+    '''
+    client = connections[env.host_string]
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        connections.connect(env.host_string)
+        client = connections[env.host_string]
+        transport = client.get_transport()
+    if not getattr(transport, '_bosun_keepalive', False):
+        transport.set_keepalive(env.keepalive or KEEPALIVE)
+        transport._bosun_keepalive = True
+    return client
+
+
+# Remote calls made by this process, see account and reset_stats
+STATS = {'calls': {}, 'bytes_sent': 0, 'bytes_received': 0}
+
+
+def reset_stats():
+    STATS['calls'] = {}
+    STATS['bytes_sent'] = STATS['bytes_received'] = 0
+
+
+def merge_stats(stats):
+    ''' Add up the STATS of another process (see dag) '''
+    for op, calls in stats['calls'].items():
+        STATS['calls'][op] = STATS['calls'].get(op, 0) + calls
+    STATS['bytes_sent'] += stats['bytes_sent']
+    STATS['bytes_received'] += stats['bytes_received']
+
+
+def account(op, sent=0, received=0):
+    ''' Count one remote operation and the bytes it moved '''
+    STATS['calls'][op] = STATS['calls'].get(op, 0) + 1
+    STATS['bytes_sent'] += sent
+    STATS['bytes_received'] += received
+    trace.annotate(bytes_sent=sent, bytes_received=received)
+
+
+def _local():
+    '''True when tasks run against this machine instead of an SSH host.
+
+    Set env.bosun_backend to 'local' (fab --set bosun_backend=local) to use
+    it; env.bosun_latency adds that many seconds to every call, to stand
+    in for a real connection. The benchmarks are built on it.
+    '''
+    if env.get('bosun_backend', 'ssh') != 'local':
+        return False
+    latency = float(env.get('bosun_latency', 0) or 0)
+    if latency:
+        time.sleep(latency)
+    return True
+
+
+def _size(obj):
+    ''' Bytes in a local path or file-like object '''
+    if hasattr(obj, 'getvalue'):
+        return len(obj.getvalue())
+    try:
+        with open(expanduser(obj), 'rb') as f:
+            f.seek(0, 2)
+            return f.tell()
+    except (IOError, TypeError):
+        return 0
+
+
+def _local_run(command, shell=True, warn_only=False, **kwargs):
+    real_command = _prefix_env_vars(_prefix_commands(command, 'remote'))
+    if shell:
+        real_command = _shell_wrap(real_command,
+                                   env.get('shell_escape', True))
+    if output.running:
+        print("[%s] run: %s" % (env.host_string, command))
+    proc = subprocess.Popen(real_command, shell=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    out = _AttributeString(proc.communicate()[0].replace('\r\n', '\n')
+                           .strip())
+    out.command = command
+    out.real_command = real_command
+    out.return_code = proc.returncode
+    out.succeeded = proc.returncode == 0
+    out.failed = not out.succeeded
+    if output.stdout:
+        for line in out.splitlines():
+            print("[%s] out: %s" % (env.host_string, line))
+    if out.failed and not (warn_only or env.warn_only):
+        error("run() received nonzero return code %d while executing '%s'"
+              % (proc.returncode, command), stdout=out)
+    return out
+
+
+def _local_get(remote_path, local_path=None, **kwargs):
+    with open(expanduser(remote_path), 'rb') as f:
+        data = f.read()
+    if hasattr(local_path, 'write'):
+        local_path.write(data)
+        return [remote_path]
+    with open(local_path, 'wb') as f:
+        f.write(data)
+    return [local_path]
+
+
+def _local_put(local_path=None, remote_path=None, **kwargs):
+    if hasattr(local_path, 'getvalue'):
+        with open(expanduser(remote_path), 'wb') as f:
+            f.write(local_path.getvalue())
+    else:
+        shutil.copy(expanduser(local_path), expanduser(remote_path))
+    return [remote_path]
+
+
+def run(command, *args, **kwargs):
+    with trace.span('run', 'remote', command=command):
+        if _local():
+            out = _local_run(command, *args, **kwargs)
+        else:
+            connection()
+            out = fapi.run(command, *args, **kwargs)
+        account('run', len(command), len(out))
+        trace.annotate(exit_code=getattr(out, 'return_code', None))
+    return out
+
+
+def get(remote_path, local_path=None, *args, **kwargs):
+    with trace.span('get', 'remote', path=remote_path):
+        if _local():
+            result = _local_get(remote_path, local_path, *args, **kwargs)
+        else:
+            connection()
+            result = fapi.get(remote_path, local_path, *args, **kwargs)
+        account('get', received=_size(local_path))
+    return result
+
+
+def put(local_path=None, remote_path=None, *args, **kwargs):
+    with trace.span('put', 'remote', path=remote_path):
+        if _local():
+            result = _local_put(local_path, remote_path, *args, **kwargs)
+        else:
+            connection()
+            result = fapi.put(local_path, remote_path, *args, **kwargs)
+        account('put', sent=_size(local_path))
+    return result
+
+
+def exists(path, *args, **kwargs):
+    with trace.span('exists', 'remote', path=path):
+        if _local():
+            with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                          warn_only=True):
+                result = _local_run('test -e "$(echo %s)"' % path).succeeded
+        else:
+            connection()
+            result = files.exists(path, *args, **kwargs)
+        account('exists', len(path))
+        trace.annotate(exists=result)
+    return result
+
+
+class QueuedCommand(object):
+    '''A command waiting inside a RemoteBatch.
+
+    After the batch is flushed it behaves like the result of a Fabric run:
+    it has output, return_code, succeeded and failed set.
+    '''
+
+    def __init__(self, command, real_command, warn_only):
+        self.command = command
+        self.real_command = real_command
+        self.warn_only = warn_only
+        self.output = None
+        self.return_code = None
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+    def __str__(self):
+        return self.output or ''
+
+
+class RemoteBatch(object):
+    '''Queue of independent remote commands shipped as one shell script.
+
+    Commands keep the cd/prefix context active when they were queued, run
+    in their own subshell and have their exit code and output reported back
+    separately. Unless keep_going is set, execution stops at the first
+    failing command, as a sequence of plain run calls would.
+    '''
+
+    def __init__(self, keep_going=False):
+        self.keep_going = keep_going
+        self.commands = []
+        self.token = uuid4().hex[:8]
+
+    def run(self, command):
+        queued = QueuedCommand(command, _prefix_commands(command, 'remote'),
+                               env.warn_only)
+        self.commands.append(queued)
+        return queued
+
+    def flush(self):
+        if not self.commands:
+            return []
+        commands, self.commands = self.commands, []
+        script = build_script([c.real_command for c in commands],
+                              self.token, self.keep_going)
+
+        with settings(hide('running', 'stdout', 'stderr'),
+                      cwd='', command_prefixes=[], warn_only=True):
+            out = run(script)
+
+        results = parse_output(out, self.token)
+        for i, command in enumerate(commands):
+            command.output, command.return_code = results.get(i, ('', None))
+            if command.return_code is None:
+                # never reached (an earlier command failed) or the remote
+                # side died before reporting back.
+                continue
+            _report(command)
+
+        for command in commands:
+            if command.return_code is None:
+                break
+            if command.failed and not command.warn_only:
+                error("batched command '%s' failed with return code %d"
+                      % (command.command, command.return_code),
+                      stdout=command.output)
+        return commands
+
+
+def _report(command):
+    if output.running:
+        print("[%s] batch: %s" % (env.host_string, command.command))
+    if output.stdout:
+        for line in command.output.splitlines():
+            print("[%s] out: %s" % (env.host_string, line))
+
+
+def build_script(commands, token, keep_going=False):
+    '''Build a shell script running each command in a subshell between
+    begin/end markers carrying the command index and exit code.'''
+    lines = []
+    for i, command in enumerate(commands):
+        lines.append('echo "%s:%s:%d:begin"' % (MARKER, token, i))
+        lines.append('( %s ) 2>&1' % command)
+        lines.append('rc=$?')
+        lines.append('echo "%s:%s:%d:end:$rc"' % (MARKER, token, i))
+        if not keep_going:
+            lines.append('[ $rc -eq 0 ] || exit $rc')
+    return "\n".join(lines)
+
+
+def parse_output(out, token):
+    '''Demultiplex the output of a script made by build_script.
+
+    Returns a dict mapping command index to (output, return_code). Commands
+    that started but never reported an exit code have return_code None.
+    '''
+    begin = '%s:%s:' % (MARKER, token)
+    results = {}
+    current, lines = None, []
+    for line in out.splitlines():
+        line = line.rstrip('\r')
+        if line.startswith(begin):
+            fields = line[len(begin):].split(':')
+            index = int(fields[0])
+            if fields[1] == 'begin':
+                current, lines = index, []
+                results[index] = ('', None)
+            elif fields[1] == 'end':
+                results[index] = ("\n".join(lines), int(fields[2]))
+                current, lines = None, []
+        elif current is not None:
+            lines.append(line)
+    if current is not None:
+        results[current] = ("\n".join(lines), None)
+    return results
+
+
+@contextmanager
+def batch(keep_going=False):
+    '''Context manager collecting remote commands into a single round trip.
+
+    Use the yielded batch's run method instead of Fabric's run for
+    independent commands:
+
+      with batch() as b:
+          b.run(fmt('mkdir -p {expdir}', environ))
+          b.run(fmt('mkdir -p {execdir}', environ))
+
+    Everything queued is executed when the block exits. Only use it for
+    commands whose output is not needed inside the block.
+    '''
+    queue = RemoteBatch(keep_going=keep_going)
+    yield queue
+    queue.flush()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import posixpath
+
+from bosun.environ import fmt
+
+
+# Files in a workdir the models (or bosun) write to in place. They get a
+# private copy instead of a link to the snapshot.
+WRITABLE = ('*.nml', 'input.nml*', 'MODELIN*', '*_table', 'INPUT/*.res*',
+            'INPUT/coupler.res', 'RESTART/*', 'time_stamp.*')
+
+MODES = ('hardlink', 'reflink', 'copy')
+
+
+def _snapshot_script(template, store):
+    ''' Make sure a snapshot of template exists in store, in $snap.
+
+    Snapshots are named after the names, sizes and mtimes of the template
+    files (following symlinks, like rsync -L), so a changed template gets
+    a new snapshot. Files in a snapshot are read-only, to catch anything
+    writing to a hard-linked file in place.
+    '''
+    return "\n".join([
+        'key=$(find -L %s -type f -printf "%%P %%s %%T@\\n" | sort | '
+        'md5sum | cut -c1-16)' % template,
+        'snap=%s/$key' % store,
+        'if [ ! -d $snap ]; then',
+        '  tmp=$snap.tmp.$$',
+        '  mkdir -p $tmp && cp -rL --preserve=timestamps %s/. $tmp/ || exit 1'
+        % template,
+        '  find $tmp -type f -exec chmod a-w {} +',
+        # someone else may have finished the same snapshot meanwhile
+        '  mv -T $tmp $snap 2>/dev/null || rm -rf $tmp',
+        'fi'])
+
+
+def workdir_script(template, workdir, store, mode='hardlink',
+                   writable=WRITABLE):
+    '''Shell script populating workdir from a snapshot of template.
+
+    mode is one of
+      hardlink  hard links to the snapshot (same filesystem as the store),
+                falling back to a copy if linking fails
+      reflink   copy-on-write copies (cp --reflink), on filesystems that
+                support them
+      copy      plain copy of the template, as rsync -rtL
+    Files matching the writable patterns always get a private, writable
+    copy when they are hard links.
+    '''
+    if mode not in MODES:
+        raise ValueError('Unknown workdir staging mode: %s' % mode)
+
+    lines = ['mkdir -p %s || exit 1' % workdir]
+    if mode == 'copy':
+        lines.append('rsync -rtL %s/ %s/' % (template, workdir))
+        return "\n".join(lines)
+
+    lines.append(_snapshot_script(template, store))
+    if mode == 'hardlink':
+        lines.append('cp -alf $snap/. %s/ 2>/dev/null || '
+                     'rsync -rtL %s/ %s/ || exit 1'
+                     % (workdir, template, workdir))
+    else:
+        lines.append('cp -a --reflink=always $snap/. %s/ || exit 1'
+                     % workdir)
+        lines.append('chmod -R u+w %s' % workdir)
+
+    lines.extend([
+        'cd %s || exit 1' % workdir,
+        'shopt -s nullglob',
+        'for f in %s; do' % ' '.join(writable),
+        '  [ -f "$f" ] || continue',
+        '  if [ $(stat -c %h "$f") -gt 1 ]; then',
+        '    cp -p "$f" "$f.bosun" && mv -f "$f.bosun" "$f" || exit 1',
+        '  fi',
+        '  chmod u+w "$f"',
+        'done'])
+    return "\n".join(lines)
+
+
+def stage_workdir(environ):
+    '''Command populating {workdir} from {workdir_template}.
+
+    Used vars:
+      workdir
+      workdir_template
+      workdir_staging (hardlink, reflink or copy; default hardlink)
+      template_store (default: .bosun_templates next to the workdir)
+      workdir_writable (extra patterns for files written in place)
+    '''
+    workdir = fmt('{workdir}', environ).rstrip('/')
+    store = environ.get('template_store', None)
+    if store is None:
+        store = posixpath.join(posixpath.dirname(workdir), '.bosun_templates')
+    writable = WRITABLE + tuple(environ.get('workdir_writable', ()))
+    return workdir_script(fmt('{workdir_template}', environ).rstrip('/'),
+                          workdir, store,
+                          mode=environ.get('workdir_staging', 'hardlink'),
+                          writable=writable)
+
+
+LINK_MANIFEST = '.bosun_manifest'
+LINK_MARKER = '@@bosun:link:'
+LINK_MODES = ('symlink', 'hardlink', 'copy')
+
+
+def link_tree_script(src, dest, mode='symlink'):
+    '''Shell script mirroring the files under src into dest with links.
+
+    The names, sizes and mtimes of the files in src are stored in a
+    manifest in dest. If src didn't change since the last call and every
+    file in the manifest is still in dest nothing else is done; otherwise
+    links are (re)created with cp -s (symlink), cp -l (hardlink) or
+    copied (copy), and files that disappeared from src are removed from
+    dest. Prints LINK_MARKER followed by 'unchanged' or 'updated'.
+    '''
+    if mode not in LINK_MODES:
+        raise ValueError('Unknown link mode: %s' % mode)
+    flag = {'symlink': '-rsf', 'hardlink': '-rlf', 'copy': '-Rf'}[mode]
+    manifest = '%s/%s' % (dest, LINK_MANIFEST)
+    return "\n".join([
+        'mkdir -p %s || exit 1' % dest,
+        '( cd %s && find -L . -type f -printf "%%P\\t%%s\\t%%T@\\n" ) | '
+        'LC_ALL=C sort > %s.new || exit 1' % (src, manifest),
+        'if cmp -s %s.new %s && ( cd %s && cut -f1 %s | '
+        'while IFS= read -r f; do [ -e "$f" ] || exit 1; done ); then'
+        % (manifest, manifest, dest, LINK_MANIFEST),
+        '  rm -f %s.new' % manifest,
+        '  echo "%sunchanged"' % LINK_MARKER,
+        '  exit 0',
+        'fi',
+        'cp %s %s/. %s/ || exit 1' % (flag, src, dest),
+        'if [ -f %s ]; then' % manifest,
+        '  LC_ALL=C comm -23 <(cut -f1 %s) <(cut -f1 %s.new) | '
+        '( cd %s && xargs -r -d "\\n" rm -f )' % (manifest, manifest, dest),
+        'fi',
+        'mv -f %s.new %s' % (manifest, manifest),
+        'echo "%supdated"' % LINK_MARKER])
+
+
+def copy_files_script(src, patterns, dest):
+    ''' Shell command copying the files in src matching patterns to dest,
+        if there are any '''
+    return ('( cd %s && shopt -s nullglob && for f in %s; do '
+            '[ -f "$f" ] && cp -p "$f" %s/; done; true )'
+            % (src, ' '.join(patterns), dest))
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+from fabric.api import settings, hide
+from fabric.utils import error
+import fabric.colors as fc
+
+from bosun.remote import run
+
+
+MANIFEST = 'MANIFEST.md5'
+STATS_MARKER = '@@bosun:archive:'
+TARBALL_MARKER = '@@bosun:tarball:'
+COMPRESS_MARKER = '@@bosun:compress:'
+
+# Compression backends for 'archive_compression': file suffix, command
+# compressing stdin to stdout ({jobs} is replaced by the number of threads),
+# command compressing a single output file in place and command
+# decompressing stdin to stdout. pigz writes gzip files, so archives made
+# with gzip and pigz can be read by either.
+COMPRESSORS = {
+    'gzip': ('.gz', 'gzip -c', 'gzip -f', 'gzip -dc'),
+    'pigz': ('.gz', 'pigz -c -p {jobs}', 'gzip -f', 'pigz -dc'),
+    'zstd': ('.zst', 'zstd -c -q -T{jobs}', 'zstd -q -f --rm', 'zstd -dc'),
+    'none': ('', 'cat', None, 'cat'),
+}
+DEFAULT_COMPRESSION = 'gzip'
+
+
+def human_size(nbytes):
+    ''' Format a byte count using binary prefixes '''
+    size = float(nbytes)
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+    return '%.1f TiB' % size
+
+
+def compression(environ):
+    ''' Name of the compression backend chosen in environ '''
+    name = environ.get('archive_compression', DEFAULT_COMPRESSION)
+    if name not in COMPRESSORS:
+        error('Unknown archive_compression %s, use one of: %s'
+              % (name, ', '.join(sorted(COMPRESSORS))))
+    return name
+
+
+def tarball_name(base, environ):
+    ''' Name of the tarball for base with the chosen compression '''
+    return base + '.tar' + COMPRESSORS[compression(environ)][0]
+
+
+def extract_command(tarball, environ=None):
+    '''Command extracting tarball into the current directory.
+
+    The decompressor comes from the suffix, so archives made with another
+    backend than the one chosen now can still be extracted. Gzip archives
+    are read with pigz when it is the chosen backend.
+    '''
+    if tarball.endswith('.gz') or tarball.endswith('.tgz'):
+        if compression(environ or {}) == 'pigz':
+            name = 'pigz'
+        else:
+            name = 'gzip'
+    elif tarball.endswith('.zst'):
+        name = 'zstd'
+    else:
+        return 'tar xf %s' % tarball
+    return '%s < %s | tar xf -' % (COMPRESSORS[name][3], tarball)
+
+
+def probe_extract_command(base, environ=None):
+    '''Command extracting the tarball of base, whatever compression it was
+    archived with: the first of base.tar with the chosen suffix, then the
+    other known ones, that exists. Fails if there is none.
+    '''
+    suffixes = [COMPRESSORS[compression(environ or {})][0]]
+    suffixes += sorted(set(c[0] for c in COMPRESSORS.values()) -
+                       set(suffixes))
+    branches = []
+    for suffix in suffixes:
+        tarball = base + '.tar' + suffix
+        branches.append('[ -f %s ]; then %s'
+                        % (tarball, extract_command(tarball, environ)))
+    return ('if %s; else echo "No archive of %s" >&2; false; fi'
+            % ('; elif '.join(branches), base))
+
+
+# Shell functions of the archive script. store copies a file into dest in
+# chunks of $chunk MiB through <target>.part, so a copy that was
+# interrupted continues from its last complete chunk, and only renames the
+# copy to its name once its MD5 matches the source. The MD5 is then
+# recorded in the manifest and the source removed. Files whose MD5 is
+# already recorded for an existing target are not copied again. verified
+# only says something was stored under a name, so a tarball is skipped on
+# it alone when none of its members is left (see gone): names like
+# INPUT.tar.gz are stored again by every segment.
+STORE_FUNCTIONS = r"""
+verified() {
+  [ -f "$dest/$1" ] && grep -q "  $1\$" $manifest
+}
+gone() {
+  local f
+  for f; do [ -e "$f" ] && return 1; done
+  return 0
+}
+store() {
+  local f=$1 rel=$2/${1##*/}
+  local target=$dest/$rel part=$dest/$rel.part sum size copied=0
+  sum=$(md5sum < "$f" | cut -d" " -f1) || return 1
+  if [ -f "$target" ] && grep -qx "$sum  $rel" $manifest; then
+    rm -f "$f"; return 0
+  fi
+  size=$(stat -c %s "$f")
+  [ -f "$part" ] && copied=$(( $(stat -c %s "$part") / (chunk << 20) ))
+  : >> "$part" || return 1
+  while [ $(( copied * (chunk << 20) )) -lt $size ]; do
+    dd if="$f" of="$part" bs=${chunk}M skip=$copied seek=$copied count=1 \
+       iflag=fullblock conv=notrunc status=none || return 1
+    copied=$(( copied + 1 ))
+  done
+  if [ "$(md5sum < "$part" | cut -d" " -f1)" != "$sum" ]; then
+    echo "checksum mismatch storing $rel" >&2; rm -f "$part"; return 1
+  fi
+  mv -f "$part" "$target" && echo "$sum  $rel" >> $manifest && rm -f "$f"
+}
+"""
+
+
+class Archive(object):
+    '''Archive stage for one segment, run as a single remote script.
+
+    Output files are compressed with up to 'jobs' parallel processes and
+    stored in <dest>/output, and tarballs are built concurrently and stored
+    in <dest>/restart, all with the 'compression' backend (a COMPRESSORS
+    key; multithreaded backends use 'jobs' threads per tarball).
+
+    Files are copied to dest in chunks of 'chunk' MiB and checked against
+    their MD5 before they get their final name and the MD5 is appended to
+    <dest>/MANIFEST.md5 (with paths relative to dest). If archiving is
+    interrupted, running it again skips what is already verified in dest,
+    reuses compressed files and complete tarballs left in the workdir and
+    resumes partial copies from their last chunk. Tarballs whose members
+    are still in the workdir are built again, and only stored when their
+    MD5 changed.
+
+    After run, stored maps each tarball name to its size and MD5, and
+    compressed to its uncompressed size, compressed size and seconds spent.
+
+    Typical use:
+      arch = Archive(full_path, compression='zstd')
+      arch.outputs(workdir, ['*fms.out', 'input.nml'], keep=['input.nml'])
+      arch.tarball(workdir + '/RESTART', '2008010100.tar.zst', ['ocean*'])
+      arch.run()
+    '''
+
+    def __init__(self, dest, jobs=4, compression=DEFAULT_COMPRESSION,
+                 chunk=256):
+        self.dest = dest
+        self.jobs = int(jobs)
+        self.compression = compression
+        self.chunk = int(chunk)
+        self.dirs = []
+        self._outputs = []
+        self._tarballs = []
+        self.stored = {}
+        self.compressed = {}
+
+    def mkdir(self, path):
+        self.dirs.append(path)
+
+    def outputs(self, workdir, patterns, keep=()):
+        ''' Files in workdir matching patterns go to <dest>/output,
+            compressed unless their name is in keep. '''
+        self._outputs.append((workdir, patterns, keep))
+
+    def tarball(self, cwd, name, members, exclude=(), remove=False):
+        ''' Build tarball name from members (relative to cwd) and move it
+            to <dest>/restart, removing the members afterwards if remove. '''
+        self._tarballs.append((cwd, name, members, exclude, remove))
+
+    def script(self):
+        dest = self.dest
+        dirs = list(self.dirs)
+        if self._outputs:
+            dirs.append('%s/output' % dest)
+        if self._tarballs:
+            dirs.append('%s/restart' % dest)
+
+        lines = ['shopt -s nullglob',
+                 'set -o pipefail',
+                 'start=$(date +%s)',
+                 'bytes=0',
+                 'failed=0',
+                 'dest=%s' % dest,
+                 'manifest=%s/%s' % (dest, MANIFEST),
+                 'chunk=%d' % self.chunk,
+                 STORE_FUNCTIONS.strip()]
+        if dirs:
+            lines.append('mkdir -p %s || exit 1' % ' '.join(dirs))
+
+        for workdir, patterns, keep in self._outputs:
+            lines.extend(_outputs_script(workdir, patterns, keep,
+                                         self.jobs, self.compression))
+
+        if self._tarballs:
+            lines.append('pids=()')
+            for tarball in self._tarballs:
+                lines.append('( %s ) &' % _tarball_script(
+                    self.compression, self.jobs, *tarball))
+                lines.append('pids+=($!)')
+            lines.append('for pid in "${pids[@]}"; do '
+                         'wait $pid || failed=1; done')
+            names = ' '.join('%s/restart/%s' % (dest, t[1])
+                             for t in self._tarballs)
+            lines.append('bytes=$(( bytes + $(du -cb %s 2>/dev/null '
+                         '| tail -1 | cut -f1) ))' % names)
+
+        lines.append('echo "%s$bytes:$(( $(date +%%s) - start )):$failed"'
+                     % STATS_MARKER)
+        lines.append('exit $failed')
+        return "\n".join(lines)
+
+    def run(self):
+        ''' Execute the archive script. Returns (bytes stored, seconds). '''
+        with settings(hide('running', 'stdout'), warn_only=True):
+            out = run(self.script())
+        nbytes, seconds = parse_stats(out)
+        self.stored = parse_tarballs(out)
+        self.compressed = parse_compression(out)
+        if out.failed:
+            error('archiving to %s failed' % self.dest, stdout=out)
+        report(self.dest, nbytes, seconds)
+        report_compression(self.compression, self.compressed)
+        return nbytes, seconds
+
+
+def _outputs_script(workdir, patterns, keep, jobs, compression):
+    suffix, _, compress_file, _ = COMPRESSORS[compression]
+    if compress_file:
+        # compressed by an interrupted run, but not stored yet
+        patterns = list(patterns) + [p + suffix for p in patterns]
+    lines = ['cd %s || exit 1' % workdir,
+             'compress=(); plain=(); seen=" "',
+             'for f in %s; do' % ' '.join(patterns),
+             '  [ -f "$f" ] || continue',
+             '  case "$seen" in *" $f "*) continue;; esac',
+             '  seen="$seen$f "']
+    if compress_file:
+        lines.append('  case "$f" in *%s) plain+=("$f"); continue;; esac'
+                     % suffix)
+    if keep:
+        lines.append('  case "$f" in %s) plain+=("$f"); continue;; esac'
+                     % '|'.join(keep))
+    lines.extend([
+        '  compress+=("$f")' if compress_file else '  plain+=("$f")',
+        'done'])
+    if compress_file:
+        lines.extend([
+            'if [ ${#compress[@]} -gt 0 ]; then',
+            '  printf "%%s\\0" "${compress[@]}" | '
+            'xargs -0 -n 1 -P %d %s || exit 1' % (jobs, compress_file),
+            'fi'])
+    lines.extend([
+        'moved=("${plain[@]}")',
+        'for f in "${compress[@]}"; do moved+=("$f%s"); done' % suffix,
+        'if [ ${#moved[@]} -gt 0 ]; then',
+        '  bytes=$(( bytes + $(du -cb "${moved[@]}" | tail -1 | cut -f1) ))',
+        '  for f in "${moved[@]}"; do store "$f" output || exit 1; done',
+        'fi'])
+    return lines
+
+
+def _tarball_script(compression, jobs, cwd, name, members, exclude, remove):
+    excludes = ''.join(' --exclude="%s"' % e for e in exclude)
+    compress = COMPRESSORS[compression][1].format(jobs=jobs)
+    # with --totals tar reports the uncompressed size on stderr, the rest
+    # of its stderr is passed on. The tarball only gets its name when
+    # complete, so one left by an interrupted run can be stored as is.
+    totals = '%s.totals' % name
+    build = ' && '.join([
+        't0=$(date +%s%N)',
+        '{ tar --totals -cf -%s %s 2> %s | %s > %s.tmp; ok=$?; '
+        % (excludes, ' '.join(members), totals, compress, name) +
+        'grep -v "^Total bytes written" %s >&2; ' % totals +
+        'raw=$(sed -n "s/^Total bytes written: \\([0-9]*\\).*/\\1/p" '
+        '%s); rm -f %s; [ $ok -eq 0 ]; }' % (totals, totals),
+        'mv %s.tmp %s' % (name, name),
+        'msecs=$(( ($(date +%s%N) - t0) / 1000000 ))',
+        'echo "%s${raw:-0} $(stat -c %%s %s) $msecs %s"'
+        % (COMPRESS_MARKER, name, name)])
+    steps = ['cd %s' % cwd,
+             '{ { [ ! -f %s ] && gone %s && verified restart/%s; } || '
+             '{ { [ -f %s ] || { %s; }; } && store %s restart; }; }'
+             % (name, ' '.join(members), name, name, build, name),
+             'sum=$(grep "  restart/%s$" $manifest | tail -1)' % name,
+             'echo "%s$(stat -c %%s $dest/restart/%s) ${sum%%%%  *} %s"'
+             % (TARBALL_MARKER, name, name)]
+    if remove:
+        steps.append('rm -f %s' % ' '.join(members))
+    return ' && '.join(steps)
+
+
+def parse_stats(out):
+    ''' Extract (bytes, seconds) from the archive script output '''
+    for line in reversed(out.splitlines()):
+        if line.startswith(STATS_MARKER):
+            fields = line[len(STATS_MARKER):].strip().split(':')
+            return int(fields[0]), int(fields[1])
+    return 0, 0
+
+
+def parse_tarballs(out):
+    ''' Extract {name: {'size': bytes, 'md5': digest}} of stored tarballs '''
+    stored = {}
+    for line in out.splitlines():
+        if line.startswith(TARBALL_MARKER):
+            size, md5, name = line[len(TARBALL_MARKER):].split()
+            stored[name] = {'size': int(size), 'md5': md5}
+    return stored
+
+
+def parse_compression(out):
+    ''' Extract {name: (uncompressed bytes, compressed bytes, seconds)} '''
+    compressed = {}
+    for line in out.splitlines():
+        if line.startswith(COMPRESS_MARKER):
+            raw, size, msecs, name = line[len(COMPRESS_MARKER):].split()
+            compressed[name] = (int(raw), int(size), int(msecs) / 1000.)
+    return compressed
+
+
+def report_compression(compression, compressed):
+    for name, (raw, size, seconds) in sorted(compressed.items()):
+        print(fc.yellow('%s: %s -> %s with %s (ratio %.2f) in %.1fs (%s/s)'
+                        % (name, human_size(raw), human_size(size),
+                           compression, raw / float(size or 1), seconds,
+                           human_size(raw / (seconds or 1.)))))
+
+
+def report(dest, nbytes, seconds):
+    rate = nbytes / float(seconds or 1)
+    print(fc.yellow('Archived %s to %s in %ds (%s/s)'
+                    % (human_size(nbytes), dest, seconds, human_size(rate))))
@@ -2,21 +2,29 @@
 
 from __future__ import with_statement
 from __future__ import print_function
-import time
-from datetime import datetime
+from os.path import dirname
 
-from fabric.api import run, cd, prefix, settings, hide
+from fabric.api import cd, prefix, settings
 import fabric.colors as fc
-from fabric.contrib.files import exists
 from fabric.decorators import task
-from dateutil.relativedelta import relativedelta
+from fabric.utils import abort
 
+from bosun import hosts, progress
 from bosun.environ import env_options, fmt
-from bosun.utils import genrange
+from bosun.jobs import JobStore, print_history, seconds
+from bosun.monitor import JobMonitor, query_jobs
+from bosun.remote import run, exists
+from bosun.throughput import (Throughput, config_key, segment_days, describe,
+                              format_walltime, walltime_request, MARGIN)
+from bosun.utils import SegmentPlan, parse_flag, restart_index
 
 
 __all__ = ['check_code', 'check_status', 'clean_experiment', 'compile_model',
-           'instrument_code', 'kill_experiment', 'run_model', 'archive_model']
+           'instrument_code', 'kill_experiment', 'run_model', 'archive_model',
+           'history', 'walltime']
+
+# States of a job waiting to run
+QUEUED_STATES = ('Q', 'H', 'W')
 
 
 @task
@@ -46,16 +54,47 @@ def instrument_code(environ, **kwargs):
 def run_model(environ, **kwargs):
     '''Run the model
 
+    Segments are submitted as a chain of dependent jobs, keeping up to
+    'pipeline_window' segments (default 1) in the queue, so segment N+1
+    waits in the queue while segment N runs. Each segment is verified and
+    archived as soon as its jobs leave the queue. Submitted jobs are
+    recorded in the job store (see bosun.jobs).
+
+    With 'walltime: auto' each segment requests the run time predicted
+    from the throughput of past segments with the same configuration
+    (see bosun.throughput), plus walltime_margin (default 0.2), and at
+    most max_walltime. Without history max_walltime is requested. With
+    an explicit walltime a better one is suggested when the request is
+    too short for the prediction or more than twice what it needs.
+
+    With a window larger than 1 every queued segment gets its own
+    namelist ({workdir}/input.nml{namelist_suffix}, {workdir}/MODELIN...)
+    and the runscripts receive the job ID to depend on in JobID_depend.
+    They are expected to submit with '-W depend=afterok:$JobID_depend'
+    when it is set and to copy the suffixed namelist into place when the
+    job starts. After the jobs of each segment a snapshot job checks the
+    run and copies its restarts and outputs to {workdir}/segments/{finish}
+    (see the model snapshot_script), and the next segment depends on it,
+    so it only starts from a verified segment and can't overwrite what is
+    still to be archived. The segment is then verified and archived from
+    the snapshot, which is removed afterwards.
+
     Used vars:
       expdir
       mode
       start
       restart
       restart_interval
+      calendar
       finish
       name
       days
       type
+      pipeline_window
+      walltime
+      walltime_margin
+      max_walltime
+      snapshot_walltime
 
     Depends on:
       agcm.prepare_namelist
@@ -70,71 +109,247 @@ def run_model(environ, **kwargs):
     '''
     print(fc.yellow('Running model'))
 
-    begin = datetime.strptime(str(environ['restart']), "%Y%m%d%H")
-    end = datetime.strptime(str(environ['finish']), "%Y%m%d%H")
-    if environ['restart_interval'] is None:
-        delta = relativedelta(end, begin)
-    else:
-        interval, units = environ['restart_interval'].split()
-        if not units.endswith('s'):
-            units = units + 's'
-        delta = relativedelta(**dict([[units, int(interval)]]))
-
-    for period in genrange(begin, end, delta):
-        finish = period + delta
-        if finish > end:
-            finish = end
+    restart = str(environ['restart'])
+    # segments stay aligned with the beginning of the experiment, even when
+    # resuming from a restart in the middle of one.
+    begin = str(environ.get('start', restart))
+    if begin > restart:
+        begin = restart
+    plan = SegmentPlan(begin, environ['finish'], environ['restart_interval'],
+                       environ.get('calendar', 'gregorian'))
+
+    window = max(int(environ.get('pipeline_window', 1)), 1)
+    auto_walltime = str(environ.get('walltime', '')).lower() == 'auto'
+    throughput = Throughput()
+    pending = []
+    for segment in plan.starting_at(restart):
+        if len(pending) >= window:
+            _finish_segment(environ, pending.pop(0))
 
         if environ['mode'] == 'cold':
-            environ['restart'] = finish.strftime("%Y%m%d%H")
+            environ['restart'] = segment.end
             environ['finish'] = environ['restart']
         else:
-            environ['restart'] = period.strftime("%Y%m%d%H")
-            environ['finish'] = finish.strftime("%Y%m%d%H")
-
-        environ['model'].check_restart(environ)
+            environ['restart'] = segment.start
+            environ['finish'] = segment.end
 
-        # TODO: set months and days? only use days?
-        if period.day == finish.day:
-            environ['months'] = (12 * (finish.year - period.year) +
-                                 finish.month - period.month)
+        if pending:
+            # restart files will be written by the previous segment
+            environ['JobID_depend'] = pending[-1]['JobID_snapshot']
         else:
-            environ['days'] = (finish - period).days
+            environ['JobID_depend'] = ''
+            environ['model'].check_restart(environ)
+        if window > 1:
+            environ['namelist_suffix'] = '.%s' % environ['restart']
+
+        environ.pop('months', None)
+        environ.pop('days', None)
+        if segment.months is not None:
+            environ['months'] = segment.months
+        else:
+            environ['days'] = segment.days
 
         # TODO: set restart_interval in input.nml to be equal to delta
 
+        _segment_walltime(environ, segment, auto_walltime, throughput)
         environ['model'].prepare_namelist(environ)
         environ['model'].run_model(environ)
         environ['model'].run_post(environ)
-
-        while check_status(environ, oneshot=True):
-            time.sleep(environ.get('status_sleep_time', 60))
-
-        environ['model'].verify_run(environ)
-        environ['model'].archive(environ)
+        if window > 1:
+            _submit_snapshot(environ)
+        _record_jobs(environ, segment)
+        pending.append(_segment_state(environ))
         environ['mode'] = 'warm'
 
+    while pending:
+        _finish_segment(environ, pending.pop(0))
+
+
+SEGMENT_KEYS = ('mode', 'restart', 'finish', 'months', 'days', 'snapshot')
+
+
+def _segment_state(environ):
+    ''' Values needed to verify and archive a submitted segment '''
+    state = dict((k, environ[k]) for k in environ.keys()
+                 if k in SEGMENT_KEYS or "JobID" in k)
+    state.pop('JobID_depend', None)
+    return state
+
+
+def _finish_segment(environ, state):
+    ''' Wait for the jobs of a segment, then verify and archive it '''
+    seg_env = dict((k, v) for k, v in environ.items()
+                   if k not in SEGMENT_KEYS and "JobID" not in k)
+    seg_env.update(state)
+    job_monitor(seg_env).wait()
+    if 'snapshot' in state:
+        seg_env['workdir'] = state['snapshot']
+    # only runs the model really checked are learned from (bosun.throughput)
+    checked = seg_env['model'].verify_run(seg_env)
+    if checked and seg_env.get('JobID_model'):
+        JobStore().verified(hosts.home(), seg_env['JobID_model'])
+    with hosts.balanced(seg_env):
+        seg_env['model'].archive(seg_env)
+    if 'snapshot' in state:
+        run('rm -rf {0} {0}.sh {0}.log'.format(state['snapshot']))
+
+
+def _submit_snapshot(environ):
+    '''Submit the job copying what the segment left in the workdir to
+    {workdir}/segments/{finish}, after all jobs of the segment succeeded.
+    Sets JobID_snapshot and snapshot (the copy).'''
+    dest = fmt('{workdir}/segments/{finish}', environ)
+    depend = ':'.join(environ[k] for k in sorted(environ.keys())
+                      if k.startswith('JobID_') and environ[k] and
+                      k not in ('JobID_depend', 'JobID_snapshot'))
+    header = ['#!/bin/bash',
+              fmt('#PBS -N S_{name}', environ),
+              '#PBS -j oe',
+              '#PBS -o %s.log' % dest,
+              '#PBS -l walltime=%s' % environ.get('snapshot_walltime',
+                                                  '00:30:00')]
+    if environ.get('account'):
+        header.append(fmt('#PBS -A {account}', environ))
+    lines = header + ['set -e'] + environ['model'].snapshot_script(environ,
+                                                                   dest)
+    run("mkdir -p %s && cat > %s.sh << 'EOF'\n%s\nEOF"
+        % (dirname(dest), dest, '\n'.join(lines)))
+    out = run('qsub -W depend=afterok:%s %s.sh' % (depend, dest))
+    environ['JobID_snapshot'] = out.split('\n')[-1]
+    environ['snapshot'] = dest
+
+
+def _segment_walltime(environ, segment, auto, throughput):
+    ''' Set the walltime of segment when it is 'auto', or suggest one '''
+    days = segment_days(segment.start, segment.end, environ.get('calendar'))
+    config = config_key(environ)
+    predicted = throughput.predict(config, days)
+    limit = seconds(environ.get('max_walltime', None))
+    if predicted is None:
+        if auto:
+            if not limit:
+                abort('walltime: auto needs past segments of this '
+                      'configuration (%s) in the job history, or '
+                      'max_walltime' % config)
+            environ['walltime'] = format_walltime(limit)
+            print(fc.yellow('No throughput history for %s, requesting '
+                            'max_walltime %s' % (config, environ['walltime'])))
+        return
+
+    rate, count = throughput.rate(config)
+    request = walltime_request(
+        predicted, environ.get('walltime_margin', MARGIN), limit)
+    if auto:
+        environ['walltime'] = request
+        print(fc.yellow('Segment %s-%s should run for %s, requesting %s'
+                        % (segment.start, segment.end,
+                           describe(predicted, rate, count), request)))
+        return
+    requested = seconds(environ.get('walltime', None))
+    if requested and (requested < predicted or
+                      requested > 2 * seconds(request)):
+        print(fc.yellow('Segment %s-%s should run for %s: walltime %s, '
+                        'consider %s' % (segment.start, segment.end,
+                                         describe(predicted, rate, count),
+                                         environ['walltime'], request)))
+
+
+def _record_jobs(environ, segment):
+    ''' Add the jobs just submitted for segment to the job store '''
+    store = JobStore()
+    for key in environ.keys():
+        if key.startswith('JobID_') and key != 'JobID_depend' and environ[key]:
+            component = key[len('JobID_'):]
+            resources = {}
+            # post-processing jobs have their own resources
+            if component == 'model':
+                resources = dict(walltime=environ.get('walltime'),
+                                 npes=environ.get('npes'),
+                                 config=config_key(environ),
+                                 days=segment_days(segment.start, segment.end,
+                                                   environ.get('calendar')))
+            store.submitted(hosts.home(), environ[key], environ['name'],
+                            component, segment.start, segment.end,
+                            **resources)
+
+
+def _job_ids(environ):
+    return [environ[k] for k in environ.keys() if "JobID" in k and environ[k]]
+
 
 def _get_status(environ):
-    ''' Retrieve PBS status from remote side '''
-    with settings(warn_only=True):
-        with hide('running', 'stdout'):
-            job_ids = " ".join([environ[k] for k in environ.keys()
-                                if "JobID" in k])
-            data = run(fmt("qstat -a %s" % job_ids, environ))
-    statuses = {}
-    if data.succeeded:
-        header = None
-        for line in data.split('\n'):
-            if header:
-                info = line.split()
-                try:
-                    statuses[info[0]] = dict(zip(header.split()[1:], info))
-                except IndexError:
-                    pass
-            elif line.startswith('Job ID'):
-                header = line
-    return statuses
+    ''' Retrieve PBS status from remote side.
+
+    Without job IDs in environ every job known to the server is returned.
+    '''
+    return query_jobs(_job_ids(environ) or None)
+
+
+def _is_experiment_job(environ, status):
+    ''' qstat truncates job names, so check if it is a prefix '''
+    s = status['Jobname']
+    return (s in fmt('M_{name}', environ) or
+            s in fmt('C_{name}', environ) or
+            s in fmt('P_{name}', environ) or
+            s in fmt('S_{name}', environ))
+
+
+def job_monitor(environ, job_ids=None):
+    '''JobMonitor for the jobs of this experiment, reporting through the
+    model check_status.
+
+    Tracks the JobID_* entries in environ or, if there are none (as when
+    called from the command line), the jobs of the experiment the job
+    store still has in the queue, and only when it has none the queued
+    jobs named after the experiment. State changes are recorded in the
+    job store.
+    '''
+    store = JobStore()
+    home = hosts.home()
+    if job_ids is None:
+        job_ids = _job_ids(environ)
+    if not job_ids:
+        job_ids = [job.job_id for job in store.jobs(environ['name'], home,
+                                                    active=True)]
+    if not job_ids:
+        job_ids = [status['ID'] for status in query_jobs(None).values()
+                   if _is_experiment_job(environ, status)]
+
+    def on_change(job_id, old_state, new_state, status):
+        store.transition(home, job_id, new_state, status,
+                         experiment=environ['name'])
+        if new_state in QUEUED_STATES:
+            _print_prediction(store, home, job_id)
+        if new_state != 'R':
+            environ['model'].check_status(environ, status)
+
+    def on_progress(job_id, status):
+        store.progress(home, job_id, status)
+        environ['model'].check_status(environ, status)
+
+    def on_finish(job_id, status):
+        store.transition(home, job_id, 'F', status,
+                         experiment=environ['name'])
+        progress.release(job_id)
+        print(fc.yellow('Job %s left the queue' % job_id))
+
+    return JobMonitor(job_ids, on_change=on_change, on_progress=on_progress,
+                      on_finish=on_finish,
+                      max_sleep=environ.get('status_sleep_time', None))
+
+
+def _print_prediction(store, home, job_id):
+    ''' How long a queued model job should run, from the job store '''
+    job = store.job(home, job_id)
+    if not job or job.component != 'model' or not job.days:
+        return
+    throughput = Throughput(store)
+    rate, count = throughput.rate(job.config)
+    if rate:
+        print(fc.yellow('Job %s queued, segment %s-%s should run for %s'
+                        % (job_id, job.start, job.finish,
+                           describe(int(job.days / rate * 3600), rate,
+                                    count))))
 
 
 @task
@@ -142,25 +357,79 @@ def _get_status(environ):
 def check_status(environ, **kwargs):
     print(fc.yellow('Checking status'))
 
-    statuses = _get_status(environ)
-    if not statuses:
+    monitor = job_monitor(environ)
+    if not monitor.poll():
         print(fc.yellow('No jobs running.'))
         return False
 
-    while statuses:
-        for status in statuses.values():
-            environ['model'].check_status(environ, status)
-
-        if kwargs.get('oneshot', False):
-            statuses = {}
-        else:
-            time.sleep(environ.get('status_sleep_time', 60))
-            statuses = _get_status(environ)
-        print()
+    if not kwargs.get('oneshot', False):
+        monitor.wait()
 
     return True
 
 
+@task
+@env_options
+def history(environ, **kwargs):
+    '''Jobs submitted for the experiment, from the local job store
+
+    Nothing is asked to PBS. 'last' limits the list to the most recent
+    jobs, and all=True lists the jobs of every experiment.
+    '''
+    store = JobStore()
+    experiment = environ['name']
+    if parse_flag(kwargs.get('all', False)):
+        experiment = None
+    records = store.jobs(experiment, hosts.home(),
+                         limit=kwargs.get('last', None))
+    if not records:
+        print(fc.yellow('No jobs recorded'))
+        return records
+    print_history(records)
+    return records
+
+
+@task
+@env_options
+def walltime(environ, **kwargs):
+    '''Predicted run time and walltime request for the next segment
+
+    Computed from the throughput of past segments with the same
+    configuration in the job store.
+
+    Used vars:
+      start
+      restart
+      finish
+      restart_interval
+      calendar
+      walltime_margin
+      max_walltime
+    '''
+    restart = str(environ['restart'])
+    begin = min(str(environ.get('start', restart)), restart)
+    plan = SegmentPlan(begin, environ['finish'], environ['restart_interval'],
+                       environ.get('calendar', 'gregorian'))
+    segment = next(plan.starting_at(restart))
+    days = segment_days(segment.start, segment.end, environ.get('calendar'))
+    config = config_key(environ)
+    throughput = Throughput()
+    predicted = throughput.predict(config, days)
+    if predicted is None:
+        print(fc.yellow('No finished segments of %s in the job history'
+                        % config))
+        return None
+    rate, count = throughput.rate(config)
+    request = walltime_request(
+        predicted, environ.get('walltime_margin', MARGIN),
+        seconds(environ.get('max_walltime', None)))
+    print(fc.yellow('Segment %s-%s (%g days) should run for %s, request '
+                    'walltime %s' % (segment.start, segment.end, days,
+                                     describe(predicted, rate, count),
+                                     request)))
+    return request
+
+
 @task
 @env_options
 def kill_experiment(environ, **kwargs):
@@ -168,10 +437,7 @@ def kill_experiment(environ, **kwargs):
     statuses = _get_status(environ)
     if statuses:
         for status in statuses.values():
-            s = status['Jobname']
-            if (s in fmt('M_{name}', environ) or
-                s in fmt('C_{name}', environ) or
-                    s in fmt('P_{name}', environ)):
+            if _is_experiment_job(environ, status):
                 run('qdel %s' % status['ID'].split('-')[0])
 
 
@@ -182,6 +448,7 @@ def clean_experiment(environ, **kwargs):
     run(fmt('rm -rf {rootexp}', environ))
     run(fmt('rm -rf {execdir}', environ))
     run(fmt('rm -rf {workdir}', environ))
+    restart_index(environ).forget_workdir(environ['workdir'])
     environ['model'].clean_experiment(environ)
 
 
@@ -260,7 +527,8 @@ def check_code(environ, **kwargs):
 @task
 @env_options
 def archive_model(environ, **kwargs):
-    environ['model'].archive(environ)
+    with hosts.balanced(environ):
+        environ['model'].archive(environ)
 
 
 @task
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+from bosun.jobs import JobStore, format_duration
+from bosun.utils import Calendar, parse_date
+
+
+# Settings that change how fast a model runs. Segments are only compared
+# with segments of the same configuration.
+CONFIG_KEYS = ('type', 'TRC', 'LV', 'npes', 'dt_atmos', 'dt_ocean', 'dt_cpld')
+
+# Most recent finished segments the throughput is computed from
+SAMPLES = 10
+
+# Fraction added to the predicted run time when requesting walltime, and
+# the granularity (seconds) requests are rounded up to
+MARGIN = 0.2
+ROUND = 300
+
+
+def config_key(environ):
+    ''' Key identifying the model configuration of environ '''
+    return ','.join('%s=%s' % (k, environ[k]) for k in CONFIG_KEYS
+                    if k in environ)
+
+
+def segment_days(start, finish, calendar=None):
+    ''' Simulated days between two YYYYMMDDHH dates '''
+    cal = Calendar(calendar)
+    return (cal.to_hours(parse_date(finish)) -
+            cal.to_hours(parse_date(start))) / 24.
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.
+
+
+class Throughput(object):
+    '''Model throughput, in simulated days per wall-clock hour, learned
+    from the segments in the job store.
+
+    The throughput of a configuration is the median over its last SAMPLES
+    verified model jobs, so a segment slowed down by a bad node or a busy
+    filesystem doesn't skew it. Jobs are only verified when the verify_run
+    of their model checked the segment ran to its end, so crashed or
+    killed jobs are left out, and so are the models without a check. The
+    run time of a job is from when it was seen running to when it left the
+    queue, since qstat reports elapsed time in minutes at best.
+    '''
+
+    def __init__(self, store=None, samples=SAMPLES):
+        self.store = store or JobStore()
+        self.samples = samples
+
+    def rates(self, config):
+        rates = []
+        for job in self.store.jobs(config=config, component='model',
+                                   verified=1):
+            if not (job.days and job.started and job.finished):
+                continue
+            elapsed = job.finished - job.started
+            if elapsed <= 0:
+                continue
+            rates.append(job.days / (elapsed / 3600.))
+        return rates[-self.samples:]
+
+    def rate(self, config):
+        ''' (days per hour, number of segments), or (None, 0) '''
+        rates = self.rates(config)
+        if not rates:
+            return None, 0
+        return _median(rates), len(rates)
+
+    def predict(self, config, days):
+        ''' Seconds a segment of days takes, None without history '''
+        rate, count = self.rate(config)
+        if not rate:
+            return None
+        return int(days / rate * 3600)
+
+
+def format_walltime(secs):
+    return '%02d:%02d:%02d' % (secs // 3600, secs % 3600 // 60, secs % 60)
+
+
+def walltime_request(predicted, margin=MARGIN, limit=None):
+    ''' HH:MM:SS walltime for a predicted run time in seconds, rounded up
+        to ROUND seconds and at most limit seconds '''
+    secs = int(predicted * (1 + float(margin)))
+    secs = -(-secs // ROUND) * ROUND
+    if limit:
+        secs = min(secs, limit)
+    return format_walltime(secs)
+
+
+def describe(seconds, rate, count):
+    return ('%s (%.1f simulated days/hour over %d segments)'
+            % (format_duration(seconds), rate, count))
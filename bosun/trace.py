@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from contextlib import contextmanager
+from os.path import expanduser
+import json
+import os
+import threading
+import time
+
+from fabric.api import env
+
+
+# Finished spans, as Chrome trace 'complete' events
+_events = []
+_local = threading.local()
+# Set in child processes whose spans are sent back to the parent
+_detached = []
+
+
+def trace_file():
+    '''Where to write the trace, or None when tracing is off.
+
+    Tracing is opt-in: set env.bosun_trace (fab --set bosun_trace=FILE) or
+    the BOSUN_TRACE environment variable.
+    '''
+    path = env.get('bosun_trace', None) or os.environ.get('BOSUN_TRACE')
+    return expanduser(path) if path else None
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _now():
+    return int(time.time() * 1e6)
+
+
+@contextmanager
+def span(name, category, **args):
+    '''Record the block as a span named name, nested in the current one.
+
+    args (and anything added with annotate while the span is the innermost
+    one) end up in the event. When the outermost span ends the trace file
+    is written, in the Chrome trace format (chrome://tracing, Perfetto).
+    '''
+    path = trace_file()
+    if path is None:
+        yield args
+        return
+
+    stack = _stack()
+    stack.append(args)
+    start = _now()
+    try:
+        yield args
+    except SystemExit as e:
+        # Fabric aborts with SystemExit
+        args['error'] = 'exit %s' % e.code
+        raise
+    except Exception as e:
+        args['error'] = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        stack.pop()
+        _events.append({'name': name, 'cat': category, 'ph': 'X',
+                        'ts': start, 'dur': _now() - start,
+                        'pid': os.getpid(),
+                        'tid': threading.current_thread().ident,
+                        'args': args})
+        if not stack and not _detached:
+            write(path)
+
+
+def annotate(**values):
+    ''' Add values to the innermost span. Numbers are added up, so it can
+        be called more than once for byte counts. '''
+    stack = _stack()
+    if not stack:
+        return
+    current = stack[-1]
+    for key, value in values.items():
+        if isinstance(value, (int, long, float)) and not isinstance(
+                value, bool) and isinstance(current.get(key), (int, long)):
+            current[key] += value
+        else:
+            current[key] = value
+
+
+def write(path):
+    ''' Write every span recorded by this process to path '''
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms'}, f)
+    os.rename(tmp, path)
+
+
+def summary(events=None):
+    '''Total time and count per span name, longest first.
+
+    Returns a list of (name, category, calls, seconds); nested spans are
+    counted again in their parents.
+    '''
+    totals = {}
+    for event in (_events if events is None else events):
+        key = (event['name'], event['cat'])
+        calls, dur = totals.get(key, (0, 0))
+        totals[key] = (calls + 1, dur + event['dur'])
+    return sorted([(name, cat, calls, dur / 1e6)
+                   for (name, cat), (calls, dur) in totals.items()],
+                  key=lambda t: -t[3])
+
+
+def events():
+    ''' Spans recorded so far, oldest first '''
+    return list(_events)
+
+
+def detach():
+    ''' In a child process: keep recording spans, but leave writing the
+        trace to the parent, which merges them (see dag, ensemble) '''
+    _detached[:] = [True]
+
+
+def merge(events):
+    ''' Add spans recorded by another process (see dag, ensemble) '''
+    _events.extend(events)
+
+
+def clear():
+    del _events[:]
@@ -1,10 +1,13 @@
 #!/usr/bin/python
 
+from collections import namedtuple
 from datetime import timedelta, datetime
 
 from dateutil.relativedelta import relativedelta
 import fabric.colors as fc
 
+from bosun import hosts
+from bosun.cache import RestartIndex
 from bosun.environ import fmt
 
 
@@ -33,22 +36,221 @@ JOB_STATES = {
 
 def genrange(*args):
     ''' Replacement for the range() builtin, accepting any argument that can be
-        compared (like datetimes and timedeltas).'''
+        compared (like datetimes and timedeltas). Values are generated lazily
+        when a step is given.'''
 
     if len(args) != 3:
         return range(*args)
-    start, stop, step = args
+    return _genrange(*args)
+
+
+def _genrange(start, stop, step):
     if start < stop:
-        cmpe = lambda a, b: a < b
-        inc = lambda a: a + step
+        while start < stop:
+            yield start
+            start = start + step
     else:
-        cmpe = lambda a, b: a > b
-        inc = lambda a: a - step
-    output = []
-    while cmpe(start, stop):
-        output.append(start)
-        start = inc(start)
-    return output
+        while start > stop:
+            yield start
+            start = start - step
+
+
+MONTH_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+class Calendar(object):
+    '''Model calendar, converting YYYYMMDDHH dates to hours since year 0.
+
+    Supported calendars are 'gregorian' (or 'standard'), 'noleap' (or
+    '365_day') and '360_day'. 'julian' is accepted but treated as
+    proleptic gregorian, so it has no leap day in 1900 or 2100 (centuries
+    not divisible by 400) and plans crossing them are a day off. Dates are
+    handled as (y, m, d, h) tuples, since datetime can't represent dates
+    like 2000-02-30.
+    '''
+
+    def __init__(self, name='gregorian'):
+        name = (name or 'gregorian').lower()
+        if name in ('gregorian', 'julian', 'standard', 'proleptic_gregorian'):
+            self.kind = 'gregorian'
+        elif name in ('noleap', '365_day', 'no_leap'):
+            self.kind = 'noleap'
+        elif name == '360_day':
+            self.kind = '360_day'
+        else:
+            raise ValueError('Unknown calendar: %s' % name)
+
+    def days_in_month(self, year, month):
+        if self.kind == '360_day':
+            return 30
+        if (self.kind == 'gregorian' and month == 2 and year % 4 == 0 and
+                (year % 100 != 0 or year % 400 == 0)):
+            return 29
+        return MONTH_DAYS[month - 1]
+
+    def to_hours(self, date):
+        y, m, d, h = date
+        if self.kind == 'gregorian':
+            days = datetime(y, m, d).toordinal()
+        elif self.kind == 'noleap':
+            days = 365 * y + sum(MONTH_DAYS[:m - 1]) + d - 1
+        else:
+            days = 360 * y + 30 * (m - 1) + d - 1
+        return days * 24 + h
+
+    def from_hours(self, hours):
+        days, h = divmod(hours, 24)
+        if self.kind == 'gregorian':
+            date = datetime.fromordinal(days)
+            return (date.year, date.month, date.day, h)
+        elif self.kind == 'noleap':
+            y, days = divmod(days, 365)
+            m = 1
+            while days >= MONTH_DAYS[m - 1]:
+                days -= MONTH_DAYS[m - 1]
+                m += 1
+            return (y, m, days + 1, h)
+        y, days = divmod(days, 360)
+        return (y, days // 30 + 1, days % 30 + 1, h)
+
+    def add_months(self, date, months):
+        y, m, d, h = date
+        y, m = divmod(12 * y + m - 1 + months, 12)
+        m += 1
+        return (y, m, min(d, self.days_in_month(y, m)), h)
+
+
+def parse_date(date):
+    ''' YYYYMMDDHH (string or int) to a (y, m, d, h) tuple '''
+    date = str(date)
+    return (int(date[0:4]), int(date[4:6]), int(date[6:8]), int(date[8:10]))
+
+
+def format_date(date):
+    return "%04d%02d%02d%02d" % date
+
+
+Segment = namedtuple('Segment', 'index start end months days')
+
+
+class SegmentPlan(object):
+    '''Restart segments between begin and end (YYYYMMDDHH dates).
+
+    interval is a restart_interval like '3 months', '1 year', '10 days' or
+    '6 hours'; None means a single segment. Segments are computed on
+    demand: plan[k] costs the same for any k, and index(date) finds the
+    segment containing a date without walking the ones before it.
+
+    Each Segment has start and end as YYYYMMDDHH strings plus the run
+    length, in months when start and end fall on the same day of the
+    month (days is None then) or in days otherwise (months is None).
+    '''
+
+    UNITS = {'year': ('months', 12), 'month': ('months', 1),
+             'week': ('hours', 7 * 24), 'day': ('hours', 24),
+             'hour': ('hours', 1)}
+
+    def __init__(self, begin, end, interval=None, calendar='gregorian'):
+        self.calendar = Calendar(calendar)
+        self.begin = parse_date(begin)
+        self.end = parse_date(end)
+        if interval is None:
+            self.unit, self.step = None, None
+        else:
+            n, units = str(interval).split()
+            self.unit, size = self.UNITS[units.lower().rstrip('s')]
+            self.step = int(n) * size
+            if self.step <= 0:
+                raise ValueError('Invalid restart interval: %s' % interval)
+        self.length = self._count()
+
+    def boundary(self, k):
+        ''' Start of the k-th segment, not limited by end '''
+        if self.unit is None:
+            return self.begin if k == 0 else self.end
+        if self.unit == 'months':
+            return self.calendar.add_months(self.begin, k * self.step)
+        return self.calendar.from_hours(
+            self.calendar.to_hours(self.begin) + k * self.step)
+
+    def _count(self):
+        if self.end <= self.begin:
+            return 0
+        if self.unit is None:
+            return 1
+        if self.unit == 'months':
+            (by, bm, _, _), (ey, em, _, _) = self.begin, self.end
+            k = (12 * (ey - by) + em - bm) // self.step
+        else:
+            k = ((self.calendar.to_hours(self.end) -
+                  self.calendar.to_hours(self.begin)) // self.step)
+        # k is at most one off, because of days and hours in the dates
+        while k > 0 and self.boundary(k - 1) >= self.end:
+            k -= 1
+        while self.boundary(k) < self.end:
+            k += 1
+        return k
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, k):
+        if k < 0:
+            k += self.length
+        if not 0 <= k < self.length:
+            raise IndexError('segment index out of range')
+        start = self.boundary(k)
+        end = min(self.boundary(k + 1), self.end)
+        return self._segment(k, start, end)
+
+    def _segment(self, k, start, end):
+        if start[2] == end[2]:
+            months = 12 * (end[0] - start[0]) + end[1] - start[1]
+            days = None
+        else:
+            months = None
+            days = ((self.calendar.to_hours(end) -
+                     self.calendar.to_hours(start)) // 24)
+        return Segment(k, format_date(start), format_date(end), months, days)
+
+    def __iter__(self):
+        return self.starting_at()
+
+    def index(self, date):
+        ''' Index of the segment containing date '''
+        date = parse_date(date)
+        if not self.begin <= date < self.end:
+            raise ValueError('%s is outside of the plan' % format_date(date))
+        if self.unit is None:
+            return 0
+        if self.unit == 'months':
+            (by, bm, _, _), (y, m, _, _) = self.begin, date
+            k = (12 * (y - by) + m - bm) // self.step
+        else:
+            k = ((self.calendar.to_hours(date) -
+                  self.calendar.to_hours(self.begin)) // self.step)
+        while k > 0 and self.boundary(k) > date:
+            k -= 1
+        while self.boundary(k + 1) <= date:
+            k += 1
+        return k
+
+    def starting_at(self, date=None):
+        '''Iterate over segments, starting from the one containing date.
+
+        If date is not a segment boundary the first segment starts at date
+        instead, so a run can be resumed from any restart. Nothing is left
+        to run from a date at or after the end of the plan.
+        '''
+        if date is not None and parse_date(date) >= self.end:
+            return
+        k = 0 if date is None else self.index(date)
+        for i in xrange(k, self.length):
+            segment = self[i]
+            if i == k and date is not None:
+                segment = self._segment(i, parse_date(date),
+                                        parse_date(segment.end))
+            yield segment
 
 
 def total_seconds(tdelta):
@@ -102,6 +304,19 @@ def hsm_full_path(environ):
     return full_path, cname
 
 
+def restart_index(environ):
+    ''' Restart index of the experiment archived at hsm_full_path '''
+    return RestartIndex(hosts.home(), hsm_full_path(environ)[0])
+
+
+def parse_flag(value):
+    ''' Boolean value of a task argument. Fabric passes the ones given on
+        the command line as strings, so 'False', 'no' or '0' are false. '''
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('true', 'yes', 'y', 'on', '1')
+    return bool(value)
+
+
 def clear_output(output):
     ''' It is very stupid to put echo in .bash_profile... '''
     patterns = ('HOME=', 'SUBMIT_HOME=', 'WORK_HOME=', 'TRANSFER_HOME=')
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from fabric.api import env
+from fabric.operations import _AttributeString
+from mock import patch
+
+from bosun.build import Fingerprint, parallel_make
+
+
+def _local_run(command, *args, **kwargs):
+    proc = subprocess.Popen(['bash', '-c', command], stdout=subprocess.PIPE)
+    out = _AttributeString(proc.communicate()[0].strip())
+    out.return_code = proc.returncode
+    return out
+
+
+@patch('bosun.build.run', _local_run)
+def test_fingerprint():
+    root = tempfile.mkdtemp()
+    try:
+        makeconf = os.path.join(root, 'makeconf')
+        executable = os.path.join(root, 'model.exe')
+        with open(makeconf, 'w') as f:
+            f.write('FFLAGS = -O2\n')
+        environ = {'root': '/model', 'executable': executable}
+
+        def fingerprint():
+            return Fingerprint(environ, executable + '.fingerprint',
+                               inputs=[makeconf], keys=['root'],
+                               target=executable)
+
+        # never built
+        fp = fingerprint()
+        assert not fp.matches()
+        open(executable, 'w').close()
+        fp.save()
+
+        assert fingerprint().matches()
+
+        environ['root'] = '/other'
+        assert not fingerprint().matches()
+        environ['root'] = '/model'
+
+        with open(makeconf, 'a') as f:
+            f.write('FFLAGS += -g\n')
+        assert not fingerprint().matches()
+        fp = fingerprint()
+        fp.matches()
+        fp.save()
+        assert fingerprint().matches()
+
+        environ['force_build'] = True
+        assert not fingerprint().matches()
+        del environ['force_build']
+
+        os.remove(executable)
+        assert not fingerprint().matches()
+    finally:
+        shutil.rmtree(root)
+
+
+def test_parallel_make():
+    with parallel_make({'make_jobs': 8}):
+        assert env.command_prefixes[-1] == 'export MAKEFLAGS=-j8'
+    with parallel_make({}):
+        assert not env.command_prefixes
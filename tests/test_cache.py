@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import shutil
+import tempfile
+
+from bosun.cache import ConfigCache, EnvSnapshot, RestartIndex, digest
+
+
+def test_config_cache_roundtrip():
+    root = tempfile.mkdtemp()
+    try:
+        cache = ConfigCache(root=root, ttl=60)
+        key = 'host|/exp_repos|base'
+        assert cache.lookup(key) is None
+
+        text_digest = cache.store(key, 'abc123', 'name: base\n')
+        entry = cache.lookup(key)
+        assert entry['revision'] == 'abc123'
+        assert entry['digest'] == text_digest == digest('name: base\n')
+        assert cache.fresh(entry)
+        assert cache.load_text(text_digest) == 'name: base\n'
+
+        assert not ConfigCache(root=root, ttl=0).fresh(entry)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_config_cache_expanded():
+    root = tempfile.mkdtemp()
+    try:
+        cache = ConfigCache(root=root)
+        environ = {'name': 'base', 'workdir': '/scratch/base'}
+        cache.store_expanded('d1', {'name': 'base'}, environ)
+
+        assert cache.load_expanded('d1', {'name': 'base'}) == environ
+        assert cache.load_expanded('d1', {'name': 'other'}) is None
+        assert cache.load_expanded('d2', {'name': 'base'}) is None
+
+        # expanded on another host or with another remote environment
+        cache.store_expanded('d1', {}, environ, 'user@a|e1')
+        assert cache.load_expanded('d1', {}, 'user@a|e1') == environ
+        assert cache.load_expanded('d1', {}, 'user@b|e1') is None
+        assert cache.load_expanded('d1', {}, 'user@a|e2') is None
+    finally:
+        shutil.rmtree(root)
+
+
+def test_env_snapshot():
+    root = tempfile.mkdtemp()
+    try:
+        snapshot = EnvSnapshot('user@host', root=root)
+        assert snapshot.load() is None
+        assert snapshot.digest() is None
+
+        snapshot.save({'HOME': '/home/user', 'OPTS': 'a=c'})
+        saved = snapshot.digest()
+        snapshot.save({'HOME': '/home/user', 'OPTS': 'a=b'})
+        assert snapshot.digest() != saved
+        assert (EnvSnapshot('user@host', root=root).load() ==
+                {'HOME': '/home/user', 'OPTS': 'a=b'})
+        assert EnvSnapshot('user@other', root=root).load() is None
+
+        snapshot.invalidate()
+        assert snapshot.load() is None
+    finally:
+        shutil.rmtree(root)
+
+
+def test_restart_index():
+    root = tempfile.mkdtemp()
+    try:
+        index = RestartIndex('user@host', '/hsm/exp', root=root)
+        assert index.lookup('ocean', '2008020100') is None
+        assert not index.extracted('ocean', '2008020100', '/work')
+
+        index.record('ocean', '2008020100', '/hsm/exp/restart/a.tar.gz',
+                     size=10, md5='abc')
+        index.mark_extracted('ocean', 2008020100, '/work')
+        index = RestartIndex('user@host', '/hsm/exp', root=root)
+        assert index.extracted('ocean', '2008020100', '/work')
+        assert not index.extracted('ocean', '2008020100', '/other')
+        assert index.lookup('ocean', '2008020100')['md5'] == 'abc'
+        assert RestartIndex('user@host', '/hsm/other',
+                            root=root).lookup('ocean', '2008020100') is None
+
+        index.mark_missing('ocean', '2008020100')
+        assert not index.extracted('ocean', '2008020100', '/work')
+        assert index.lookup('ocean', '2008020100')['archive']
+
+        # the workdir was cleaned: archives are still known
+        index.mark_extracted('ocean', '2008020100', '/work')
+        index.mark_extracted('atmos', '2008020100', '/other')
+        index.forget_workdir('/work')
+        assert not index.extracted('ocean', '2008020100', '/work')
+        assert index.extracted('atmos', '2008020100', '/other')
+        assert index.lookup('ocean', '2008020100')['archive']
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import raises
+
+from bosun.dag import Graph
+
+
+def _step(name):
+    def step(environ):
+        seen = ','.join(sorted(os.listdir(environ['dir'])))
+        with open(os.path.join(environ['dir'], name), 'w') as f:
+            f.write(seen)
+        environ[name] = True
+    return step
+
+
+def _fail(environ):
+    raise RuntimeError('boom')
+
+
+def test_levels():
+    graph = Graph('test')
+    graph.add('a', None)
+    graph.add('b', None, requires=['a'])
+    graph.add('c', None)
+    graph.add('d', None, requires=['b', 'c'])
+
+    assert graph.levels() == [['a', 'c'], ['b'], ['d']]
+
+
+@raises(ValueError)
+def test_cycle():
+    graph = Graph('test')
+    graph.add('a', None, requires=['b'])
+    graph.add('b', None, requires=['a'])
+    graph.levels()
+
+
+@raises(ValueError)
+def test_unknown_step():
+    graph = Graph('test')
+    graph.add('a', None, requires=['b'])
+    graph.levels()
+
+
+def test_run():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        graph = Graph('test')
+        for name, requires in (('a', ()), ('b', ()), ('c', ('a', 'b')),
+                               ('d', ('c',))):
+            graph.add(name, _step(name), requires=requires)
+        environ = {'dir': tmpdir}
+        results = graph.run(environ, workers=2)
+
+        assert sorted(results) == ['a', 'b', 'c', 'd']
+        # c and d saw what they required
+        with open(os.path.join(tmpdir, 'c')) as f:
+            assert f.read() == 'a,b'
+        with open(os.path.join(tmpdir, 'd')) as f:
+            assert f.read() == 'a,b,c'
+        # changes made in step processes come back
+        assert all(environ[name] for name in 'abcd')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _append(environ):
+    environ['files'].append('new')
+
+
+def test_run_updates_in_place():
+    graph = Graph('test')
+    graph.add('a', _append)
+    graph.add('b', _append)
+    environ = {'files': ['old']}
+    graph.run(environ, workers=2)
+    assert environ['files'] == ['old', 'new']
+
+
+def test_run_failure():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        graph = Graph('test')
+        graph.add('a', _fail)
+        graph.add('b', _step('b'))
+        graph.add('c', _step('c'), requires=['a'])
+        try:
+            graph.run({'dir': tmpdir}, workers=2)
+        except SystemExit:
+            pass
+        else:
+            assert False, 'a failing step should abort'
+        assert not os.path.exists(os.path.join(tmpdir, 'c'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_component_steps():
+    from bosun import coupled, deploy_graph
+
+    graph = deploy_graph({'model': coupled, 'instrument': False})
+    levels = graph.levels()
+
+    assert levels[-1] == ['compile_pre_ocean', 'compile_pre_atmos',
+                          'compile_post_ocean', 'compile_post_atmos']
+    assert 'compile_model' in levels[1]
+
+
+def test_instrument_steps():
+    from bosun import coupled, deploy_graph
+
+    graph = deploy_graph({'model': coupled, 'instrument': True})
+    requires = graph.steps['instrument_code'][1]
+    assert 'copy_expfiles' in requires
+    assert 'compile_model' not in graph.steps
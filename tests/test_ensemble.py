@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import tempfile
+
+from fabric.api import env, settings
+import mock
+
+from bosun import ensemble, trace
+
+
+def _member(environ):
+    print('running %s on %s' % (environ['name'], env.host_string))
+    if environ['name'] == 'bad':
+        raise RuntimeError('boom')
+
+
+def _traced_member(environ):
+    with trace.span('member', 'task', member=environ['name']):
+        pass
+
+
+def test_run_members():
+    logdir = tempfile.mkdtemp()
+    try:
+        environ = {'name': 'base', 'ensemble_logdir': logdir,
+                   'ensemble_members': {'good': {'name': 'good'},
+                                        'bad': {'name': 'bad'}},
+                   'host_pool': 'node1,node2'}
+        with settings(host_string='login'), \
+                mock.patch('bosun.hosts.least_loaded', return_value='node1'):
+            summary = ensemble.run_members(environ, _member, workers=2)
+
+        assert summary['good']['error'] is None
+        assert summary['bad']['error'] == 'boom'
+        with open(os.path.join(logdir, 'good.log')) as f:
+            # members submit jobs: they stay on the home host
+            assert 'running good on login' in f.read()
+    finally:
+        shutil.rmtree(logdir)
+
+
+def test_member_spans():
+    logdir = tempfile.mkdtemp()
+    path = os.path.join(logdir, 'trace.json')
+    trace.clear()
+    try:
+        environ = {'name': 'base', 'ensemble_logdir': logdir,
+                   'ensemble_members': {'a': {'name': 'a'},
+                                        'b': {'name': 'b'}}}
+        with settings(bosun_trace=path):
+            with trace.span('run_ensemble', 'task'):
+                ensemble.run_members(environ, _traced_member, workers=2)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        assert sorted(e['args'].get('member') for e in events
+                      if e['name'] == 'member') == ['a', 'b']
+        assert [e['name'] for e in events][-1] == 'run_ensemble'
+    finally:
+        trace.clear()
+        shutil.rmtree(logdir)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+from bosun import environ
+
+
+def test_parse_env_output():
+    out = ("HOME=/home/user\r\n"
+           "PBS_OPTS=-l walltime=01:00:00\r\n"
+           "EMPTY=\r\n"
+           "BASH_FUNC_module%%=() {  eval `modulecmd bash $*`\r\n"
+           "}\r\n"
+           "PATH=/usr/bin:/bin\r\n")
+    env_vars = environ.parse_env_output(out)
+
+    assert env_vars == {
+        'HOME': '/home/user',
+        'PBS_OPTS': '-l walltime=01:00:00',
+        'EMPTY': '',
+        'BASH_FUNC_module%%': '() {  eval `modulecmd bash $*`\n}',
+        'PATH': '/usr/bin:/bin',
+    }
+
+
+def test_parse_env_output_leading_noise():
+    assert environ.parse_env_output("welcome!\nA=1\n") == {'A': '1'}
+
+
+CONFIG = """
+type: atmos
+workdir: /scratch/{name}
+agcm_namelist:
+  file: /home/MODELIN
+  vars:
+    MODEL_RES:
+      trunc: 62
+ensemble:
+  m01:
+    agcm_namelist:
+      vars:
+        MODEL_RES:
+          trunc: 126
+  m02:
+    npes: 8
+"""
+
+
+def test_load_configuration_ensemble():
+    env = environ.load_configuration(CONFIG, {'name': 'base'})
+    members = env['ensemble_members']
+
+    assert env['workdir'] == '/scratch/base'
+    assert sorted(members) == ['m01', 'm02']
+    assert members['m01']['workdir'] == '/scratch/m01'
+    assert members['m01']['agcm_namelist']['vars']['MODEL_RES']['trunc'] == 126
+    assert members['m02']['npes'] == 8
+    assert members['m02']['model'] is env['model']
+    assert 'npes' not in env
+
+
+def test_update_model_type():
+    from bosun import agcm
+
+    assert environ.update_model_type({'type': 'atmos'})['model'] is agcm
+    assert environ.update_model_type({'type': 'unknown'})['model'] is None
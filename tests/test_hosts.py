@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import os
+import time
+
+from fabric.api import env, settings, hide
+
+from bosun import hosts
+
+
+def test_pool():
+    assert hosts.pool({'host_pool': ['a', 'b']}) == ['a', 'b']
+    assert hosts.pool({'host_pool': 'a, b,'}) == ['a', 'b']
+    os.environ['BOSUN_HOST_POOL'] = 'c,d'
+    try:
+        assert hosts.pool({}) == ['c', 'd']
+    finally:
+        del os.environ['BOSUN_HOST_POOL']
+    assert hosts.pool() == []
+
+
+def test_least_loaded():
+    hosts.clear()
+    now = time.time()
+    hosts._loads.update({'a': [now, 0.5, 4], 'b': [now, 0.2, 1],
+                         'c': [now, None, None]})
+    # b is picked, then counts one more process: 1.2 per CPU
+    assert hosts.least_loaded(['a', 'b', 'c']) == 'b'
+    assert hosts.least_loaded(['a', 'b', 'c']) == 'a'
+    assert hosts.least_loaded(['a', 'b', 'c']) == 'a'
+    hosts.clear()
+
+
+def test_measure_and_balanced():
+    hosts.clear()
+    with settings(hide('everything'), bosun_backend='local',
+                  host_string='home', shell='/bin/bash -c'):
+        hosts.measure(['node1'])
+        assert hosts._loads['node1'][1] >= 0
+        assert hosts._loads['node1'][2] >= 1
+
+        with hosts.balanced({'host_pool': ['node1']}) as host:
+            assert host == env.host_string == 'node1'
+            assert hosts.home() == 'home'
+        with hosts.balanced({}) as host:
+            assert host == 'home'
+    hosts.clear()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+
+from bosun import jobs
+
+
+def test_seconds():
+    assert jobs.seconds('04:00') == 4 * 3600
+    assert jobs.seconds('01:02:03') == 3723
+    assert jobs.seconds(3600) == 3600
+    assert jobs.seconds('--') is None
+    assert jobs.seconds(None) is None
+
+
+def test_job_store():
+    root = tempfile.mkdtemp()
+    try:
+        store = jobs.JobStore(os.path.join(root, 'bosun', 'jobs.db'))
+        store.submitted('host', '1.sdb', 'exp', 'model', 2008010100,
+                        2008020100, walltime='04:00:00', npes='48', when=10)
+        store.submitted('host', '2.sdb', 'exp', 'pos_atmos', when=11)
+        store.submitted('other', '3.sdb', 'exp2', 'model', when=12)
+        # submitting again doesn't reset a known job
+        store.transition('host', '1.sdb', 'Q', when=15)
+        # first seen 10 minutes after it started
+        store.transition('host', '1.sdb', 'R', {'Time': '00:10'}, when=1000)
+        store.submitted('host', '1.sdb', 'exp', 'model', when=21)
+
+        active = store.jobs('exp', 'host', active=True)
+        assert [j.job_id for j in active] == ['1.sdb', '2.sdb']
+        job = active[0]
+        assert isinstance(job, jobs.JobRecord)
+        assert (job.state, job.started, job.elapsed) == ('R', 400, 600)
+        assert (job.start, job.finish) == ('2008010100', '2008020100')
+        assert (job.walltime, job.npes) == (4 * 3600, 48)
+
+        store.progress('host', '1.sdb', {'Time': '01:00'}, when=4000)
+        store.transition('host', '1.sdb', 'F', {'Time': '01:30'}, when=5800)
+        # jobs found in the queue but not submitted through bosun
+        store.transition('host', '9.sdb', 'Q', {'TSK': '8'},
+                         experiment='exp', when=40)
+
+        assert store.transitions('host', '1.sdb') == [
+            ('Q', 10), ('R', 1000), ('F', 5800)]
+        job = store.jobs('exp', 'host')[0]
+        assert (job.state, job.started, job.finished, job.elapsed) == (
+            'F', 400, 5800, 5400)
+        assert [j.job_id for j in store.jobs('exp', active=True)] == [
+            '2.sdb', '9.sdb']
+        assert [j.job_id for j in store.jobs(limit=2)] == ['3.sdb', '9.sdb']
+
+        # only seen through progress polls
+        store.submitted('host', '4.sdb', 'exp', 'model', when=50)
+        store.progress('host', '4.sdb', {'Time': '00:05'}, when=1000)
+        assert store.job('host', '4.sdb').started == 700
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+from bosun import monitor
+
+
+QSTAT = """
+sdb:
+                                                            Req'd  Req'd   Elap
+Job ID          Username Queue    Jobname    SessID NDS TSK Memory Time  S Time
+--------------- -------- -------- ---------- ------ --- --- ------ ----- - -----
+123456.sdb      user     workq    M_exp         --    1  48    --  04:00 R 00:10
+123457.sdb      user     workq    P_exp         --    1   1    --  01:00 H   --
+"""
+
+
+def test_parse_qstat():
+    statuses = monitor.parse_qstat(QSTAT)
+    assert sorted(statuses) == ['123456.sdb', '123457.sdb']
+    assert statuses['123456.sdb']['S'] == 'R'
+    assert statuses['123456.sdb']['Time'] == '00:10'
+    assert statuses['123456.sdb']['Req_Time'] == '04:00'
+    assert statuses['123457.sdb']['Jobname'] == 'P_exp'
+
+
+def _fake_query(states):
+    ''' Returns a query function replaying a list of {job_id: state} '''
+    def query(job_ids):
+        current = states.pop(0)
+        return dict((j, {'ID': j, 'S': s}) for j, s in current.items())
+    return query
+
+
+def test_monitor_callbacks():
+    events = []
+    query = _fake_query([{'1.sdb': 'Q', '2.sdb': 'H'},
+                         {'1.sdb': 'R', '2.sdb': 'H'},
+                         {'1.sdb': 'E', '2.sdb': 'Q'},
+                         {'2.sdb': 'R'},
+                         {}])
+    mon = monitor.JobMonitor(
+        ['1', '2.sdb'], query=query,
+        on_change=lambda j, o, n, s: events.append(('change', j, o, n)),
+        on_progress=lambda j, s: events.append(('progress', j)),
+        on_finish=lambda j, s: events.append(('finish', j, s['S'])))
+    sleeps = []
+    mon.wait(sleep=sleeps.append)
+
+    assert not mon.active
+    assert events == [('change', '1', None, 'Q'),
+                      ('change', '2.sdb', None, 'H'),
+                      ('change', '1', 'Q', 'R'),
+                      ('progress', '1'),
+                      ('change', '1', 'R', 'E'),
+                      ('change', '2.sdb', 'H', 'Q'),
+                      ('finish', '1', 'E'),
+                      ('change', '2.sdb', 'Q', 'R'),
+                      ('progress', '2.sdb'),
+                      ('finish', '2.sdb', 'R')]
+    # exiting job => poll again quickly
+    assert sleeps[2] == monitor.POLL_INTERVALS['E'][0]
+
+
+def test_monitor_backoff():
+    mon = monitor.JobMonitor(['1'], query=_fake_query([{'1': 'Q'}] * 10),
+                             max_sleep=100)
+    intervals = []
+    for i in range(5):
+        mon.poll()
+        intervals.append(mon.next_interval())
+    assert intervals == [30, 60, 100, 100, 100]
+
+
+def test_same_job():
+    assert monitor._same_job('123', '123.sdb')
+    assert monitor._same_job('123.sdb', '123')
+    assert monitor._same_job('123.sdb-login1', '123.sdb')
+    assert monitor._same_job('123.sdb-login1', '123.sdb-log*')
+    assert not monitor._same_job('12', '123.sdb')
+    assert not monitor._same_job('123.sdb', '12.sdb')
+    assert not monitor._same_job('123.sdb', '123.other')
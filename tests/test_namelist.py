@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import shutil
+import tempfile
+
+import mock
+
+from bosun import namelist
+
+
+TEMPLATE = " &coupler_nml\n days = 1\n dt_atmos = 1800\n /\n"
+
+
+def test_merge_vars():
+    data = {'coupler_nml': {'days': 1, 'dt_atmos': 1800}}
+    namelist.merge_vars(data, {'coupler_nml': {'dt_atmos': 900, 'new': 1},
+                               'other_nml': {'a': 1}})
+    assert data == {'coupler_nml': {'days': 1, 'dt_atmos': 900}}
+
+
+def test_remote_digests_skips_login_noise():
+    out = ('Welcome to the cluster\n'
+           'd41d8cd98f00b204e9800998ecf8427e  -\n'
+           '0cc175b9c0f1b6a831c399e269772661  -')
+    with mock.patch('bosun.namelist.run', return_value=out):
+        assert namelist._remote_digests('/a', '/b') == [
+            'd41d8cd98f00b204e9800998ecf8427e',
+            '0cc175b9c0f1b6a831c399e269772661']
+
+
+def test_render_caches_template_and_skips_upload():
+    root = tempfile.mkdtemp()
+    remote = {'/exp/input.nml': TEMPLATE}
+
+    def fake_digests(*paths):
+        return [namelist.md5(remote.get(p, '')) for p in paths]
+
+    def fake_get(path, fd):
+        fd.write(remote[path])
+
+    def fake_put(fd, path):
+        remote[path] = fd.getvalue()
+
+    def update(data):
+        data['coupler_nml']['days'] = 31
+
+    try:
+        with mock.patch('bosun.namelist._remote_digests', fake_digests), \
+                mock.patch('bosun.namelist.get') as get, \
+                mock.patch('bosun.namelist.put') as put, \
+                mock.patch('bosun.cache.CACHE_DIR', root):
+            get.side_effect = fake_get
+            put.side_effect = fake_put
+            namelist.clear()
+
+            data = namelist.render('/exp/input.nml', '/work/input.nml',
+                                   update=update)
+            assert data['coupler_nml']['days'] == 31
+            assert 'days = 31' in remote['/work/input.nml']
+            assert get.call_count == put.call_count == 1
+
+            # same template and same result: nothing is transferred
+            namelist.render('/exp/input.nml', '/work/input.nml',
+                            update=update)
+            assert get.call_count == put.call_count == 1
+
+            # the template stays cached between processes
+            namelist._templates.clear()
+            namelist.render('/exp/input.nml', '/work/input.nml')
+            assert get.call_count == 1
+            assert put.call_count == 2
+            assert 'days = 1' in remote['/work/input.nml']
+            namelist.clear()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
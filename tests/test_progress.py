@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+from datetime import datetime
+
+from fabric.api import env
+
+from bosun import progress as prog
+from bosun.progress import LogProgress, ForecastProgress, SEPARATOR
+from bosun.mom4 import FMS_DATE
+
+
+def test_log_progress():
+    progress = LogProgress('/work/fms.out', 'yyyy', FMS_DATE)
+    assert 'tac' in progress.script()
+    assert progress.update('') is None
+
+    out = SEPARATOR + '120\n yyyy/mm/dd 2000/ 1/ 2  6:00:00\n'
+    assert progress.update(out) == datetime(2000, 1, 2, 6)
+    assert progress.offset == 120
+    assert 'tail -c +$((off + 1))' in progress.script()
+
+    # nothing new in the log
+    assert progress.update(SEPARATOR + '130\n') == datetime(2000, 1, 2, 6)
+
+    # log was rewritten by a new segment
+    assert progress.update(SEPARATOR + '10\n') is None
+    assert progress.offset == 10
+
+
+def test_forecast_progress():
+    progress = ForecastProgress('/work/model/dataout', '*.fct.*',
+                                '/work/.bosun_progress')
+    # the stamp of a previous job is not used
+    assert 'rm -f $s' in progress.script().splitlines()
+    assert progress.update(SEPARATOR + '\n') is None
+    assert 'rm -f $s' not in progress.script().splitlines()
+    current = progress.update(SEPARATOR + '2000010112\n')
+    assert current == datetime(2000, 1, 1, 12)
+
+
+def test_release():
+    env.host_string = 'host'
+    first = prog.tracker('1.sdb', ForecastProgress, '/d', '*', '/s')
+    assert prog.tracker('1.sdb', ForecastProgress, '/d', '*', '/s') is first
+    prog.release('1.sdb')
+    assert not [k for k in prog._trackers if k[1] == '1.sdb']
+    again = prog.tracker('1.sdb', ForecastProgress, '/d', '*', '/s')
+    assert again is not first
+    prog.release('1.sdb')
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import tempfile
+from StringIO import StringIO
+
+from fabric.api import settings, hide, cd
+import mock
+
+from bosun import remote
+
+
+def _run_locally(script):
+    proc = subprocess.Popen(['bash', '-c', script], stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    return out.decode('utf-8'), proc.returncode
+
+
+def test_build_script_roundtrip():
+    script = remote.build_script(['echo one', 'echo two; echo three'], 'tok')
+    out, rc = _run_locally(script)
+    results = remote.parse_output(out, 'tok')
+
+    assert rc == 0
+    assert results == {0: ('one', 0), 1: ('two\nthree', 0)}
+
+
+def test_build_script_stops_on_error():
+    script = remote.build_script(['echo one', 'false', 'echo three'], 'tok')
+    out, rc = _run_locally(script)
+    results = remote.parse_output(out, 'tok')
+
+    assert rc == 1
+    assert results[1] == ('', 1)
+    assert 2 not in results
+
+
+def test_build_script_keep_going():
+    script = remote.build_script(['exit 3', 'echo two'], 'tok',
+                                 keep_going=True)
+    out, rc = _run_locally(script)
+    results = remote.parse_output(out, 'tok')
+
+    assert results == {0: ('', 3), 1: ('two', 0)}
+
+
+def test_parse_output_ignores_noise():
+    out = ("HOME=/home/user\r\n"
+           "@@bosun:tok:0:begin\r\n"
+           "created\r\n"
+           "@@bosun:other:1:begin\r\n"
+           "@@bosun:tok:0:end:0\r\n")
+    results = remote.parse_output(out, 'tok')
+    assert results == {0: ('created\n@@bosun:other:1:begin', 0)}
+
+
+def test_parse_output_unfinished():
+    out = "@@bosun:tok:0:begin\npartial\n"
+    assert remote.parse_output(out, 'tok') == {0: ('partial', None)}
+
+
+def test_local_backend():
+    root = tempfile.mkdtemp()
+    try:
+        with settings(hide('everything'), bosun_backend='local',
+                      host_string='local', shell='/bin/bash -c'):
+            remote.reset_stats()
+            with cd(root):
+                assert remote.run('echo $PWD') == root
+            remote.put(StringIO('abc'), os.path.join(root, 'f'))
+            assert remote.exists(os.path.join(root, 'f'))
+            assert not remote.exists(os.path.join(root, 'missing'))
+
+            data = StringIO()
+            remote.get(os.path.join(root, 'f'), data)
+            assert data.getvalue() == 'abc'
+
+            with settings(warn_only=True):
+                assert remote.run('exit 3').return_code == 3
+
+        assert remote.STATS['calls'] == {'run': 2, 'put': 1, 'get': 1,
+                                         'exists': 2}
+        assert remote.STATS['bytes_sent'] > 3
+        assert remote.STATS['bytes_received'] > 3
+    finally:
+        shutil.rmtree(root)
+
+
+class FakeTransport(object):
+
+    def __init__(self, active):
+        self.active = active
+        self.keepalive = None
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+
+class FakeClient(object):
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def get_transport(self):
+        return self.transport
+
+
+class FakeConnections(dict):
+    ''' Fabric's connection cache, reconnecting with a live transport '''
+
+    def __init__(self):
+        self.connected = 0
+
+    def connect(self, key):
+        self.connected += 1
+        self[key] = FakeClient(FakeTransport(True))
+
+
+def test_connection_reconnects():
+    connections = FakeConnections()
+    dead = FakeClient(FakeTransport(False))
+    connections['host'] = dead
+    with mock.patch('bosun.remote.connections', connections):
+        with settings(host_string='host', keepalive=0):
+            client = remote.connection()
+            assert connections.connected == 1
+            assert client is not dead
+            assert client.transport.keepalive == remote.KEEPALIVE
+
+            # a live connection is kept
+            assert remote.connection() is client
+            assert connections.connected == 1
+
+            connections['host'] = FakeClient(None)
+            assert remote.connection() is not client
+            assert connections.connected == 2
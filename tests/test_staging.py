@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+
+from bosun import staging
+
+
+def _touch(path, content='data'):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _run(script):
+    proc = subprocess.Popen(['bash', '-c', script], stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    assert proc.returncode == 0, out
+
+
+def test_hardlink_workdir():
+    root = tempfile.mkdtemp()
+    try:
+        template = os.path.join(root, 'template')
+        store = os.path.join(root, 'store')
+        _touch(os.path.join(template, 'INPUT', 'grid_spec.nc'))
+        _touch(os.path.join(template, 'INPUT', 'ocean_temp_salt.res.nc'))
+        _touch(os.path.join(template, 'data_table'))
+
+        workdirs = [os.path.join(root, 'exp%d' % i) for i in range(2)]
+        for workdir in workdirs:
+            _run(staging.workdir_script(template, workdir, store))
+
+        assert len(os.listdir(store)) == 1
+        grid = os.stat(os.path.join(workdirs[0], 'INPUT', 'grid_spec.nc'))
+        assert grid.st_nlink == 3
+        assert not grid.st_mode & stat.S_IWUSR
+
+        for name in ('INPUT/ocean_temp_salt.res.nc', 'data_table'):
+            private = os.stat(os.path.join(workdirs[1], name))
+            assert private.st_nlink == 1
+            assert private.st_mode & stat.S_IWUSR
+
+        # a changed template gets a new snapshot
+        _touch(os.path.join(template, 'INPUT', 'new.nc'))
+        _run(staging.workdir_script(template, workdirs[0], store))
+        assert len(os.listdir(store)) == 2
+        assert os.path.exists(os.path.join(workdirs[0], 'INPUT', 'new.nc'))
+    finally:
+        shutil.rmtree(root)
+
+
+def test_link_tree():
+    root = tempfile.mkdtemp()
+    try:
+        src = os.path.join(root, 'inputs')
+        dest = os.path.join(root, 'datain')
+        _touch(os.path.join(src, 'a.dat'))
+        _touch(os.path.join(src, 'sub', 'b.dat'))
+        script = staging.link_tree_script(src, dest)
+
+        _run(script)
+        assert os.path.islink(os.path.join(dest, 'sub', 'b.dat'))
+        assert os.path.exists(os.path.join(dest, staging.LINK_MANIFEST))
+
+        proc = subprocess.Popen(['bash', '-c', script],
+                                stdout=subprocess.PIPE)
+        assert 'unchanged' in proc.communicate()[0]
+
+        os.remove(os.path.join(src, 'a.dat'))
+        _touch(os.path.join(src, 'c.dat'))
+        _run(script)
+        assert sorted(os.listdir(dest)) == [staging.LINK_MANIFEST, 'c.dat',
+                                            'sub']
+
+        # broken tree is fixed even if the inputs didn't change
+        os.remove(os.path.join(dest, 'c.dat'))
+        _run(script)
+        assert os.path.islink(os.path.join(dest, 'c.dat'))
+    finally:
+        shutil.rmtree(root)
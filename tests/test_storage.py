@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from bosun import storage
+
+
+def _touch(path, content='data'):
+    with open(path, 'w') as f:
+        f.write(content * 100)
+
+
+def test_archive_script():
+    root = tempfile.mkdtemp()
+    try:
+        workdir = os.path.join(root, 'work')
+        dest = os.path.join(root, 'hsm')
+        os.makedirs(os.path.join(workdir, 'RESTART'))
+        for name in ('a.fms.out', 'input.nml', 'b.fms.out'):
+            _touch(os.path.join(workdir, name))
+        for name in ('ocean_temp.res.nc', 'coupler.res'):
+            _touch(os.path.join(workdir, 'RESTART', name))
+
+        arch = storage.Archive(dest, jobs=2)
+        arch.mkdir(os.path.join(dest, 'ocean'))
+        arch.outputs(workdir, ['*fms.out', 'input.nml', 'missing*'],
+                     keep=['input.nml'])
+        arch.tarball(os.path.join(workdir, 'RESTART'), '2008.tar.gz',
+                     ['coupler*', 'ocean*'], remove=True)
+
+        proc = subprocess.Popen(['bash', '-c', arch.script()],
+                                stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        assert proc.returncode == 0
+
+        assert sorted(os.listdir(os.path.join(dest, 'output'))) == [
+            'a.fms.out.gz', 'b.fms.out.gz', 'input.nml']
+        assert os.listdir(os.path.join(dest, 'restart')) == ['2008.tar.gz']
+        assert os.listdir(os.path.join(workdir, 'RESTART')) == []
+        assert os.path.isdir(os.path.join(dest, 'ocean'))
+
+        check = subprocess.Popen(['md5sum', '-c', storage.MANIFEST],
+                                 cwd=dest, stdout=subprocess.PIPE)
+        check.communicate()
+        assert check.returncode == 0
+
+        nbytes, seconds = storage.parse_stats(out)
+        assert nbytes > 0
+
+        stored = storage.parse_tarballs(out)
+        tarball = os.path.join(dest, 'restart', '2008.tar.gz')
+        assert stored['2008.tar.gz']['size'] == os.path.getsize(tarball)
+        assert len(stored['2008.tar.gz']['md5']) == 32
+    finally:
+        shutil.rmtree(root)
+
+
+def test_human_size():
+    assert storage.human_size(512) == '512.0 B'
+    assert storage.human_size(3 * 1024 ** 3) == '3.0 GiB'
+
+
+def _have(command):
+    return subprocess.call(['bash', '-c', 'command -v %s' % command],
+                           stdout=subprocess.PIPE) == 0
+
+
+def test_compression_backends():
+    for compression in ('gzip', 'pigz', 'zstd', 'none'):
+        if not _have(compression.replace('none', 'cat')):
+            continue
+        root = tempfile.mkdtemp()
+        try:
+            workdir = os.path.join(root, 'work')
+            dest = os.path.join(root, 'hsm')
+            os.makedirs(os.path.join(workdir, 'RESTART'))
+            _touch(os.path.join(workdir, 'a.fms.out'))
+            _touch(os.path.join(workdir, 'RESTART', 'ocean.res'))
+
+            environ = {'archive_compression': compression}
+            name = storage.tarball_name('2008', environ)
+            arch = storage.Archive(dest, jobs=2, compression=compression)
+            arch.outputs(workdir, ['*fms.out'])
+            arch.tarball(os.path.join(workdir, 'RESTART'), name, ['ocean*'],
+                         remove=True)
+            proc = subprocess.Popen(['bash', '-c', arch.script()],
+                                    stdout=subprocess.PIPE)
+            out = proc.communicate()[0]
+            assert proc.returncode == 0
+
+            suffix = storage.COMPRESSORS[compression][0]
+            assert os.listdir(os.path.join(dest, 'output')) == [
+                'a.fms.out' + suffix]
+            raw, size, seconds = storage.parse_compression(out)[name]
+            assert raw >= 400
+            assert size == os.path.getsize(os.path.join(dest, 'restart', name))
+
+            subprocess.check_call(
+                ['bash', '-c', storage.extract_command(
+                    os.path.join(dest, 'restart', name), environ)],
+                cwd=workdir)
+            assert os.path.exists(os.path.join(workdir, 'ocean.res'))
+        finally:
+            shutil.rmtree(root)
+
+
+def test_extract_command():
+    assert storage.tarball_name('2008', {}) == '2008.tar.gz'
+    assert storage.tarball_name('2008', {'archive_compression': 'none'}) \
+        == '2008.tar'
+    pigz = {'archive_compression': 'pigz'}
+    assert storage.extract_command('a.tar.gz', pigz).startswith('pigz -dc')
+    assert storage.extract_command('a.tar.gz').startswith('gzip -dc')
+    assert storage.extract_command('a.tar.zst', pigz).startswith('zstd -dc')
+    assert storage.extract_command('a.tar') == 'tar xf a.tar'
+
+
+def test_probe_extract_command():
+    root = tempfile.mkdtemp()
+    try:
+        _touch(os.path.join(root, 'ocean.res'))
+        # archived uncompressed, while gzip is chosen now
+        subprocess.check_call(['tar', 'cf', 'hsm.tar', 'ocean.res'],
+                              cwd=root)
+        os.remove(os.path.join(root, 'ocean.res'))
+        command = storage.probe_extract_command(os.path.join(root, 'hsm'))
+        assert command.index('.tar.gz') < command.index('.tar.zst')
+        subprocess.check_call(['bash', '-c', command], cwd=root)
+        assert os.path.exists(os.path.join(root, 'ocean.res'))
+
+        missing = storage.probe_extract_command(os.path.join(root, 'none'))
+        assert subprocess.call(['bash', '-c', missing], cwd=root,
+                               stderr=open(os.devnull, 'w')) != 0
+    finally:
+        shutil.rmtree(root)
+
+
+def _store(dest, path, subdir):
+    script = '\n'.join(['dest=%s' % dest,
+                        'manifest=%s/%s' % (dest, storage.MANIFEST),
+                        'chunk=1', storage.STORE_FUNCTIONS,
+                        'store %s %s' % (path, subdir)])
+    return subprocess.call(['bash', '-c', script])
+
+
+def test_resumable_store():
+    root = tempfile.mkdtemp()
+    try:
+        dest = os.path.join(root, 'hsm')
+        os.makedirs(os.path.join(dest, 'restart'))
+        src = os.path.join(root, 'big')
+        content = os.urandom(3 * 1024 * 1024 + 100)
+        target = os.path.join(dest, 'restart', 'big')
+
+        # a copy interrupted in the middle of the second chunk continues
+        with open(src, 'wb') as f:
+            f.write(content)
+        with open(target + '.part', 'wb') as f:
+            f.write(content[:1536 * 1024])
+        assert _store(dest, src, 'restart') == 0
+        assert open(target, 'rb').read() == content
+        assert not os.path.exists(src)
+        assert not os.path.exists(target + '.part')
+        check = subprocess.Popen(['md5sum', '-c', storage.MANIFEST],
+                                 cwd=dest, stdout=subprocess.PIPE)
+        check.communicate()
+        assert check.returncode == 0
+
+        # already verified: not copied again
+        with open(src, 'wb') as f:
+            f.write(content)
+        mtime = int(os.path.getmtime(target)) - 10
+        os.utime(target, (mtime, mtime))
+        assert _store(dest, src, 'restart') == 0
+        assert os.path.getmtime(target) == mtime
+
+        # a corrupted partial copy is detected and thrown away
+        os.remove(target)
+        with open(src, 'wb') as f:
+            f.write(content)
+        with open(target + '.part', 'wb') as f:
+            f.write('x' * 1024 * 1024)
+        assert _store(dest, src, 'restart') != 0
+        assert not os.path.exists(target)
+        assert not os.path.exists(target + '.part')
+        assert os.path.exists(src)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_archive_again():
+    root = tempfile.mkdtemp()
+    try:
+        workdir = os.path.join(root, 'work')
+        dest = os.path.join(root, 'hsm')
+        os.makedirs(os.path.join(workdir, 'RESTART'))
+        _touch(os.path.join(workdir, 'RESTART', 'ocean.res'))
+        _touch(os.path.join(workdir, 'b.fms.out.gz'))
+
+        arch = storage.Archive(dest)
+        arch.outputs(workdir, ['*fms.out'])
+        arch.tarball(os.path.join(workdir, 'RESTART'), '2008.tar.gz',
+                     ['ocean*'])
+        outs = []
+        for attempt in range(2):
+            proc = subprocess.Popen(['bash', '-c', arch.script()],
+                                    stdout=subprocess.PIPE)
+            outs.append(proc.communicate()[0])
+            assert proc.returncode == 0
+
+        # left compressed by an earlier run
+        assert os.listdir(os.path.join(dest, 'output')) == ['b.fms.out.gz']
+        # the same tarball is only stored once
+        assert (storage.parse_tarballs(outs[0]) ==
+                storage.parse_tarballs(outs[1]))
+        assert len(open(os.path.join(dest, storage.MANIFEST)).readlines()) \
+            == 2
+
+        # next segment: same name, new content
+        _touch(os.path.join(workdir, 'RESTART', 'ocean.res'), 'new')
+        proc = subprocess.Popen(['bash', '-c', arch.script()],
+                                stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        assert proc.returncode == 0
+        assert (storage.parse_tarballs(out)['2008.tar.gz']['md5'] !=
+                storage.parse_tarballs(outs[0])['2008.tar.gz']['md5'])
+        subprocess.check_call(
+            ['bash', '-c', storage.extract_command(
+                os.path.join(dest, 'restart', '2008.tar.gz'))], cwd=root)
+        assert open(os.path.join(root, 'ocean.res')).read() == 'new' * 100
+
+        # members removed after an interrupted run stored the tarball
+        arch = storage.Archive(dest)
+        arch.tarball(os.path.join(workdir, 'RESTART'), '2008.tar.gz',
+                     ['ocean*'])
+        os.remove(os.path.join(workdir, 'RESTART', 'ocean.res'))
+        proc = subprocess.Popen(['bash', '-c', arch.script()],
+                                stdout=subprocess.PIPE)
+        assert storage.parse_tarballs(proc.communicate()[0]) == \
+            storage.parse_tarballs(out)
+        assert proc.returncode == 0
+    finally:
+        shutil.rmtree(root)
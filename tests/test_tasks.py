@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import mock
+
+from bosun import tasks, utils
+
+
+class FakeModel(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def verify_run(self, environ):
+        self.calls.append(('verify', environ['restart'], environ['mode']))
+        return True
+
+    def archive(self, environ):
+        self.calls.append(('archive', environ['restart'],
+                           tasks._job_ids(environ)))
+
+    def snapshot_script(self, environ, dest):
+        return ['cp -a %s/RESTART %s/' % (environ['workdir'], dest)]
+
+
+def test_finish_segment_uses_segment_state():
+    model = FakeModel()
+    environ = {'model': model, 'mode': 'cold', 'restart': '2000010100',
+               'finish': '2000020100', 'JobID_model': '10.sdb',
+               'JobID_depend': '9.sdb', 'workdir': '/scratch/exp'}
+    state = tasks._segment_state(environ)
+    assert 'JobID_depend' not in state
+    assert 'workdir' not in state
+
+    # the next segment was submitted meanwhile
+    environ.update({'mode': 'warm', 'restart': '2000020100',
+                    'finish': '2000030100', 'JobID_model': '11.sdb',
+                    'JobID_depend': '10.sdb'})
+    with mock.patch('bosun.tasks.job_monitor') as monitor, \
+            mock.patch('bosun.tasks.JobStore') as store:
+        tasks._finish_segment(environ, state)
+        assert tasks._job_ids(monitor.call_args[0][0]) == ['10.sdb']
+        # learned from by bosun.throughput
+        assert store.return_value.verified.call_args[0][1] == '10.sdb'
+    assert model.calls == [('verify', '2000010100', 'cold'),
+                           ('archive', '2000010100', ['10.sdb'])]
+    assert environ['restart'] == '2000020100'
+
+
+def test_finish_segment_unchecked():
+    model = FakeModel()
+    # like agcm.verify_run: nothing checked
+    model.verify_run = lambda environ: False
+    environ = {'model': model, 'mode': 'warm', 'restart': '2000010100',
+               'finish': '2000020100', 'JobID_model': '10.sdb'}
+    with mock.patch('bosun.tasks.job_monitor'), \
+            mock.patch('bosun.tasks.JobStore') as store:
+        tasks._finish_segment(environ, tasks._segment_state(environ))
+    assert not store.return_value.verified.called
+
+
+def test_snapshot_segment():
+    model = FakeModel()
+    environ = {'model': model, 'mode': 'warm', 'restart': '2000010100',
+               'finish': '2000020100', 'name': 'exp',
+               'workdir': '/scratch/exp',
+               'JobID_model': '10.sdb', 'JobID_pos_ocean': '11.sdb',
+               'JobID_depend': '9.sdb', 'JobID_snapshot': '8.sdb'}
+    with mock.patch('bosun.tasks.run') as run:
+        run.return_value = '12.sdb'
+        tasks._submit_snapshot(environ)
+        script, qsub = [c[0][0] for c in run.call_args_list]
+    assert '#PBS -N S_exp' in script
+    assert ('cp -a /scratch/exp/RESTART /scratch/exp/segments/2000020100/'
+            in script)
+    assert qsub == ('qsub -W depend=afterok:10.sdb:11.sdb '
+                    '/scratch/exp/segments/2000020100.sh')
+    assert environ['JobID_snapshot'] == '12.sdb'
+
+    # verified and archived from the snapshot, then removed
+    state = tasks._segment_state(environ)
+    environ.update({'restart': '2000020100', 'finish': '2000030100'})
+    with mock.patch('bosun.tasks.job_monitor'), \
+            mock.patch('bosun.tasks.JobStore'):
+        with mock.patch('bosun.tasks.run') as run:
+            model.verify_run = lambda env: model.calls.append(env['workdir'])
+            tasks._finish_segment(environ, state)
+    assert model.calls[0] == '/scratch/exp/segments/2000020100'
+    assert run.call_args[0][0].startswith(
+        'rm -rf /scratch/exp/segments/2000020100 ')
+    assert environ['workdir'] == '/scratch/exp'
+
+
+class FakeThroughput(object):
+
+    def __init__(self, rate):
+        self._rate = rate
+
+    def rate(self, config):
+        return (self._rate, 5) if self._rate else (None, 0)
+
+    def predict(self, config, days):
+        return int(days / self._rate * 3600) if self._rate else None
+
+
+def test_segment_walltime():
+    segment = utils.Segment(0, '2000010100', '2000020100', 1, None)
+    environ = {'walltime': 'auto', 'type': 'atmos'}
+    tasks._segment_walltime(environ, segment, True, FakeThroughput(31))
+    assert environ['walltime'] == '01:15:00'
+
+    environ = {'walltime': 'auto', 'max_walltime': '00:30:00'}
+    tasks._segment_walltime(environ, segment, True, FakeThroughput(31))
+    assert environ['walltime'] == '00:30:00'
+    environ = {'walltime': 'auto', 'max_walltime': '02:00:00'}
+    tasks._segment_walltime(environ, segment, True, FakeThroughput(None))
+    assert environ['walltime'] == '02:00:00'
+
+    # explicit requests are kept
+    environ = {'walltime': '08:00:00'}
+    tasks._segment_walltime(environ, segment, False, FakeThroughput(31))
+    assert environ['walltime'] == '08:00:00'
+
+
+def test_history_all_flag():
+    environ = {'name': 'exp'}
+    with mock.patch('bosun.tasks.JobStore') as store, \
+            mock.patch('bosun.tasks.print_history'):
+        store.return_value.jobs.return_value = []
+        tasks.history(environ, all='False')
+        assert store.return_value.jobs.call_args[0][0] == 'exp'
+        tasks.history(environ, all='True')
+        assert store.return_value.jobs.call_args[0][0] is None
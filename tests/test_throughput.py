@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+
+from bosun import jobs, throughput
+
+
+def test_config_key():
+    environ = {'type': 'atmos', 'TRC': 62, 'LV': 28, 'npes': 48,
+               'dt_atmos': 600, 'name': 'exp'}
+    assert throughput.config_key(environ) == \
+        'type=atmos,TRC=62,LV=28,npes=48,dt_atmos=600'
+
+
+def test_segment_days():
+    assert throughput.segment_days(2000020100, 2000030100) == 29
+    assert throughput.segment_days('2000020100', '2000030100',
+                                   'noleap') == 28
+    assert throughput.segment_days('2000010100', '2000010112') == .5
+
+
+def test_walltime_request():
+    # 20% margin, rounded up to 5 minutes
+    assert throughput.walltime_request(3600) == '01:15:00'
+    assert throughput.walltime_request(3600, margin=0) == '01:00:00'
+    assert throughput.walltime_request(3600, limit=4000) == '01:06:40'
+
+
+def test_throughput():
+    root = tempfile.mkdtemp()
+    try:
+        store = jobs.JobStore(os.path.join(root, 'jobs.db'))
+        model = throughput.Throughput(store, samples=3)
+        assert model.predict('c', 30) is None
+
+        # days, seconds running, verified
+        segments = [(10, 36000, True),   # too old: outside the samples
+                    (31, 3600, True),
+                    (30, 7200, False),   # killed by walltime
+                    (30, 3600, True),
+                    (30, 60, False),     # crashed
+                    (15, 1200, True),
+                    (30, 7200, True)]
+        for i, (days, secs, verified) in enumerate(segments):
+            job_id = '%d.sdb' % i
+            store.submitted('h', job_id, 'exp', 'model', config='c',
+                            days=days, when=i + 1)
+            store.transition('h', job_id, 'R', when=100000 * (i + 1))
+            # qstat only shows minutes: not used
+            store.transition('h', job_id, 'F', {'Time': '00:01'},
+                             when=100000 * (i + 1) + secs)
+            if verified:
+                store.verified('h', job_id)
+        # other configurations and post-processing don't count
+        for job_id, config, component in (('x.sdb', 'd', 'model'),
+                                          ('p.sdb', 'c', 'pos')):
+            store.submitted('h', job_id, 'exp', component, config=config,
+                            days=1)
+            store.transition('h', job_id, 'R', when=1)
+            store.transition('h', job_id, 'F', when=36001)
+            store.verified('h', job_id)
+
+        assert [round(r, 6) for r in model.rates('c')] == [30, 45, 15]
+        assert model.rate('c') == (30., 3)
+        assert model.predict('c', 15) == 1800
+    finally:
+        shutil.rmtree(root)
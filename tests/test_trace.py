@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import tempfile
+
+from fabric.api import settings, hide
+
+from bosun import remote, trace
+
+
+def _read(path):
+    with open(path) as f:
+        return json.load(f)['traceEvents']
+
+
+def test_disabled():
+    trace.clear()
+    with settings(bosun_trace=None):
+        with trace.span('task', 'task'):
+            trace.annotate(exit_code=0)
+    assert trace._events == []
+
+
+def test_nested_spans():
+    trace.clear()
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'trace.json')
+    try:
+        with settings(bosun_trace=path):
+            with trace.span('deploy', 'task', experiment='exp'):
+                with trace.span('run', 'remote', command='ls'):
+                    trace.annotate(bytes_sent=2, bytes_received=10)
+                    trace.annotate(bytes_received=5, exit_code=0)
+                assert not os.path.exists(path)
+        events = _read(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    run, deploy = events
+    assert deploy['name'] == 'deploy' and deploy['ph'] == 'X'
+    assert run['args'] == {'command': 'ls', 'bytes_sent': 2,
+                           'bytes_received': 15, 'exit_code': 0}
+    assert deploy['ts'] <= run['ts']
+    assert run['ts'] + run['dur'] <= deploy['ts'] + deploy['dur']
+    assert trace.summary()[0][:3] == ('deploy', 'task', 1)
+
+
+def test_error_recorded():
+    trace.clear()
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'trace.json')
+    try:
+        with settings(bosun_trace=path):
+            try:
+                with trace.span('deploy', 'task'):
+                    raise SystemExit(1)
+            except SystemExit:
+                pass
+        event, = _read(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    assert event['args']['error'] == 'exit 1'
+
+
+def test_remote_calls_traced():
+    trace.clear()
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'trace.json')
+    try:
+        with settings(hide('everything'), bosun_backend='local',
+                      host_string='local', shell='/bin/bash -c',
+                      bosun_trace=path, warn_only=True):
+            remote.run('echo hello; exit 3')
+            remote.exists(tmpdir)
+        run, exists = _read(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    assert run['cat'] == 'remote'
+    assert run['args']['exit_code'] == 3
+    assert run['args']['bytes_received'] == len('hello')
+    assert exists['args']['exists'] is True
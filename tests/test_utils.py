@@ -72,3 +72,60 @@ def test_clear_output():
     assert ("TRANSFER_HOME=" not in cleaned) is True
     assert ("SUBMIT_HOME=" not in cleaned) is True
     assert ("WORK_HOME=" not in cleaned) is True
+
+
+def test_segment_plan_months():
+    plan = utils.SegmentPlan('2000010100', '2000070100', '2 months')
+    assert len(plan) == 3
+    assert plan[0] == utils.Segment(0, '2000010100', '2000030100', 2, None)
+    assert plan[-1].start == '2000050100'
+    assert [s.end for s in plan] == ['2000030100', '2000050100',
+                                     '2000070100']
+
+
+def test_segment_plan_partial_last_segment():
+    plan = utils.SegmentPlan('2000010100', '2000011500', '10 days')
+    assert len(plan) == 2
+    assert plan[1] == utils.Segment(1, '2000011100', '2000011500', None, 4)
+
+
+def test_segment_plan_calendars():
+    days = {}
+    for calendar in ('gregorian', 'noleap', '360_day'):
+        plan = utils.SegmentPlan('2000010100', '2100010100', '1 day',
+                                 calendar=calendar)
+        days[calendar] = len(plan)
+        assert plan[len(plan) - 1].end == '2100010100'
+    assert days == {'gregorian': 36525, 'noleap': 36500, '360_day': 36000}
+
+    plan = utils.SegmentPlan('2000022500', '2000030500', '1 day',
+                             calendar='360_day')
+    assert [s.start[6:8] for s in plan][3:6] == ['28', '29', '30']
+
+
+def test_segment_plan_resume():
+    plan = utils.SegmentPlan('1900010100', '2100010100', '1 month')
+    assert len(plan) == 2400
+    assert plan.index('2000011500') == 1200
+    segments = plan.starting_at('2000011500')
+    assert next(segments) == utils.Segment(1200, '2000011500', '2000020100',
+                                           None, 17)
+    assert next(segments).start == '2000020100'
+
+    # the experiment already finished
+    assert list(plan.starting_at('2100010100')) == []
+
+    single = utils.SegmentPlan('2000010100', '2000031500')
+    assert list(single) == [utils.Segment(0, '2000010100', '2000031500',
+                                          None, 74)]
+
+
+def test_parse_flag():
+    # as given on the command line, history:all=False
+    assert not utils.parse_flag('False')
+    assert not utils.parse_flag('0')
+    assert not utils.parse_flag('')
+    assert utils.parse_flag('True')
+    assert utils.parse_flag('yes')
+    assert utils.parse_flag(True)
+    assert not utils.parse_flag(None)